@@ -67,7 +67,8 @@ from safe.common.utilities import (
     format_int)
 from safe.common.converter import convert_mmi_data
 from safe.common.version import get_version
-from safe.common.polygon import in_and_outside_polygon
+from safe.common.polygon import (in_and_outside_polygon,
+                                 label_points_by_polygons)
 from safe.common.tables import Table, TableCell, TableRow
 from safe.postprocessors import (
     get_postprocessors,
@@ -107,7 +107,9 @@ def validate_inputs(
             '%s' % str(e))
         raise Exception(msg)
 
-    if len(z.shape) != dimensions:
+    # In 2D a trailing axis of bands is allowed
+    if not (len(z.shape) == dimensions or
+            (dimensions == 2 and len(z.shape) == 3)):
         msg = 'z must be a %iD numpy array got a: %dD' % (
             dimensions, len(z.shape))
         raise Exception(msg)
@@ -130,7 +132,7 @@ def validate_inputs(
         xi = points[:]
 
     else:
-        (m, n) = z.shape
+        (m, n) = z.shape[:2]
         Ny = len(y)
         if not (Nx == m and Ny == n):
             msg = (
@@ -25,11 +25,71 @@ import logging
 import numpy
 from safe.common.exceptions import InaSAFEError
 from safe.common.interpolation import validate_inputs, validate_mode
+from safe.common.numerics import geotransform_to_axes
 
 LOGGER = logging.getLogger('InaSAFE')
 # pylint: disable=W0105
 
 
+def is_regular_axis(x, rtol=1.0e-6):
+    """Determine if coordinate vector is equidistantly spaced
+
+    :param x: 1D array of monotonically increasing coordinates
+    :type x: numpy.ndarray
+
+    :param rtol: Tolerance on spacing relative to the mean spacing
+    :type rtol: float
+
+    :returns: True if all spacings agree with the mean spacing to within
+        the tolerance, otherwise False
+    :rtype: bool
+    """
+
+    if len(x) < 2:
+        return False
+
+    step = float(x[-1] - x[0]) / (len(x) - 1)
+    if not step > 0:
+        return False
+
+    return bool(numpy.all(numpy.abs(numpy.diff(x) - step) <= rtol * step))
+
+
+def regular_axis_index(x, xi):
+    """Find upper neighbours on an equidistantly spaced axis
+
+    :param x: 1D array of equidistantly spaced, increasing coordinates
+    :type x: numpy.ndarray
+
+    :param xi: 1D array of coordinates within [x[0], x[-1]]
+    :type xi: numpy.ndarray
+
+    :returns: Integer array with same result as
+        numpy.searchsorted(x, xi, side='left')
+
+    ..note::
+        The index is computed from the origin and spacing and then
+        corrected by at most one step against the actual coordinates so
+        that rounding never makes the result differ from a binary search.
+    """
+
+    n = len(x)
+    step = float(x[-1] - x[0]) / (n - 1)
+
+    idx = numpy.ceil((xi - x[0]) / step).astype(numpy.int)
+    numpy.clip(idx, 0, n - 1, out=idx)
+
+    # Step down where the lower neighbour is not strictly less than xi
+    mask = (idx > 0) & (x[idx - 1] >= xi)
+    idx[mask] -= 1
+
+    # Step up where the neighbour is strictly less than xi
+    mask = (idx < n - 1) & (x[idx] < xi)
+    idx[mask] += 1
+
+    return idx
+
+
 # noinspection PyArgumentEqualDefault,PyTypeChecker
 def interpolate2d(x, y, z, points, mode='linear', bounds_error=False):
     """Fundamental 2D interpolation routine
@@ -40,7 +100,8 @@ def interpolate2d(x, y, z, points, mode='linear', bounds_error=False):
     :param y: 1D array of y-coordinates of the mesh on which to interpolate
     :type y: numpy.ndarray
 
-    :param z: 2D array of values for each x, y pair
+    :param z: 2D array of values for each x, y pair or 3D array with a
+        trailing axis of B bands of values for each x, y pair
     :type z: numpy.ndarry
 
     :param points: Nx2 array of coordinates where interpolated values are
@@ -63,6 +124,7 @@ def interpolate2d(x, y, z, points, mode='linear', bounds_error=False):
     :type bounds_error: bool
 
     :returns: 1D array with same length as points with interpolated values
+        or NxB array if z has a band axis
 
     :raises: Exception, BoundsError (see note about bounds_error)
 
@@ -80,12 +142,17 @@ def interpolate2d(x, y, z, points, mode='linear', bounds_error=False):
         data is typically organised with longitudes (x) going from left to
         right and latitudes (y) from left to right then user
         interpolate_raster in this module
+
+        If both x and y are equidistantly spaced, as is always the case for
+        raster axes, neighbours are located arithmetically from the origin
+        and spacing rather than by binary search.
     """
 
     # Input checks
     validate_mode(mode)
     x, y, z, xi, eta = validate_inputs(
         x=x, y=y, z=z, points=points, bounds_error=bounds_error)
+    bands = z.shape[2:]
 
     # Identify elements that are outside interpolation domain or NaN
     outside = (xi < x[0]) + (eta < y[0]) + (xi > x[-1]) + (eta > y[-1])
@@ -96,17 +163,24 @@ def interpolate2d(x, y, z, points, mode='linear', bounds_error=False):
     eta = eta[inside]
 
     # Find upper neighbours for each interpolation point
-    idx = numpy.searchsorted(x, xi, side='left')
-    idy = numpy.searchsorted(y, eta, side='left')
-
-    # Internal check (index == 0 is OK)
-    if len(idx) > 0 or len(idy) > 0:
-        if (max(idx) >= len(x)) or (max(idy) >= len(y)):
-            msg = (
-                'Interpolation point outside domain. '
-                'This should never happen. '
-                'Please email Ole.Moller.Nielsen@gmail.com')
-            raise InaSAFEError(msg)
+    regular = is_regular_axis(x) and is_regular_axis(y)
+    if regular:
+        # Equidistant axes (e.g. from geotransform_to_axes): compute
+        # indices directly from origin and spacing
+        idx = regular_axis_index(x, xi)
+        idy = regular_axis_index(y, eta)
+    else:
+        idx = numpy.searchsorted(x, xi, side='left')
+        idy = numpy.searchsorted(y, eta, side='left')
+
+        # Internal check (index == 0 is OK)
+        if len(idx) > 0 or len(idy) > 0:
+            if (max(idx) >= len(x)) or (max(idy) >= len(y)):
+                msg = (
+                    'Interpolation point outside domain. '
+                    'This should never happen. '
+                    'Please email Ole.Moller.Nielsen@gmail.com')
+                raise InaSAFEError(msg)
 
     # Get the four neighbours for each interpolation point
     x0 = x[idx - 1]
@@ -126,6 +200,11 @@ def interpolate2d(x, y, z, points, mode='linear', bounds_error=False):
     numpy.seterr(**old_set)  # Restore
 
     if mode == 'linear':
+        if bands:
+            # Same coefficients for all bands
+            alpha = alpha[:, numpy.newaxis]
+            beta = beta[:, numpy.newaxis]
+
         # Bilinear interpolation formula
         dx = z10 - z00
         dy = z01 - z00
@@ -151,8 +230,9 @@ def interpolate2d(x, y, z, points, mode='linear', bounds_error=False):
         z[lower_right] = z10[lower_right]
         z[upper_left] = z01[upper_left]
 
-    # Self test
-    if len(z) > 0:
+    # Self test (not needed for the regular grid fast path where indices
+    # are bounded by construction)
+    if not regular and len(z) > 0:
         mz = numpy.nanmax(z)
         mZ = numpy.nanmax(z)
         # noinspection PyStringFormat
@@ -164,7 +244,7 @@ def interpolate2d(x, y, z, points, mode='linear', bounds_error=False):
 
     # Populate result with interpolated values for points inside domain
     # and NaN for values outside
-    r = numpy.zeros(len(points))
+    r = numpy.zeros((len(points),) + bands)
     r[inside] = z
     r[outside] = numpy.nan
 
@@ -189,7 +269,8 @@ def interpolate_raster(x, y, z, points, mode='linear', bounds_error=False):
     :param y: 1D array of y-coordinates of the mesh on which to interpolate
     :type y: numpy.ndarray
 
-    :param z: 2D array of values for each x, y pair
+    :param z: 2D array of values for each x, y pair or 3D array of B
+        bands (B x latitudes x longitudes)
     :type z: numpy.ndarry
 
     :param points: Nx2 array of coordinates where interpolated values are
@@ -212,23 +293,184 @@ def interpolate_raster(x, y, z, points, mode='linear', bounds_error=False):
     :type bounds_error: bool
 
     :returns: 1D array with same length as points with interpolated values
+        or NxB array if z is a stack of B bands
 
     :raises: Exception, BoundsError (see note about bounds_error)
+
+    ..note::
+        For a stack of bands, neighbours and interpolation coefficients
+        are computed once and applied to all bands together.
     """
 
-    # Flip matrix z up-down to interpret latitudes ordered from south to north
-    z = numpy.flipud(z)
+    z = numpy.asarray(z)
+    if len(z.shape) == 3:
+        # Flip latitudes to go from south to north and move bands to the
+        # last axis so that x coordinates follow the first axis and y
+        # coordinates the second
+        z = z[:, ::-1, :].transpose((2, 1, 0))
+    else:
+        # Flip matrix z up-down to interpret latitudes ordered from south
+        # to north
+        z = numpy.flipud(z)
 
-    # Transpose z to have y coordinates along the first axis and x coordinates
-    # along the second axis
-    # noinspection PyUnresolvedReferences
-    z = z.transpose()
+        # Transpose z to have y coordinates along the first axis and x
+        # coordinates along the second axis
+        # noinspection PyUnresolvedReferences
+        z = z.transpose()
 
     # Call underlying interpolation routine and return
     res = interpolate2d(x, y, z, points, mode=mode, bounds_error=bounds_error)
     return res
 
 
+class InterpolationPlan(object):
+    """Precomputed interpolation from a raster grid to fixed points
+
+    Args:
+        * geotransform: GDAL geotransform (6-tuple) of the grid.
+        * rows: Number of rows (latitudes) in the grid
+        * columns: Number of columns (longitudes) in the grid
+        * points: Nx2 array of coordinates where interpolated values are
+            sought
+        * mode: 'linear' (default) or 'constant'. See interpolate2d.
+
+    Note:
+        Neighbour indices and interpolation coefficients depend only on the
+        grid geometry and the points. They are computed once here and
+        apply() then interpolates any grid with the same geometry by a
+        gather of the neighbouring values followed by a weighted sum.
+        The result is identical to that of interpolate_raster.
+    """
+
+    def __init__(self, geotransform, rows, columns, points, mode='linear'):
+        """Compute neighbour indices and weights for points
+        """
+
+        validate_mode(mode)
+
+        self.geotransform = tuple(geotransform)
+        self.rows = rows
+        self.columns = columns
+        self.mode = mode
+
+        x, y = geotransform_to_axes(geotransform, columns, rows)
+        points = numpy.array(points, dtype='d', copy=False)
+        if len(points) == 0:
+            points = numpy.zeros((0, 2))
+        self.number_of_points = len(points)
+
+        xi = points[:, 0]
+        eta = points[:, 1]
+
+        # Identify elements that are outside interpolation domain or NaN
+        outside = (xi < x[0]) + (eta < y[0]) + (xi > x[-1]) + (eta > y[-1])
+        outside += numpy.isnan(xi) + numpy.isnan(eta)
+        self.inside = numpy.flatnonzero(-outside)
+
+        xi = xi[self.inside]
+        eta = eta[self.inside]
+
+        # Find upper neighbours for each interpolation point
+        if is_regular_axis(x) and is_regular_axis(y):
+            idx = regular_axis_index(x, xi)
+            idy = regular_axis_index(y, eta)
+        else:
+            idx = numpy.searchsorted(x, xi, side='left')
+            idy = numpy.searchsorted(y, eta, side='left')
+
+        # Coefficients for weighting between lower and upper bounds
+        old_set = numpy.seterr(invalid='ignore')  # Suppress warnings
+        alpha = (xi - x[idx - 1]) / (x[idx] - x[idx - 1])
+        beta = (eta - y[idy - 1]) / (y[idy] - y[idy - 1])
+        numpy.seterr(**old_set)  # Restore
+
+        # Flat indices into grid with latitudes from north to south along
+        # the first axis and longitudes along the second as in
+        # interpolate_raster. Lower neighbour index -1 wraps around as it
+        # does in interpolate2d.
+        col0 = (idx - 1) % columns
+        col1 = idx
+        row0 = rows - 1 - (idy - 1) % rows
+        row1 = rows - 1 - idy
+
+        if mode == 'linear':
+            self.alpha = alpha
+            self.beta = beta
+            self.i00 = row0 * columns + col0
+            self.i01 = row1 * columns + col0
+            self.i10 = row0 * columns + col1
+            self.i11 = row1 * columns + col1
+        else:
+            # Piecewise constant: pick nearest neighbour once and for all
+            left = alpha < 0.5
+            lower = beta < 0.5
+            col = numpy.where(left, col0, col1)
+            row = numpy.where(lower, row0, row1)
+            self.index = row * columns + col
+
+    def __len__(self):
+        """Number of points in plan
+        """
+        return self.number_of_points
+
+    def is_compatible(self, geotransform, rows, columns):
+        """Determine if plan can be applied to grid with given geometry
+
+        Args:
+            * geotransform: GDAL geotransform (6-tuple) of the grid.
+            * rows: Number of rows in the grid
+            * columns: Number of columns in the grid
+
+        Returns:
+            True if grid geometry is that of the plan, otherwise False
+        """
+
+        return (tuple(geotransform) == self.geotransform and
+                rows == self.rows and columns == self.columns)
+
+    def apply(self, z):
+        """Interpolate grid values to the points of this plan
+
+        Args:
+            * z: 2D array of values with latitudes from north to south along
+                the first axis and longitudes from west to east along the
+                second, i.e. as returned by Raster.get_data(), or 3D stack
+                of B such arrays as returned by Raster.get_bands()
+
+        Returns:
+            1D array with same length as points with interpolated values
+            and NaN for points outside the grid, or NxB array for a stack
+            of bands
+        """
+
+        z = numpy.asarray(z)
+        if z.shape[-2:] != (self.rows, self.columns) or len(z.shape) > 3:
+            msg = ('Grid of dimensions %s does not match interpolation plan '
+                   'for %i rows and %i columns'
+                   % (str(z.shape), self.rows, self.columns))
+            raise InaSAFEError(msg)
+
+        # Gather along flat grid index for all bands at once
+        bands = z.shape[:-2]
+        z = z.reshape(bands + (self.rows * self.columns,))
+
+        r = numpy.zeros(bands + (self.number_of_points,))
+        r[:] = numpy.nan
+
+        if self.mode == 'linear':
+            z00 = z[..., self.i00]
+            dx = z[..., self.i10] - z00
+            dy = z[..., self.i01] - z00
+            r[..., self.inside] = (z00 + self.alpha * dx + self.beta * dy +
+                                   self.alpha * self.beta *
+                                   (z[..., self.i11] - dx - dy - z00))
+        else:
+            r[..., self.inside] = z[..., self.index]
+
+        # Points along the first axis
+        return r.T
+
+
 # Mathematical derivation of the interpolation formula used
 # noinspection PyStatementEffect
 """
@@ -94,7 +94,55 @@ def nan_allclose(x, y, rtol=1.0e-5, atol=1.0e-8):
     return numpy.allclose(x, y, rtol=rtol, atol=atol)
 
 
-def normal_cdf(x, mu=0, sigma=1):
+def _float_array(x):
+    """Convert input to floating point array without upcasting floats
+
+    :param x: scalar or array of real numbers
+    :type x: numpy.ndarray, float
+
+    :returns: x as an array. Arrays of float32 (or other floating point
+        types) are returned as they are, anything else is converted to
+        float64.
+    :rtype: numpy.ndarray
+    """
+
+    x = numpy.asarray(x)
+    if x.dtype.kind != 'f':
+        x = x.astype(numpy.float64)
+
+    return x
+
+
+def _result_array(x, out, *args):
+    """Establish output array for element wise functions
+
+    :param x: Floating point input array
+    :type x: numpy.ndarray
+
+    :param out: Output array or None. If None a new array is created with
+        the broadcast shape of x and args and the dtype of x (float64 if
+        any of args is a float64 array).
+    :type out: numpy.ndarray, None
+
+    :param args: Further scalar or array arguments broadcast against x
+
+    :returns: out
+    :rtype: numpy.ndarray
+    """
+
+    if out is None:
+        dtype = x.dtype
+        for arg in args:
+            if isinstance(arg, numpy.ndarray) and arg.dtype.kind == 'f':
+                dtype = numpy.promote_types(dtype, arg.dtype)
+
+        shape = numpy.broadcast(x, *args).shape
+        out = numpy.empty(shape, dtype=dtype)
+
+    return out
+
+
+def normal_cdf(x, mu=0, sigma=1, out=None):
     r"""Cumulative Normal Distribution Function
 
     :param x: scalar or array of real numbers
@@ -106,6 +154,9 @@ def normal_cdf(x, mu=0, sigma=1):
     :param sigma: Standard deviation. Default 1
     :type sigma: float
 
+    :param out: Optional array for the result. It may be x itself.
+    :type out: numpy.ndarray
+
     :returns: An approximation of the cdf of the normal
     :rtype: numpy.ndarray
 
@@ -114,15 +165,26 @@ def normal_cdf(x, mu=0, sigma=1):
         \frac12 [1 + erf(\frac{x - \mu}{\sigma \sqrt{2}})], x \in \R
 
         Source: http://en.wikipedia.org/wiki/Normal_distribution
+
+        Float32 input gives float32 output. All operations are done in
+        place on the output array.
     """
 
-    arg = (x - mu) / (sigma * numpy.sqrt(2))
-    res = (1 + erf(arg)) / 2
+    x = _float_array(x)
+    res = _result_array(x, out, mu, sigma)
+
+    numpy.subtract(x, mu, res)
+    res /= sigma * numpy.sqrt(2)
+    erf(res, out=res)
+    res += 1
+    res /= 2
 
+    if res.ndim == 0 and out is None:
+        return res[()]
     return res
 
 
-def log_normal_cdf(x, median=1, sigma=1):
+def log_normal_cdf(x, median=1, sigma=1, out=None):
     r"""Cumulative Log Normal Distribution Function
 
     :param x: scalar or array of real numbers
@@ -134,6 +196,9 @@ def log_normal_cdf(x, median=1, sigma=1):
     :param sigma: Log normal standard deviation. Default 1
     :type sigma: float
 
+    :param out: Optional array for the result. It may be x itself.
+    :type out: numpy.ndarray
+
     :returns: An approximation of the cdf of the normal
     :rtype: numpy.ndarray
 
@@ -144,16 +209,32 @@ def log_normal_cdf(x, median=1, sigma=1):
         Source: http://en.wikipedia.org/wiki/Normal_distribution
     """
 
-    return normal_cdf(numpy.log(x), mu=numpy.log(median), sigma=sigma)
+    x = _float_array(x)
+    res = _result_array(x, out, median, sigma)
+
+    numpy.log(x, res)
+    normal_cdf(res, mu=numpy.log(median), sigma=sigma, out=res)
+
+    if res.ndim == 0 and out is None:
+        return res[()]
+    return res
+
+
+# Coefficients of Chebyshev fitting formula used by erf, highest order first
+ERF_COEFFICIENTS = [0.17087277, -0.82215223, 1.48851587, -1.13520398,
+                    0.27886807, -0.18628806, 0.09678418, 0.37409196,
+                    1.00002368, -1.26551223]
 
 
-# noinspection PyUnresolvedReferences
-def erf(z):
+def erf(z, out=None):
     """Approximation to ERF
 
     :param z: input array or scalar to perform erf on
     :type z: numpy.ndarray, float
 
+    :param out: Optional array for the result. It may be z itself.
+    :type out: numpy.ndarray
+
     :returns: the approximate error
     :rtype: numpy.ndarray, float
 
@@ -170,41 +251,46 @@ def erf(z):
         Source:
         http://stackoverflow.com/questions/457408/
         is-there-an-easily-available-implementation-of-erf-for-python
+
+        The formula is evaluated with whole array operations, in place on
+        the output array where possible, and float32 input gives float32
+        output.
     """
 
-    # Input check
-    try:
-        len(z)
-    except TypeError:
-        scalar = True
-        z = [z]
-    else:
-        scalar = False
+    z = _float_array(z)
+    scalar = z.ndim == 0 and out is None
+    ans = _result_array(z, out)
 
-    z = numpy.array(z)
+    # Remember sign as the output may overwrite z
+    neg = numpy.signbit(z)
 
     # Begin algorithm
-    t = 1.0 / (1.0 + 0.5 * numpy.abs(z))
-
-    # Use Horner's method
-    ans = 1 - t * numpy.exp(-z * z - 1.26551223 +
-                           t * (1.00002368 +
-                           t * (0.37409196 +
-                           t * (0.09678418 +
-                           t * (-0.18628806 +
-                           t * (0.27886807 +
-                           t * (-1.13520398 +
-                           t * (1.48851587 +
-                           t * (-0.82215223 +
-                           t * 0.17087277)))))))))
-
-    neg = (z < 0.0)  # Mask for negative input values
-    ans[neg] = -ans[neg]
+    numpy.abs(z, ans)
+    t = numpy.multiply(ans, 0.5, out=numpy.empty_like(ans))
+    t += 1
+    numpy.reciprocal(t, t)
+
+    # Exponent -z * z + polynomial in t using Horner's method
+    numpy.square(ans, ans)
+    numpy.negative(ans, ans)
+    p = numpy.empty_like(t)
+    p[...] = ERF_COEFFICIENTS[0]
+    for c in ERF_COEFFICIENTS[1:]:
+        p *= t
+        p += c
+    ans += p
+    del p
+
+    numpy.exp(ans, ans)
+    ans *= t
+    numpy.subtract(1, ans, ans)
+
+    # Odd function
+    ans[neg] *= -1
 
     if scalar:
-        return ans[0]
-    else:
-        return ans
+        return ans[()]
+    return ans
 
 
 def axes_to_points(x, y):
@@ -261,7 +347,138 @@ def axes_to_points(x, y):
     return P
 
 
-def grid_to_points(A, x, y):
+class GridPoints(object):
+    """Lazy Nx2 array of coordinates of all grid points
+
+    Args:
+        * x: Increasing x coordinates (longitudes) of the grid columns
+        * y: Increasing y coordinates (latitudes) of the grid rows
+
+    Note:
+        Points are ordered as by axes_to_points, i.e. with x varying the
+        fastest and the northern row first, so that they match a grid A
+        flattened in 'C' order. Only the axes are stored. Coordinates are
+        computed from (row, column) when points are indexed, so selecting
+        points with an integer or boolean index array or a slice only
+        allocates the selected points. Use iter_chunks to visit all points
+        while holding one chunk at a time.
+
+        numpy.array(P) returns the full Nx2 array.
+    """
+
+    def __init__(self, x, y):
+        """Store axes
+        """
+
+        self.x = ensure_numeric(x, numpy.float)
+        self.y = ensure_numeric(y, numpy.float)[::-1]  # Northern row first
+
+        self.columns = len(self.x)
+        self.rows = len(self.y)
+        self.shape = (self.rows * self.columns, 2)
+        self.ndim = 2
+        self.dtype = numpy.dtype(numpy.float)
+
+    def __len__(self):
+        """Number of grid points
+        """
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        """Return all points as Nx2 array
+        """
+
+        P = self.get_points(numpy.arange(len(self)))
+        if dtype is not None:
+            P = P.astype(dtype)
+        return P
+
+    def __getitem__(self, key):
+        """Get coordinates of selected points
+
+        Args:
+            * key: Integer, slice, integer array or boolean mask selecting
+              points, optionally followed by an index into the coordinate
+              axis as for a numpy array, e.g. P[:10, 0].
+
+        Returns:
+            Array of coordinates for the selected points
+        """
+
+        if isinstance(key, tuple):
+            points = self[key[0]]
+            if points.ndim == 1:
+                return points[key[1:]]
+            else:
+                return points[(slice(None),) + key[1:]]
+
+        if isinstance(key, slice):
+            return self.get_points(numpy.arange(*key.indices(len(self))))
+
+        indices = numpy.asarray(key)
+        if indices.dtype == numpy.bool:
+            verify(indices.shape == (len(self),),
+                   'Boolean index must have one element per grid point')
+            return self.get_points(numpy.flatnonzero(indices))
+
+        if indices.ndim == 0:
+            index = int(indices)
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError('Grid point index %i out of range'
+                                 % int(indices))
+            return self.get_points(numpy.array([index]))[0]
+
+        return self.get_points(indices)
+
+    def __iter__(self):
+        """Iterate over points one chunk at a time
+        """
+
+        for _, points in self.iter_chunks():
+            for point in points:
+                yield point
+
+    def get_points(self, indices):
+        """Compute coordinates of points
+
+        Args:
+            * indices: Array of flat indices of grid points. Negative
+              indices count from the end.
+
+        Returns:
+            Nx2 array of coordinates
+        """
+
+        indices = numpy.asarray(indices, dtype=numpy.int)
+        indices = numpy.where(indices < 0, indices + len(self), indices)
+
+        points = numpy.empty((len(indices), 2))
+        points[:, 0] = self.x[indices % self.columns]
+        points[:, 1] = self.y[indices // self.columns]
+
+        return points
+
+    def iter_chunks(self, chunk_size=2 ** 16):
+        """Iterate over all points in chunks
+
+        Args:
+            * chunk_size: Number of points in each chunk (the last one
+              may be smaller)
+
+        Returns:
+            Generator of tuples (start, points) where points is the Mx2
+            array of coordinates of points start to start + M
+        """
+
+        N = len(self)
+        for start in range(0, N, chunk_size):
+            stop = min(start + chunk_size, N)
+            yield start, self.get_points(numpy.arange(start, stop))
+
+
+def grid_to_points(A, x, y, lazy=False):
     """Convert grid data to point data
 
     :param A: Array of pixel values
@@ -273,8 +490,12 @@ def grid_to_points(A, x, y):
     :param y: Latitudes corresponding to rows in A (south->north)
     :type y: numpy.ndarray
 
+    :param lazy: If True, return points as a GridPoints instance which
+        computes coordinates on demand rather than as an array.
+    :type lazy: bool
+
     Returns:
-        * P: Nx2 array of point coordinates
+        * P: Nx2 array of point coordinates (or GridPoints if lazy)
         * V: N array of point values
     """
 
@@ -286,7 +507,10 @@ def grid_to_points(A, x, y):
 
     # Create Nx2 array of x, y points corresponding to each
     # element in A.
-    points = axes_to_points(x, y)
+    if lazy:
+        points = GridPoints(x, y)
+    else:
+        points = axes_to_points(x, y)
 
     # Create flat 1D row-major view of A cast as
     # one column vector of length MxN where M, N = A.shape
@@ -3,7 +3,10 @@
 .. tip::
    The main public functions are:
      separate_points_by_polygon: Fundamental clipper
+     inside_polygons: Classify points by many polygons using a spatial index
+     label_points_by_polygons: Label points by the first polygon they fall in
      intersection: Determine intersections of lines
+     intersect_segments: Determine intersections between many line segments
 
    Some more specific or helper functions include:
      inside_polygon
@@ -11,6 +14,10 @@
      outside_polygon
      is_outside_polygon
      point_on_line
+     PackedRTree
+     PreparedPolygon
+     PolygonGrid
+     rasterise_polygons
 """
 
 __author__ = 'Ole Nielsen <ole.moller.nielsen@gmail.com>'
@@ -22,28 +29,46 @@ __copyright__ += 'Disaster Reduction'
 
 
 import logging
+import multiprocessing
+import numbers
 import numpy
-from random import uniform, seed as seed_function
 
 from safe.common.numerics import ensure_numeric
-from safe.common.numerics import grid_to_points, geotransform_to_axes
+from safe.common.numerics import geotransform_to_axes
+from safe.common.numerics import GridPoints
 from safe.common.exceptions import (
     PolygonInputError, InaSAFEError, PointsInputError)
 
 LOGGER = logging.getLogger('InaSAFE')
 
+# Polygons with at least this many vertices are automatically prepared
+# (see PreparedPolygon) in separate_points_by_polygon
+PREPARED_POLYGON_THRESHOLD = 64
+
+# Classified grids (see PolygonGrid) are automatically built when
+# classifying at least this many points by one polygon in inside_polygons
+# and label_points_by_polygons
+POLYGON_GRID_THRESHOLD = 10000
+
+# Points are only classified in parallel (see separate_points_by_polygon)
+# when at least this many fall inside the polygon bounding box
+PARALLEL_POINTS_THRESHOLD = 100000
+
 
 def separate_points_by_polygon(
         points, polygon,
         polygon_bbox=None,
         closed=True,
         check_input=True,
-        use_numpy=True):
+        use_numpy=True,
+        grid=None,
+        workers=None):
     """Determine whether points are inside or outside a polygon.
 
     Args:
         * points: Tuple of (x, y) coordinates, or list of tuples
-        * polygon: list or Nx2 array of polygon vertices
+        * polygon: list or Nx2 array of polygon vertices or a
+              PreparedPolygon instance
         * polygon_bbox: (optional) bounding box for polygon
         * closed: (optional) determine whether points on boundary should be
               regarded as belonging to the polygon (closed = True)
@@ -53,6 +78,13 @@ def separate_points_by_polygon(
               the code faster.
         * check_input: Allows faster execution if set to False
         * use_numpy: Use the fast numpy implementation
+        * grid: (optional) PolygonGrid built for this polygon. Only points
+              in grid cells crossed by the polygon boundary will then be
+              subjected to the exact test.
+        * workers: (optional) Number of processes to classify points with.
+              If greater than one, points are split into chunks which are
+              classified in a process pool. The result is the same as with
+              one process.
 
     Returns:
         * indices_inside_polygon: array of indices of points
@@ -77,10 +109,21 @@ def separate_points_by_polygon(
         Polygons can have holes in them and points inside a hole is
         regarded as being outside the polygon.
 
+        Polygons with many vertices are prepared (see PreparedPolygon)
+        so that each point is only tested against the edges near it.
+        Rectangles are tested against their bounding box and small convex
+        polygons against the half-planes of their edges.
+
     Algorithm is based on work by Darel Finley,
     http://www.alienryderflex.com/polygon/
     """
 
+    if isinstance(polygon, PreparedPolygon):
+        prepared = polygon
+        polygon = prepared.polygon
+    else:
+        prepared = None
+
     # FIXME (Ole): Make sure bounding box here follows same format as
     #              those returned by layers. Methinks they don't at the moment
     if check_input:
@@ -111,9 +154,10 @@ def separate_points_by_polygon(
         if polygon.shape[1] != 2:
             raise PolygonInputError(msg)
 
-        msg = ('Points array must be 1 or 2 dimensional. '
-               'I got %d dimensions: %s' % (len(points.shape), points))
         if not 0 < len(points.shape) < 3:
+            # Only format message when needed as points may be large
+            msg = ('Points array must be 1 or 2 dimensional. '
+                   'I got %d dimensions: %s' % (len(points.shape), points))
             raise PolygonInputError(msg)
 
         if len(points.shape) == 1:
@@ -137,6 +181,13 @@ def separate_points_by_polygon(
         if points.shape[1] != 2:
             raise PolygonInputError(msg)
 
+        msg = ('Keyword argument "workers" must be a positive integer or '
+               'None. I got %s' % str(workers))
+        if not (workers is None or
+                (isinstance(workers, numbers.Integral) and
+                 not isinstance(workers, bool) and workers > 0)):
+            raise PolygonInputError(msg)
+
     # If there are no points return two 0-vectors
     if points.shape[0] == 0:
         return numpy.arange(0), numpy.arange(0)
@@ -145,16 +196,12 @@ def separate_points_by_polygon(
     # are outside its bounding box. This is a very important
     # optimisation
     if polygon_bbox is None:
-        minpx = min(polygon[:, 0])
-        maxpx = max(polygon[:, 0])
-        minpy = min(polygon[:, 1])
-        maxpy = max(polygon[:, 1])
-        polygon_bbox = [minpx, maxpx, minpy, maxpy]
-    else:
-        minpx = polygon_bbox[0]
-        maxpx = polygon_bbox[1]
-        minpy = polygon_bbox[2]
-        maxpy = polygon_bbox[3]
+        polygon_bbox = get_polygon_bbox(polygon)
+
+    minpx = polygon_bbox[0]
+    maxpx = polygon_bbox[1]
+    minpy = polygon_bbox[2]
+    maxpy = polygon_bbox[3]
 
     x = points[:, 0]
     y = points[:, 1]
@@ -165,12 +212,46 @@ def separate_points_by_polygon(
     candidate_points = points[inside_box]
 
     if use_numpy:
-        func = _separate_points_by_polygon
+        if prepared is not None:
+            polygon_shape = prepared.polygon_shape
+        elif candidate_points.shape[0] > 0:
+            polygon_shape = get_polygon_shape(polygon)
+        else:
+            polygon_shape = 'general'
+
+        if (prepared is None and
+                polygon_shape != 'rectangle' and
+                polygon.shape[0] >= PREPARED_POLYGON_THRESHOLD and
+                candidate_points.shape[0] > 0):
+            # Large polygon - sort its edges into slabs
+            prepared = PreparedPolygon(polygon)
+
+        if polygon_shape == 'rectangle':
+            func = _separate_points_by_rectangle
+        elif prepared is not None:
+            polygon = prepared
+            func = _separate_points_by_prepared_polygon
+        elif polygon_shape == 'convex':
+            func = _separate_points_by_convex_polygon
+        else:
+            func = _separate_points_by_polygon
     else:
         func = _separate_points_by_polygon_python
 
-    local_indices_inside, local_indices_outside = func(
-        candidate_points, polygon, closed=closed)
+    if grid is not None:
+        msg = ('Grid was built with holes and can only be used with '
+               'in_and_outside_polygon')
+        if len(grid.holes) > 0:
+            raise InaSAFEError(msg)
+
+    if (workers is not None and workers > 1 and
+            candidate_points.shape[0] >= PARALLEL_POINTS_THRESHOLD):
+        local_indices_inside, local_indices_outside = \
+            _separate_points_in_parallel(candidate_points, polygon, closed,
+                                         func, grid, workers)
+    else:
+        local_indices_inside, local_indices_outside = _separate_points_chunk(
+            (candidate_points, polygon, closed, func, grid))
 
     # Map local indices from candidate points to global indices of all points
     indices_outside_box = numpy.where(outside_box)[0]
@@ -186,6 +267,68 @@ def separate_points_by_polygon(
     return indices_inside_polygon, indices_outside_polygon
 
 
+def _separate_points_chunk(args):
+    """Classify points by polygon with given algorithm
+
+    Input:
+       args - Tuple (points, polygon, closed, func, grid) where func is
+       the underlying algorithm for polygon and grid is a PolygonGrid or
+       None
+
+    Output:
+       indices_inside_polygon, indices_outside_polygon
+
+    This is a module level function taking one argument so that it can
+    be used with multiprocessing.Pool.map
+    """
+
+    points, polygon, closed, func, grid = args
+    if grid is None:
+        return func(points, polygon, closed=closed)
+    else:
+        return _separate_points_by_grid(
+            points, grid,
+            lambda P: func(P, polygon, closed=closed))
+
+
+def _separate_points_in_parallel(points, polygon, closed, func, grid,
+                                 workers):
+    """Classify points by polygon in a pool of processes
+
+    Input:
+       points - Nx2 array of point coordinates
+       polygon, closed, func, grid - See _separate_points_chunk
+       workers - Number of processes
+
+    Output:
+       indices_inside_polygon, indices_outside_polygon
+
+    Points are split into one contiguous chunk per process and the
+    results are merged in chunk order, so indices are ordered as if
+    the points were classified in one process.
+    """
+
+    workers = int(workers)
+    chunks = numpy.array_split(points, workers)
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(_separate_points_chunk,
+                           [(chunk, polygon, closed, func, grid)
+                            for chunk in chunks])
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    offsets = numpy.cumsum([0] + [len(chunk) for chunk in chunks])
+    indices_inside = numpy.concatenate(
+        [offsets[i] + inside for i, (inside, _) in enumerate(results)])
+    indices_outside = numpy.concatenate(
+        [offsets[i] + outside for i, (_, outside) in enumerate(results)])
+
+    return indices_inside, indices_outside
+
+
 def _separate_points_by_polygon(points, polygon,
                                 closed, rtol=0.0, atol=0.0):
     """Underlying algorithm to partition point according to polygon
@@ -374,6 +517,551 @@ def _separate_points_by_polygon_python(points, polygon,
     return indices[:inside_index], indices[inside_index:]
 
 
+#------------------------------------------------------------
+# Fast paths for rectangles and convex polygons
+#------------------------------------------------------------
+def _separate_points_by_rectangle(points, polygon, closed):
+    """Underlying algorithm to partition points according to rectangle
+
+    Input:
+       points - Nx2 array of point coordinates
+       polygon - Nx2 array of vertices of an axis-aligned rectangle
+       closed - (optional) determine whether points on boundary should be
+       regarded as belonging to the polygon (closed = True)
+       or not (closed = False). Close can also be None.
+
+    Output:
+       indices_inside_polygon, indices_outside_polygon
+    """
+
+    minpx, maxpx, minpy, maxpy = get_polygon_bbox(polygon)
+
+    x = points[:, 0]
+    y = points[:, 1]
+
+    if closed is False:
+        inside = (minpx < x) * (x < maxpx) * (minpy < y) * (y < maxpy)
+    else:
+        inside = (minpx <= x) * (x <= maxpx) * (minpy <= y) * (y <= maxpy)
+
+    return numpy.where(inside)[0], numpy.where(~inside)[0]
+
+
+def _separate_points_by_convex_polygon(points, polygon, closed):
+    """Underlying algorithm to partition points according to convex polygon
+
+    Input:
+       points - Nx2 array of point coordinates
+       polygon - Nx2 array of vertices of a convex polygon
+       closed - (optional) determine whether points on boundary should be
+       regarded as belonging to the polygon (closed = True)
+       or not (closed = False). Close can also be None.
+
+    Output:
+       indices_inside_polygon, indices_outside_polygon
+
+    Note:
+       A point is inside a convex polygon if it is on the inner side of
+       every edge. The side is determined from the same cross product used
+       by point_on_line so points on the boundary agree with it.
+    """
+
+    x = points[:, 0]
+    y = points[:, 1]
+
+    px_i = polygon[:, 0]
+    py_i = polygon[:, 1]
+    px_j = numpy.roll(px_i, -1)
+    py_j = numpy.roll(py_i, -1)
+
+    # Orientation of polygon from its signed area
+    if numpy.sum(px_i * py_j - px_j * py_i) > 0:
+        orientation = 1  # Counter clockwise
+    else:
+        orientation = -1  # Clockwise
+
+    inside = numpy.ones(points.shape[0], dtype=numpy.bool)
+    for i in range(polygon.shape[0]):
+        # Vector from beginning of edge to points and along edge
+        a0 = x - px_i[i]
+        a1 = y - py_i[i]
+        b0 = px_j[i] - px_i[i]
+        b1 = py_j[i] - py_i[i]
+        if b0 == 0 and b1 == 0:
+            # Repeated vertex
+            continue
+
+        side = (a1 * b0 - a0 * b1) * orientation
+        if closed is False:
+            inside *= side > 0
+        else:
+            inside *= side >= 0
+
+    return numpy.where(inside)[0], numpy.where(~inside)[0]
+
+
+#------------------------------------------------------------
+# Prepared polygons for repeated or large point in polygon tests
+#------------------------------------------------------------
+class PreparedPolygon(object):
+    """Polygon with its edges sorted into horizontal slabs
+
+    The bounding box of the polygon is divided into horizontal slabs
+    of equal height and every edge is registered with each slab its
+    y-extent overlaps. A point then only needs to be tested against the
+    edges in its own slab rather than against every edge of the polygon.
+
+    Preparing a polygon takes O(N log N) time for N vertices and can be
+    reused for any number of calls. Whether the polygon is a rectangle or
+    convex (see get_polygon_shape) is also determined once. Instances can
+    be passed to separate_points_by_polygon (and the functions built on
+    it) wherever an Nx2 array of polygon vertices is accepted.
+
+    Holes can be included in which case the edges of the outer ring and
+    all holes are tested together. A point is then inside if it crosses
+    an odd number of edges (the even-odd rule), which requires holes to
+    lie inside the outer ring and not to overlap each other.
+
+    Args:
+        * polygon: list or Nx2 array of polygon vertices
+        * number_of_slabs: (optional) number of slabs. If None a number
+            proportional to the number of vertices is used.
+        * holes: (optional) list of polygons representing holes
+
+    Raises:
+        PolygonInputError
+    """
+
+    def __init__(self, polygon, number_of_slabs=None, holes=None):
+
+        rings = [polygon]
+        if holes is not None:
+            rings.extend(holes)
+
+        for i, ring in enumerate(rings):
+            try:
+                ring = ensure_numeric(ring, numpy.float)
+            except Exception, e:
+                msg = ('Polygon could not be converted to numeric array: %s'
+                       % str(e))
+                raise PolygonInputError(msg)
+
+            msg = 'Polygon array must be a 2d array of vertices'
+            if len(ring.shape) != 2:
+                raise PolygonInputError(msg)
+
+            msg = 'Polygon array must have two columns'
+            if ring.shape[1] != 2:
+                raise PolygonInputError(msg)
+
+            rings[i] = ring
+
+        polygon = rings[0]
+        self.polygon = polygon
+        self.holes = rings[1:]
+        self.bbox = get_polygon_bbox(polygon)
+        if len(self.holes) > 0:
+            self.polygon_shape = 'general'
+        else:
+            self.polygon_shape = get_polygon_shape(polygon)
+
+        # Edge end points (each ring is implicitly closed)
+        edges = []
+        for ring in rings:
+            x0 = ring[:, 0]
+            y0 = ring[:, 1]
+            x1 = numpy.roll(x0, -1)
+            y1 = numpy.roll(y0, -1)
+            edges.append(numpy.array([x0, y0, x1, y1]))
+        self.edges = numpy.concatenate(edges, axis=1)
+        x0, y0, x1, y1 = self.edges
+
+        N = self.edges.shape[1]
+        if number_of_slabs is None:
+            number_of_slabs = max(1, N // 4)
+        self.number_of_slabs = number_of_slabs
+
+        miny = self.bbox[2]
+        maxy = self.bbox[3]
+        if maxy > miny:
+            self.slab_height = (maxy - miny) / number_of_slabs
+        else:
+            # Degenerate polygon, use one slab
+            self.number_of_slabs = 1
+            self.slab_height = 1.0
+
+        # Register each edge with every slab its y-extent overlaps
+        s0 = self.slab_index(numpy.minimum(y0, y1))
+        s1 = self.slab_index(numpy.maximum(y0, y1))
+        edge_ids, slabs = _expand_ranges(numpy.arange(N), s0, s1 + 1)
+
+        idx = numpy.argsort(slabs, kind='mergesort')
+        self.slab_edges = edge_ids[idx]
+        self.slab_offsets = numpy.zeros(self.number_of_slabs + 1,
+                                        dtype=numpy.int)
+        self.slab_offsets[1:] = numpy.cumsum(
+            numpy.bincount(slabs, minlength=self.number_of_slabs))
+
+    def __len__(self):
+        return self.polygon.shape[0]
+
+    def slab_index(self, y):
+        """Slab index for each y coordinate
+
+        Coordinates outside the polygon bounding box are assigned
+        to the nearest slab.
+        """
+
+        s = numpy.floor((y - self.bbox[2]) / self.slab_height)
+        s = numpy.clip(s, 0, self.number_of_slabs - 1)
+        return s.astype(numpy.int)
+
+
+def _separate_points_by_prepared_polygon(points, prepared,
+                                         closed, rtol=0.0, atol=0.0,
+                                         max_pairs=2 ** 22):
+    """Underlying algorithm to partition points according to prepared polygon
+
+    Input:
+       points - Nx2 array of point coordinates
+       prepared - PreparedPolygon instance
+       closed - (optional) determine whether points on boundary should be
+       regarded as belonging to the polygon (closed = True)
+       or not (closed = False). Close can also be None.
+       rtol, atol: Tolerances for when a point is considered to coincide with
+       a line. Default 0.0.
+       max_pairs - Maximal number of point-edge pairs to process at a time
+
+    Output:
+       indices_inside_polygon, indices_outside_polygon
+
+    Note:
+       This gives the same result as _separate_points_by_polygon as each
+       point is tested against a subset of edges containing every edge
+       that can cross it or that it can lie on.
+    """
+
+    M = points.shape[0]
+    if M == 0:
+        # If no points return two 0-vectors
+        return numpy.arange(0), numpy.arange(0)
+
+    x = points[:, 0]
+    y = points[:, 1]
+    px_i, py_i, px_j, py_j = prepared.edges
+
+    # Range of edges in slab table for each point
+    s = prepared.slab_index(y)
+    start = prepared.slab_offsets[s]
+    stop = prepared.slab_offsets[s + 1]
+
+    # Process points in chunks so that point-edge pairs stay bounded
+    cumulative = numpy.cumsum(stop - start)
+    limits = numpy.searchsorted(cumulative,
+                                numpy.arange(0, cumulative[-1], max_pairs),
+                                side='right')
+    limits = numpy.unique(numpy.concatenate(([0], limits, [M])))
+
+    inside = numpy.zeros(M, dtype=numpy.bool)
+    for k in range(len(limits) - 1):
+        lo = limits[k]
+        hi = limits[k + 1]
+        p = numpy.arange(lo, hi)
+        p, e = _expand_ranges(p, start[p], stop[p])
+        e = prepared.slab_edges[e]
+
+        xp = x[p]
+        yp = y[p]
+        xi = px_i[e]
+        yi = py_i[e]
+        xj = px_j[e]
+        yj = py_j[e]
+
+        # Edge crossing formula as in _separate_points_by_polygon
+        original_numpy_settings = numpy.seterr(invalid='ignore',
+                                               divide='ignore')
+        sigma = (yp - yi) / (yj - yi) * (xj - xi)
+        numpy.seterr(**original_numpy_settings)
+
+        crossing = ((xi + sigma < xp) *
+                    (((yi < yp) * (yj >= yp)) + ((yj < yp) * (yi >= yp))))
+
+        # Count crossings for each point and determine parity
+        count = numpy.bincount(p[crossing] - lo, minlength=hi - lo)
+        inside[lo:hi] = count % 2 == 1
+
+        if closed is not None:
+            # Find points on polygon boundary
+            on_edge = _points_on_segments(xp, yp, xi, yi, xj, yj, rtol, atol)
+            inside[p[on_edge]] = closed
+
+    indices_inside = numpy.where(inside)[0]
+    indices_outside = numpy.where(~inside)[0]
+    return indices_inside, indices_outside
+
+
+def _points_on_segments(x, y, x0, y0, x1, y1, rtol=0.0, atol=0.0):
+    """Determine elementwise if points lie on line segments
+
+    Input:
+       x, y - Arrays of point coordinates
+       x0, y0, x1, y1 - Arrays of segment end point coordinates
+       rtol, atol - Tolerances as in point_on_line
+
+    Output:
+       Boolean array which is True where point i lies on segment i
+
+    This is the elementwise equivalent of point_on_line
+    """
+
+    # Vector from beginning of line to point
+    a0 = x - x0
+    a1 = y - y0
+
+    # Vector parallel to line
+    b0 = x1 - x0
+    b1 = y1 - y0
+
+    # Determine if point vector is parallel to line up to a tolerance
+    nominator = abs(a1 * b0 - a0 * b1)
+    denominator = b0 * b0 + b1 * b1
+    is_parallel = nominator <= atol + rtol * denominator
+
+    # Determine for points parallel to line if they are within end points
+    a0 = a0[is_parallel]
+    a1 = a1[is_parallel]
+    b0 = b0[is_parallel]
+    b1 = b1[is_parallel]
+
+    len_a = numpy.sqrt(a0 * a0 + a1 * a1)
+    len_b = numpy.sqrt(denominator[is_parallel])
+    cross = a0 * b0 + a1 * b1
+
+    result = numpy.zeros(len(x), dtype=numpy.bool)
+    result[is_parallel] = (cross >= 0) * (len_a <= len_b)
+    return result
+
+
+class PolygonGrid(object):
+    """Uniform grid over a polygon with cells classified once
+
+    Each cell of a regular grid covering the polygon bounding box is
+    classified as being fully inside the polygon, fully outside it or as
+    a boundary cell touched by at least one edge. Points falling in
+    interior or exterior cells are then classified by a simple lookup and
+    only points in boundary cells need the exact point in polygon test.
+
+    The grid can be reused for any number of calls to
+    separate_points_by_polygon or in_and_outside_polygon.
+
+    Args:
+        * polygon: list or Nx2 array of polygon vertices (outer ring)
+            or PreparedPolygon instance
+        * holes: (optional) list of polygons representing holes
+        * number_of_cells: (optional) approximate total number of grid cells.
+            If None a number proportional to the number of vertices is used.
+
+    Raises:
+        PolygonInputError
+
+    Note:
+        A grid built with holes can only be used with in_and_outside_polygon
+        (and the functions built on it) as separate_points_by_polygon does
+        not know about holes.
+    """
+
+    OUTSIDE = 0
+    INSIDE = 1
+    BOUNDARY = 2
+
+    def __init__(self, polygon, holes=None, number_of_cells=None):
+
+        if holes is None:
+            holes = []
+
+        msg = ('Argument holes must be a list of polygons, '
+               'I got %s' % holes)
+        if not isinstance(holes, list):
+            raise InaSAFEError(msg)
+
+        rings = []
+        for ring in [polygon] + holes:
+            if isinstance(ring, PreparedPolygon):
+                ring = ring.polygon
+            try:
+                ring = ensure_numeric(ring, numpy.float)
+            except Exception, e:
+                msg = ('Polygon could not be converted to numeric array: %s'
+                       % str(e))
+                raise PolygonInputError(msg)
+
+            msg = 'Polygon array must be a 2d array with two columns'
+            if len(ring.shape) != 2 or ring.shape[1] != 2:
+                raise PolygonInputError(msg)
+            rings.append(ring)
+
+        self.polygon = polygon
+        self.holes = holes
+        self.bbox = get_polygon_bbox(rings[0])
+        minx, maxx, miny, maxy = self.bbox
+
+        # Choose grid dimensions with roughly square cells
+        N = sum([len(ring) for ring in rings])
+        if number_of_cells is None:
+            number_of_cells = min(max(1024, 16 * N), 2 ** 22)
+
+        width = maxx - minx
+        height = maxy - miny
+        if width > 0 and height > 0:
+            cell_size = numpy.sqrt(width * height / number_of_cells)
+            self.nx = max(1, int(numpy.ceil(width / cell_size)))
+            self.ny = max(1, int(numpy.ceil(height / cell_size)))
+        else:
+            # Degenerate polygon
+            self.nx = self.ny = 1
+
+        self.dx = width / self.nx or 1.0
+        self.dy = height / self.ny or 1.0
+
+        # Start out with every cell deemed to be outside
+        status = numpy.zeros(self.nx * self.ny, dtype=numpy.int8)
+
+        # Mark cells touched by any edge of any ring as boundary cells
+        edges = numpy.concatenate([polygon2segments(ring).reshape(4, -1)
+                                   for ring in rings], axis=1)
+        status[self._cells_touched_by_segments(*edges)] = self.BOUNDARY
+
+        # Classify remaining cells by their centres. As no edge passes
+        # through these cells, every point in them shares the status.
+        cells = numpy.where(status != self.BOUNDARY)[0]
+        rows = cells // self.nx
+        cols = cells % self.nx
+        centres = numpy.zeros((len(cells), 2))
+        centres[:, 0] = minx + (cols + 0.5) * self.dx
+        centres[:, 1] = miny + (rows + 0.5) * self.dy
+
+        if len(cells) > 0:
+            inside, _ = in_and_outside_polygon(centres, rings[0],
+                                               holes=rings[1:],
+                                               closed=True,
+                                               check_input=False)
+            status[cells[inside]] = self.INSIDE
+
+        self.status = status
+
+    def _cells_touched_by_segments(self, x0, y0, x1, y1):
+        """Find grid cells touched by line segments
+
+        Args:
+            * x0, y0, x1, y1: Arrays of segment end point coordinates
+
+        Returns:
+            * Array of flat cell indices (may contain duplicates)
+        """
+
+        minx = self.bbox[0]
+        miny = self.bbox[2]
+
+        # Range of cells covered by each segment's bounding box
+        i0 = self._cell_coordinate(numpy.minimum(x0, x1), minx, self.dx,
+                                   self.nx)
+        i1 = self._cell_coordinate(numpy.maximum(x0, x1), minx, self.dx,
+                                   self.nx)
+        j0 = self._cell_coordinate(numpy.minimum(y0, y1), miny, self.dy,
+                                   self.ny)
+        j1 = self._cell_coordinate(numpy.maximum(y0, y1), miny, self.dy,
+                                   self.ny)
+        width = i1 - i0 + 1
+        counts = width * (j1 - j0 + 1)
+
+        segments, k = _expand_ranges(numpy.arange(len(x0)),
+                                     numpy.zeros(len(x0), dtype=numpy.int),
+                                     counts)
+        cols = i0[segments] + k % width[segments]
+        rows = j0[segments] + k // width[segments]
+
+        # Cell corners, slightly enlarged to be robust against rounding
+        eps_x = 1.0e-9 * self.dx
+        eps_y = 1.0e-9 * self.dy
+        cx0 = minx + cols * self.dx - eps_x
+        cx1 = minx + (cols + 1) * self.dx + eps_x
+        cy0 = miny + rows * self.dy - eps_y
+        cy1 = miny + (rows + 1) * self.dy + eps_y
+
+        # A segment touches a cell its bounding box overlaps unless all
+        # four corners of the cell lie strictly on the same side of it
+        ax = x0[segments]
+        ay = y0[segments]
+        bx = x1[segments] - ax
+        by = y1[segments] - ay
+        d = [(cx - ax) * by - (cy - ay) * bx
+             for cx, cy in [(cx0, cy0), (cx1, cy0), (cx1, cy1), (cx0, cy1)]]
+        dmin = numpy.minimum(numpy.minimum(d[0], d[1]),
+                             numpy.minimum(d[2], d[3]))
+        dmax = numpy.maximum(numpy.maximum(d[0], d[1]),
+                             numpy.maximum(d[2], d[3]))
+        touched = (dmin <= 0) * (dmax >= 0)
+
+        return rows[touched] * self.nx + cols[touched]
+
+    @staticmethod
+    def _cell_coordinate(v, origin, delta, n):
+        """Cell index along one axis clipped to the grid
+        """
+
+        i = numpy.floor((v - origin) / delta)
+        return numpy.clip(i, 0, n - 1).astype(numpy.int)
+
+    def cell_status(self, points):
+        """Look up status of the grid cells containing points
+
+        Args:
+            * points: Nx2 array of point coordinates
+
+        Returns:
+            * Array with PolygonGrid.INSIDE, PolygonGrid.OUTSIDE or
+              PolygonGrid.BOUNDARY for each point. Points outside the
+              polygon bounding box are OUTSIDE.
+        """
+
+        x = points[:, 0]
+        y = points[:, 1]
+        minx, maxx, miny, maxy = self.bbox
+
+        cols = self._cell_coordinate(x, minx, self.dx, self.nx)
+        rows = self._cell_coordinate(y, miny, self.dy, self.ny)
+        status = self.status[rows * self.nx + cols]
+
+        outside_box = (x > maxx) + (x < minx) + (y > maxy) + (y < miny)
+        status[outside_box] = self.OUTSIDE
+        return status
+
+
+def _separate_points_by_grid(points, grid, separate_boundary_points):
+    """Partition points using classified grid cells
+
+    Input:
+       points - Nx2 array of point coordinates
+       grid - PolygonGrid instance
+       separate_boundary_points - function taking an array of points and
+       returning indices of points inside and outside. It is only called
+       for points in boundary cells.
+
+    Output:
+       indices_inside_polygon, indices_outside_polygon
+    """
+
+    status = grid.cell_status(points)
+    inside = status == grid.INSIDE
+
+    boundary = numpy.where(status == grid.BOUNDARY)[0]
+    if len(boundary) > 0:
+        boundary_inside, _ = separate_boundary_points(points[boundary])
+        inside[boundary[boundary_inside]] = True
+
+    return numpy.where(inside)[0], numpy.where(~inside)[0]
+
+
 def point_on_line(points, line, rtol=1.0e-5, atol=1.0e-8,
                   check_input=True):
     """Determine if a point is on a line segment
@@ -474,7 +1162,8 @@ def in_and_outside_polygon(
         points, polygon,
         closed=True,
         holes=None,
-        check_input=True):
+        check_input=True,
+        grid=None):
     """Separate a list of points into two sets inside and outside a polygon
 
     :param points: (tuple, list or array) of coordinates
@@ -485,10 +1174,15 @@ def in_and_outside_polygon(
       to be 'inside' polygon
 
     :param holes: list of polygons representing holes. Points inside either of
-      these are considered outside polygon
+      these are considered outside polygon. Holes must lie inside the
+      polygon and must not overlap each other.
 
     :param check_input: Allows faster execution if set to False
 
+    :param grid: Optional PolygonGrid built for this polygon and its holes.
+      If given, only points in grid cells crossed by a ring are subjected
+      to the exact test.
+
     Output:
       inside: Indices of points inside the polygon
 
@@ -497,10 +1191,18 @@ def in_and_outside_polygon(
     See separate_points_by_polygon for more documentation
     """
 
-    # Get separation by outer_ring
-    inside, outside = separate_points_by_polygon(points, polygon,
-                                                 closed=closed,
-                                                 check_input=check_input)
+    if grid is not None:
+        points = ensure_numeric(points, numpy.float)
+        if len(points.shape) == 1:
+            # Only one point was passed in. Convert to array of points.
+            points = numpy.reshape(points, (-1, 2))
+
+        return _separate_points_by_grid(
+            points, grid,
+            lambda P: in_and_outside_polygon(P, polygon,
+                                             closed=closed,
+                                             holes=holes,
+                                             check_input=check_input))
 
     # Take care of holes
     if holes is not None:
@@ -509,19 +1211,17 @@ def in_and_outside_polygon(
         if not isinstance(holes, list):
             raise InaSAFEError(msg)
 
-        for hole in holes:
-            in_hole, out_hole = separate_points_by_polygon(points[inside],
-                                                           hole,
-                                                           closed=not closed,
-                                                           check_input=True)
-
-            in_hole = inside[in_hole]  # Inside hole
-            inside = inside[out_hole]  # Inside outer_ring but outside hole
-
-            # Add holde indices to outside
-            outside = numpy.concatenate((outside, in_hole))
+        if len(holes) > 0:
+            # Classify by outer ring and holes in one pass over their edges.
+            # Points on the boundary of a hole are on the boundary of the
+            # polygon so closed applies to them as well.
+            if isinstance(polygon, PreparedPolygon):
+                polygon = polygon.polygon
+            polygon = PreparedPolygon(polygon, holes=holes)
 
-    return inside, outside
+    return separate_points_by_polygon(points, polygon,
+                                      closed=closed,
+                                      check_input=check_input)
 
 
 def is_inside_polygon(point, polygon, closed=True):
@@ -538,68 +1238,569 @@ def is_inside_polygon(point, polygon, closed=True):
         return False
 
 
-def inside_polygon(points, polygon, closed=True, holes=None,
-                   check_input=True):
-    """Determine points inside a polygon
+def inside_polygon(points, polygon, closed=True, holes=None,
+                   check_input=True):
+    """Determine points inside a polygon
+
+       Functions inside_polygon and outside_polygon have been defined in
+       terms of separate_by_polygon which will put all inside indices in
+       the first part of the indices array and outside indices in the last
+
+       See separate_points_by_polygon for documentation
+
+       points and polygon can be a geospatial instance,
+       a list or a numeric array
+
+       holes: list of polygons representing holes. Points inside either of
+       these are not considered inside_polygon
+    """
+
+    indices, _ = in_and_outside_polygon(points, polygon,
+                                        closed=closed,
+                                        holes=holes,
+                                        check_input=check_input)
+
+    # Return indices of points inside polygon
+    return indices
+
+
+# FIXME (Ole): This also needs to fixed as per issue #324
+def is_outside_polygon(point, polygon, closed=True):
+    """Determine if one point is outside a polygon
+
+    See outside_polygon for more details
+    """
+
+    indices = outside_polygon(point, polygon, closed=closed)
+
+    if indices.shape[0] == 1:
+        return True
+    else:
+        return False
+
+
+def outside_polygon(points, polygon, closed=True,
+                    holes=None, check_input=True):
+    """Determine points outside a polygon
+
+       Functions inside_polygon and outside_polygon have been defined in
+       terms of separate_by_polygon which will put all inside indices in
+       the first part of the indices array and outside indices in the last
+
+       See separate_points_by_polygon for documentation
+
+       holes: list of polygons representing holes. Points inside either of
+              these are considered outside polygon
+    """
+
+    _, indices = in_and_outside_polygon(points, polygon,
+                                        closed=closed,
+                                        holes=holes,
+                                        check_input=check_input)
+
+    # Return indices of points outside polygon
+    return indices
+
+
+#---------------------------------------------------
+# Spatial index for classifying points by many polygons
+#---------------------------------------------------
+class PackedRTree(object):
+    """Static R-tree over bounding boxes, packed into flat numpy arrays.
+
+    The tree is bulk loaded using Sort-Tile-Recursive (STR) packing and
+    can not be modified after construction. Queries are vectorised and
+    traverse the tree one level at a time for all query points at once.
+
+    Args:
+        * bboxes: Nx4 array of bounding boxes following the same format as
+            polygon_bbox elsewhere in this module, i.e. each row is
+            [minx, maxx, miny, maxy]
+        * node_capacity: (optional) maximal number of children per node
+
+    Note:
+        Bounding boxes are treated as closed, i.e. points on the boundary
+        of a box are considered to be inside it.
+
+    Example:
+
+        bboxes = [get_polygon_bbox(p) for p in polygons]
+        tree = PackedRTree(bboxes)
+        point_indices, box_indices = tree.query_points(points)
+    """
+
+    def __init__(self, bboxes, node_capacity=16):
+
+        bboxes = ensure_numeric(bboxes, numpy.float)
+        if len(bboxes.shape) == 1 and bboxes.shape[0] == 0:
+            bboxes = bboxes.reshape((0, 4))
+
+        msg = ('Bounding boxes must be an Nx4 array with rows '
+               '[minx, maxx, miny, maxy]. I got shape %s'
+               % str(bboxes.shape))
+        if len(bboxes.shape) != 2 or bboxes.shape[1] != 4:
+            raise InaSAFEError(msg)
+
+        msg = 'Node capacity must be at least 2. I got %s' % node_capacity
+        if node_capacity < 2:
+            raise InaSAFEError(msg)
+
+        self.node_capacity = node_capacity
+        self.size = bboxes.shape[0]
+
+        # Leaf entries are the input boxes ordered spatially
+        self.order = _str_order(bboxes, node_capacity)
+        self.boxes = bboxes[self.order]
+
+        # Build internal levels bottom up. Each level is stored as
+        # (boxes, child_start, child_stop) where children refer to
+        # entries in the level below (or the leaf entries).
+        self.levels = []
+        level_boxes = self.boxes
+        while level_boxes.shape[0] > 1 or len(self.levels) == 0:
+            n = level_boxes.shape[0]
+            if n == 0:
+                break
+
+            start = numpy.arange(0, n, node_capacity)
+            stop = numpy.minimum(start + node_capacity, n)
+            node_boxes = numpy.zeros((len(start), 4))
+            node_boxes[:, 0] = numpy.minimum.reduceat(level_boxes[:, 0], start)
+            node_boxes[:, 1] = numpy.maximum.reduceat(level_boxes[:, 1], start)
+            node_boxes[:, 2] = numpy.minimum.reduceat(level_boxes[:, 2], start)
+            node_boxes[:, 3] = numpy.maximum.reduceat(level_boxes[:, 3], start)
+
+            # Pack nodes spatially before they are grouped at the next level
+            idx = _str_order(node_boxes, node_capacity)
+            self.levels.append((node_boxes[idx], start[idx], stop[idx]))
+            level_boxes = node_boxes[idx]
+
+        # Store levels from the root down
+        self.levels.reverse()
+
+    def __len__(self):
+        return self.size
+
+    def query_points(self, points, chunk_size=65536):
+        """Find all boxes containing each point
+
+        Args:
+            * points: Nx2 array of point coordinates
+            * chunk_size: (optional) number of points to traverse the tree
+                with at a time. This bounds the memory used for candidates.
+
+        Returns:
+            * point_indices: Indices of points
+            * box_indices: Indices of the boxes containing them
+
+            The two arrays are of equal length, one entry per
+            (point, box) pair, and are sorted by box index first and
+            point index second. Indices refer to the original order
+            of points and boxes.
+        """
+
+        points = ensure_numeric(points, numpy.float)
+        M = points.shape[0]
+        if M == 0 or self.size == 0:
+            return (numpy.zeros(0, dtype=numpy.int),
+                    numpy.zeros(0, dtype=numpy.int))
+
+        point_indices = []
+        box_indices = []
+        for offset in range(0, M, chunk_size):
+            x = points[offset:offset + chunk_size, 0]
+            y = points[offset:offset + chunk_size, 1]
+
+            # Start with every point paired with the root node
+            p = numpy.arange(len(x))
+            n = numpy.zeros(len(x), dtype=numpy.int)
+
+            for node_boxes, start, stop in self.levels:
+                # Keep pairs where the point falls in the node box
+                boxes = node_boxes[n]
+                mask = ((boxes[:, 0] <= x[p]) * (x[p] <= boxes[:, 1]) *
+                        (boxes[:, 2] <= y[p]) * (y[p] <= boxes[:, 3]))
+                p = p[mask]
+                n = n[mask]
+
+                # Expand to all children of the remaining nodes
+                p, n = _expand_ranges(p, start[n], stop[n])
+
+            # Finally test against the leaf entries themselves
+            boxes = self.boxes[n]
+            mask = ((boxes[:, 0] <= x[p]) * (x[p] <= boxes[:, 1]) *
+                    (boxes[:, 2] <= y[p]) * (y[p] <= boxes[:, 3]))
+
+            point_indices.append(p[mask] + offset)
+            box_indices.append(self.order[n[mask]])
+
+        point_indices = numpy.concatenate(point_indices)
+        box_indices = numpy.concatenate(box_indices)
+
+        # Sort by box index then point index
+        idx = numpy.lexsort((point_indices, box_indices))
+        return point_indices[idx], box_indices[idx]
+
+    def query_bbox(self, bbox):
+        """Find all boxes intersecting a given bounding box
+
+        Args:
+            * bbox: Bounding box [minx, maxx, miny, maxy]
+
+        Returns:
+            * Sorted array of indices of boxes that intersect bbox
+        """
+
+        minx, maxx, miny, maxy = bbox
+        if self.size == 0:
+            return numpy.zeros(0, dtype=numpy.int)
+
+        n = numpy.zeros(1, dtype=numpy.int)
+        for node_boxes, start, stop in self.levels:
+            boxes = node_boxes[n]
+            mask = ((boxes[:, 0] <= maxx) * (minx <= boxes[:, 1]) *
+                    (boxes[:, 2] <= maxy) * (miny <= boxes[:, 3]))
+            n = n[mask]
+            _, n = _expand_ranges(n, start[n], stop[n])
+
+        boxes = self.boxes[n]
+        mask = ((boxes[:, 0] <= maxx) * (minx <= boxes[:, 1]) *
+                (boxes[:, 2] <= maxy) * (miny <= boxes[:, 3]))
+
+        indices = self.order[n[mask]]
+        indices.sort()
+        return indices
+
+
+def _str_order(bboxes, node_capacity):
+    """Order bounding boxes by Sort-Tile-Recursive packing
+
+    Boxes are sorted by the x coordinate of their centres, cut into
+    vertical slices and sorted by y within each slice so that runs of
+    node_capacity consecutive boxes are spatially compact.
+
+    Args:
+        * bboxes: Nx4 array of bounding boxes [minx, maxx, miny, maxy]
+        * node_capacity: Number of boxes grouped per node
+
+    Returns:
+        * Permutation array ordering the boxes
+    """
+
+    N = bboxes.shape[0]
+    if N == 0:
+        return numpy.zeros(0, dtype=numpy.int)
+
+    cx = (bboxes[:, 0] + bboxes[:, 1]) / 2
+    cy = (bboxes[:, 2] + bboxes[:, 3]) / 2
+
+    number_of_nodes = int(numpy.ceil(float(N) / node_capacity))
+    number_of_slices = int(numpy.ceil(numpy.sqrt(number_of_nodes)))
+    slice_size = number_of_slices * node_capacity
+
+    order = numpy.argsort(cx, kind='mergesort')
+    slice_id = numpy.arange(N) // slice_size
+    return order[numpy.lexsort((cy[order], slice_id))]
+
+
+def _expand_ranges(keys, start, stop):
+    """Pair each key with every integer in its range [start, stop)
+
+    Args:
+        * keys: Array of keys, e.g. point indices
+        * start, stop: Arrays with range for each key
+
+    Returns:
+        * keys: Array of keys repeated once for every element in its range
+        * values: Array with the corresponding elements of the ranges
+    """
+
+    counts = stop - start
+    total = numpy.sum(counts)
+    offsets = numpy.cumsum(counts) - counts
+
+    values = (numpy.arange(total) -
+              numpy.repeat(offsets - start, counts))
+    return numpy.repeat(keys, counts), values
+
+
+def get_polygon_bbox(polygon):
+    """Bounding box of polygon as used throughout this module
+
+    Args:
+        * polygon: Nx2 array of polygon vertices or PreparedPolygon
+
+    Returns:
+        * [minx, maxx, miny, maxy]
+    """
+
+    if isinstance(polygon, PreparedPolygon):
+        return polygon.bbox
+
+    polygon = ensure_numeric(polygon, numpy.float)
+    return [numpy.min(polygon[:, 0]), numpy.max(polygon[:, 0]),
+            numpy.min(polygon[:, 1]), numpy.max(polygon[:, 1])]
+
+
+def get_polygon_shape(polygon):
+    """Determine whether polygon is a rectangle, convex or neither
+
+    Args:
+        * polygon: Nx2 array of polygon vertices or PreparedPolygon
+
+    Returns:
+        * 'rectangle' if polygon is an axis-aligned rectangle,
+          'convex' if it is convex and 'general' otherwise
+
+    Note:
+        Repeated vertices and collinear vertices are allowed.
+        Polygons that are degenerate or wind around more than once are
+        'general'.
+    """
+
+    if isinstance(polygon, PreparedPolygon):
+        return polygon.polygon_shape
+
+    polygon = ensure_numeric(polygon, numpy.float)
+
+    # Edge vectors leaving out repeated vertices
+    edges = numpy.roll(polygon, -1, axis=0) - polygon
+    edges = edges[numpy.any(edges != 0, axis=1)]
+    if len(edges) < 3:
+        return 'general'
+
+    # Turn from each edge to the next
+    following = numpy.roll(edges, -1, axis=0)
+    cross = edges[:, 0] * following[:, 1] - edges[:, 1] * following[:, 0]
+    dot = edges[:, 0] * following[:, 0] + edges[:, 1] * following[:, 1]
+
+    # All turns must be in the same direction without reversals
+    if not (numpy.all(cross >= 0) or numpy.all(cross <= 0)):
+        return 'general'
+
+    if numpy.any((cross == 0) * (dot < 0)):
+        return 'general'
+
+    # and add up to exactly one revolution
+    turning = numpy.sum(numpy.arctan2(numpy.abs(cross), dot))
+    if not numpy.allclose(turning, 2 * numpy.pi):
+        return 'general'
+
+    if numpy.all((edges[:, 0] == 0) + (edges[:, 1] == 0)):
+        return 'rectangle'
+    else:
+        return 'convex'
+
+
+def _polygon_rings(polygon):
+    """Get outer ring and inner rings of polygon
+
+    Args:
+        * polygon: Polygon geometry object or Nx2 array of vertices
+
+    Returns:
+        * outer_ring: Nx2 array of vertices
+        * inner_rings: List of Nx2 arrays or None
+    """
+
+    if hasattr(polygon, 'outer_ring'):
+        return polygon.outer_ring, polygon.inner_rings
+    else:
+        # Assume it is an array
+        return polygon, None
+
+
+def inside_polygons(points, polygons, closed=True, rtree=None,
+                    check_input=True):
+    """Determine points inside each of multiple polygons
+
+    Args:
+        * points: Nx2 array (or list) of point coordinates
+        * polygons: list of polygon geometry objects, list of polygon arrays
+            or packed polygons (safe.storage.geometry.PackedGeometry)
+        * closed: (optional) determine whether points on boundary should be
+            regarded as belonging to the polygon (closed = True)
+            or not (closed = False).
+        * rtree: (optional) PackedRTree over the polygon bounding boxes.
+            If None, one will be built here.
+        * check_input: Allows faster execution if set to False
+
+    Returns:
+        * List of index arrays - one per input polygon - each with the
+          indices of points falling inside that polygon.
+
+    Note:
+        Points are only tested against polygons whose bounding box contains
+        them. This makes the cost roughly proportional to the number of
+        points rather than (number of polygons x number of points).
+
+        Polygons may overlap in which case points are reported in all of
+        the polygons they fall inside.
+    """
+
+    points, rings, candidates = _candidates_by_polygon(points, polygons,
+                                                       closed, rtree,
+                                                       check_input)
+
+    result = []
+    for i, (outer_ring, inner_rings) in enumerate(rings):
+        if len(candidates[i]) == 0:
+            result.append(candidates[i])
+            continue
+
+        inside = _inside_rings(points[candidates[i]], outer_ring,
+                               inner_rings, closed)
+        result.append(candidates[i][inside])
+
+    return result
+
+
+def label_points_by_polygons(points, polygons, closed=True, rtree=None,
+                             check_input=True):
+    """Label each point with the first polygon it falls inside
+
+    Args:
+        * points: Nx2 array (or list) of point coordinates
+        * polygons: list of polygon geometry objects, list of polygon arrays
+            or packed polygons (safe.storage.geometry.PackedGeometry)
+        * closed: (optional) determine whether points on boundary should be
+            regarded as belonging to the polygon (closed = True)
+            or not (closed = False).
+        * rtree: (optional) PackedRTree over the polygon bounding boxes.
+            If None, one will be built here.
+        * check_input: Allows faster execution if set to False
+
+    Returns:
+        * labels: int32 array with one entry per point holding the index
+          of the polygon it falls inside or -1 if it is not in any polygon.
+
+    Note:
+        If multiple polygons overlap, the one first encountered will be used.
+        Points inside holes are not considered inside the polygon.
+
+        The label array lends itself to reductions by polygon with
+        numpy.bincount, e.g. the number of points in each polygon is
+
+        numpy.bincount(labels[labels >= 0], minlength=len(polygons))
+    """
+
+    points, rings, candidates = _candidates_by_polygon(points, polygons,
+                                                       closed, rtree,
+                                                       check_input)
+
+    labels = numpy.zeros(points.shape[0], dtype=numpy.int32) - 1
+    for i, (outer_ring, inner_rings) in enumerate(rings):
+        # Only consider points not already claimed by an earlier polygon
+        idx = candidates[i][labels[candidates[i]] < 0]
+        if len(idx) == 0:
+            continue
 
-       Functions inside_polygon and outside_polygon have been defined in
-       terms of separate_by_polygon which will put all inside indices in
-       the first part of the indices array and outside indices in the last
+        inside = _inside_rings(points[idx], outer_ring, inner_rings, closed)
+        labels[idx[inside]] = i
 
-       See separate_points_by_polygon for documentation
+    return labels
 
-       points and polygon can be a geospatial instance,
-       a list or a numeric array
 
-       holes: list of polygons representing holes. Points inside either of
-       these are not considered inside_polygon
+def _inside_rings(points, outer_ring, inner_rings, closed):
+    """Indices of points inside polygon given by its rings
+
+    A PolygonGrid is built for the polygon when there are enough points
+    for it to pay off.
     """
 
-    indices, _ = in_and_outside_polygon(points, polygon,
-                                        closed=closed,
-                                        holes=holes,
-                                        check_input=check_input)
+    if inner_rings is None:
+        number_of_vertices = len(outer_ring)
+    else:
+        number_of_vertices = len(outer_ring) + sum([len(ring)
+                                                    for ring in inner_rings])
 
-    # Return indices of points inside polygon
-    return indices
+    grid = None
+    if len(points) >= max(POLYGON_GRID_THRESHOLD, 64 * number_of_vertices):
+        grid = PolygonGrid(outer_ring, holes=inner_rings)
 
+    inside, _ = in_and_outside_polygon(points, outer_ring,
+                                       holes=inner_rings,
+                                       closed=closed,
+                                       check_input=False,
+                                       grid=grid)
+    return inside
 
-# FIXME (Ole): This also needs to fixed as per issue #324
-def is_outside_polygon(point, polygon, closed=True):
-    """Determine if one point is outside a polygon
 
-    See outside_polygon for more details
+def _candidates_by_polygon(points, polygons, closed, rtree, check_input):
+    """Find candidate points for each polygon from their bounding boxes
+
+    Underlying function for inside_polygons and label_points_by_polygons
+    - see those for details
+
+    Returns:
+        * points: Nx2 array of points
+        * rings: List of (outer_ring, inner_rings) - one per polygon
+        * candidates: List of sorted index arrays - one per polygon - with
+          points that fall inside the bounding box of that polygon
     """
 
-    indices = outside_polygon(point, polygon, closed=closed)
+    if check_input:
+        msg = 'Keyword argument "closed" must be boolean or None'
+        if not (isinstance(closed, bool) or closed is None):
+            raise PolygonInputError(msg)
 
-    if indices.shape[0] == 1:
-        return True
-    else:
-        return False
+        try:
+            points = ensure_numeric(points, numpy.float)
+        except Exception, e:
+            msg = ('Points could not be converted to numeric array: %s'
+                   % str(e))
+            raise PolygonInputError(msg)
 
+        if len(points.shape) == 1:
+            # Only one point was passed in. Convert to array of points.
+            try:
+                points = numpy.reshape(points, (-1, 2))
+            except ValueError, e:
+                raise PointsInputError(e.message)
 
-def outside_polygon(points, polygon, closed=True,
-                    holes=None, check_input=True):
-    """Determine points outside a polygon
+        msg = ('Points array must be a 2d array with two columns (x,y), '
+               'I got shape %s' % str(points.shape))
+        if len(points.shape) != 2 or points.shape[1] != 2:
+            raise PolygonInputError(msg)
 
-       Functions inside_polygon and outside_polygon have been defined in
-       terms of separate_by_polygon which will put all inside indices in
-       the first part of the indices array and outside indices in the last
+    rings = []
+    for polygon in polygons:
+        outer_ring, inner_rings = _polygon_rings(polygon)
+        if check_input and not isinstance(outer_ring, PreparedPolygon):
+            try:
+                outer_ring = ensure_numeric(outer_ring, numpy.float)
+            except Exception, e:
+                msg = ('Polygon could not be converted to numeric array: %s'
+                       % str(e))
+                raise PolygonInputError(msg)
 
-       See separate_points_by_polygon for documentation
+            msg = 'Polygon array must be a 2d array with two columns'
+            if len(outer_ring.shape) != 2 or outer_ring.shape[1] != 2:
+                raise PolygonInputError(msg)
 
-       holes: list of polygons representing holes. Points inside either of
-              these are considered outside polygon
-    """
+        rings.append((outer_ring, inner_rings))
 
-    _, indices = in_and_outside_polygon(points, polygon,
-                                        closed=closed,
-                                        holes=holes,
-                                        check_input=check_input)
+    if rtree is None:
+        if hasattr(polygons, 'get_bboxes'):
+            # Packed polygons (see safe.storage.geometry.PackedGeometry)
+            bboxes = polygons.get_bboxes()
+        else:
+            bboxes = [get_polygon_bbox(outer_ring) for outer_ring, _ in rings]
+        rtree = PackedRTree(bboxes)
 
-    # Return indices of points outside polygon
-    return indices
+    msg = ('Spatial index has %i entries but %i polygons were given'
+           % (len(rtree), len(rings)))
+    if len(rtree) != len(rings):
+        raise InaSAFEError(msg)
+
+    # Candidate (point, polygon) pairs from bounding boxes, grouped by polygon
+    candidate_points, candidate_polygons = rtree.query_points(points)
+    limits = numpy.searchsorted(candidate_polygons,
+                                numpy.arange(len(rings) + 1))
+    candidates = [candidate_points[limits[i]:limits[i + 1]]
+                  for i in range(len(rings))]
+
+    return points, rings, candidates
 
 
 def clip_lines_by_polygon(lines, polygon,
@@ -694,11 +1895,23 @@ def _clip_lines_by_polygon(lines,
                            polygon,
                            polygon_segments,
                            polygon_bbox,
-                           closed=True):
+                           closed=True,
+                           max_pairs=2 ** 22):
     """Clip multiple lines by polygon
 
     Underlying function.
     - see clip_lines_by_polygon for details
+
+    All segments of all lines are processed together:
+
+    1: Find all intersection points between line segments and polygon edges
+       (see intersect_segments)
+    2: Sort intersection points along each segment and cut segments into
+       sub-segments at the intersections
+    3: Determine whether each sub-segment is inside or outside the polygon
+       from its midpoint (in one call for all sub-segments)
+    4: Join adjacent sub-segments from each line into polylines that are
+       either fully inside or outside polygon
     """
 
     # Get bounding box
@@ -710,33 +1923,278 @@ def _clip_lines_by_polygon(lines,
     inside_line_segments = {}
     outside_line_segments = {}
 
-    # Loop through lines
     M = len(lines)
-    for k in range(M):
-        line = lines[k]
+    if M == 0:
+        return inside_line_segments, outside_line_segments
+
+    # Flatten all lines into one array of vertices
+    lengths = numpy.array([len(line) for line in lines])
+    offsets = numpy.cumsum(lengths) - lengths
+    vertices = numpy.concatenate([numpy.reshape(line, (-1, 2))
+                                  for line in lines])
+
+    # Exclude lines that are fully outside polygon bounding box
+    nonempty = lengths > 0
+    line_outside = numpy.zeros(M, dtype=numpy.bool)
+    x = vertices[:, 0]
+    y = vertices[:, 1]
+    starts = offsets[nonempty]
+    line_outside[nonempty] = ((numpy.maximum.reduceat(x, starts) < minpx) +
+                              (numpy.minimum.reduceat(x, starts) > maxpx) +
+                              (numpy.maximum.reduceat(y, starts) < minpy) +
+                              (numpy.minimum.reduceat(y, starts) > maxpy))
+
+    for k in numpy.where(line_outside)[0]:
+        inside_line_segments[int(k)] = []
+        outside_line_segments[int(k)] = [lines[k]]
+
+    # Segments of remaining lines (one fewer than vertices for each line)
+    candidates = numpy.where(~line_outside * (lengths > 1))[0]
+    segment_line, i0 = _expand_ranges(candidates,
+                                      offsets[candidates],
+                                      offsets[candidates] +
+                                      lengths[candidates] - 1)
+    p0 = vertices[i0]
+    p1 = vertices[i0 + 1]
+
+    # Skip segments that are outside polygon bounding box
+    outside_bbox = (((p0[:, 0] < minpx) * (p1[:, 0] < minpx)) +
+                    ((p0[:, 0] > maxpx) * (p1[:, 0] > maxpx)) +
+                    ((p0[:, 1] < minpy) * (p1[:, 1] < minpy)) +
+                    ((p0[:, 1] > maxpy) * (p1[:, 1] > maxpy)))
+
+    # Degenerate segments at a corner of the bounding box only touch it
+    outside_bbox += (numpy.all(p0 == p1, axis=1) *
+                     ((p0[:, 0] == minpx) + (p0[:, 0] == maxpx)) *
+                     ((p0[:, 1] == minpy) + (p0[:, 1] == maxpy)))
+
+    # Cut segments into sub-segments that are inside or outside polygon
+    if closed is not False and get_polygon_shape(polygon) == 'rectangle':
+        starts, ends, sub_segment, is_inside = _cut_segments_by_rectangle(
+            p0, p1, outside_bbox, polygon_bbox)
+    else:
+        starts, ends, sub_segment, is_inside = _cut_segments_by_polygon(
+            p0, p1, outside_bbox, polygon, polygon_segments, polygon_bbox,
+            closed, max_pairs)
+    sub_segment_line = segment_line[sub_segment]
+
+    # Rejoin adjacent sub-segments and add to result lines
+    for k in candidates:
+        inside_line_segments[int(k)] = []
+        outside_line_segments[int(k)] = []
+
+    for mask, result in [(is_inside, inside_line_segments),
+                         (~is_inside, outside_line_segments)]:
+        joined_lines, joined_line_ids = _join_segment_arrays(
+            starts[mask], ends[mask], sub_segment_line[mask])
+        for k, line in zip(joined_line_ids, joined_lines):
+            result[int(k)].append(line)
+
+    # Lines with only one vertex have no segments
+    for k in numpy.where(~line_outside * (lengths <= 1))[0]:
+        inside_line_segments[int(k)] = []
+        outside_line_segments[int(k)] = []
 
-        # Exclude lines that are fully outside polygon bounding box
-        if (max(line[:, 0]) < minpx or  # Everything is to the west
-            min(line[:, 0]) > maxpx or  # Everything is to the east
-            max(line[:, 1]) < minpy or  # Everything is to the south
-            min(line[:, 1]) > maxpy):   # Everything is to the north
+    return inside_line_segments, outside_line_segments
 
-            inside_line_segments[k] = []
-            outside_line_segments[k] = [line]
-            continue
 
-        # Call underlying function for one line and one polygon
-        inside, outside = _clip_line_by_polygon(line,
-                                                polygon,
-                                                polygon_segments,
-                                                polygon_bbox,
-                                                closed=closed)
+def _cut_segments_by_polygon(p0, p1, outside_bbox, polygon,
+                             polygon_segments, polygon_bbox, closed,
+                             max_pairs):
+    """Cut line segments where they cross polygon edges
 
-        # Record clipped line segments from line k
-        inside_line_segments[k] = inside
-        outside_line_segments[k] = outside
+    Input:
+        p0, p1: Mx2 arrays of segment end points
+        outside_bbox: Boolean array which is True for segments entirely to
+            one side of the polygon bounding box
+        polygon, polygon_segments, polygon_bbox, closed, max_pairs: See
+            _clip_lines_by_polygon
 
-    return inside_line_segments, outside_line_segments
+    Output:
+        starts, ends: Kx2 arrays of sub-segment end points ordered along
+            each segment
+        sub_segment: Index of segment for each sub-segment
+        is_inside: Boolean array which is True for sub-segments inside
+            polygon
+    """
+
+    # Find intersections between remaining segments and polygon edges
+    ids = numpy.where(~outside_bbox)[0]
+    segments = numpy.concatenate((p0[ids], p1[ids]), axis=1)
+    edges = numpy.transpose(polygon_segments, (2, 0, 1))
+    segment_ids, _, intersections = intersect_segments(segments, edges,
+                                                       max_pairs=max_pairs)
+    segment_ids = ids[segment_ids]
+
+    # Cut points for each segment are its end points and intersections
+    S = len(p0)
+    cut_segment = numpy.concatenate((numpy.arange(S), numpy.arange(S),
+                                     segment_ids))
+    cut_points = numpy.concatenate((p0, p1, intersections))
+
+    # Sort cut points by distance from first end point of their segment
+    V = cut_points - p0[cut_segment]
+    distances = (V * V).sum(axis=1)
+    idx = numpy.lexsort((distances, cut_segment))
+    cut_segment = cut_segment[idx]
+    cut_points = cut_points[idx]
+    distances = distances[idx]
+
+    # Remove duplicate points
+    duplicates = numpy.zeros(len(distances), dtype=numpy.bool)
+    duplicates[1:] = ((distances[1:] == distances[:-1]) *
+                      (cut_segment[1:] == cut_segment[:-1]))
+
+    # Degenerate segments outside bounding box are kept as they are
+    degenerate = outside_bbox * numpy.all(p0 == p1, axis=1)
+    duplicates[1:] *= ~degenerate[cut_segment[1:]]
+    cut_segment = cut_segment[~duplicates]
+    cut_points = cut_points[~duplicates]
+
+    # Form sub-segments between consecutive cut points on the same segment
+    same = numpy.where(cut_segment[1:] == cut_segment[:-1])[0]
+    starts = cut_points[same]
+    ends = cut_points[same + 1]
+    sub_segment = cut_segment[same]
+
+    # Separate sub-segment midpoints according to polygon
+    # Deliberately ignore boundary as midpoints by definition
+    # are fully inside or fully outside.
+    # Segments outside the bounding box are outside polygon without
+    # looking at midpoints. This matters for degenerate segments at a
+    # polygon vertex which would otherwise be on the boundary.
+    candidates = numpy.where(~outside_bbox[sub_segment])[0]
+    midpoints = (starts[candidates] + ends[candidates]) / 2
+    inside, _ = separate_points_by_polygon(midpoints,
+                                           polygon,
+                                           polygon_bbox,
+                                           check_input=False,
+                                           closed=closed)
+    is_inside = numpy.zeros(len(starts), dtype=numpy.bool)
+    is_inside[candidates[inside]] = True
+
+    return starts, ends, sub_segment, is_inside
+
+
+def _cut_segments_by_rectangle(p0, p1, outside_bbox, polygon_bbox):
+    """Cut line segments where they cross an axis-aligned rectangle
+
+    Input:
+        p0, p1: Mx2 arrays of segment end points
+        outside_bbox: Boolean array which is True for segments entirely to
+            one side of the rectangle
+        polygon_bbox: The rectangle given as its bounding box
+
+    Output:
+        Same as _cut_segments_by_polygon with points on the boundary
+        regarded as inside.
+
+    Note:
+        This is the Liang-Barsky algorithm. Each segment is parameterised
+        as p0 + t * (p1 - p0) and the range of t inside the rectangle is
+        found from the range inside each pair of parallel edges.
+    """
+
+    minpx, maxpx, minpy, maxpy = polygon_bbox
+
+    S = len(p0)
+    d = p1 - p0
+    t0 = numpy.zeros(S)
+    t1 = numpy.ones(S)
+
+    for k, lower, upper in [(0, minpx, maxpx), (1, minpy, maxpy)]:
+        moving = d[:, k] != 0
+
+        # Parameters where segment crosses the two edges
+        ta = (lower - p0[moving, k]) / d[moving, k]
+        tb = (upper - p0[moving, k]) / d[moving, k]
+        t0[moving] = numpy.maximum(t0[moving], numpy.minimum(ta, tb))
+        t1[moving] = numpy.minimum(t1[moving], numpy.maximum(ta, tb))
+
+        # Segments parallel to edges are either between them or not
+        outside = ~moving * ((p0[:, k] < lower) + (p0[:, k] > upper))
+        t0[outside] = 1
+        t1[outside] = 0
+
+    # Points where segments enter and leave the rectangle
+    entry_points = p0 + t0[:, numpy.newaxis] * d
+    exit_points = numpy.where((t1 == 1)[:, numpy.newaxis], p1,
+                              p0 + t1[:, numpy.newaxis] * d)
+
+    # Segments passing through a corner have t0 == t1 up to rounding.
+    # They touch the rectangle rather than cross it.
+    degenerate = numpy.all(d == 0, axis=1)
+    through_corner = abs(t1 - t0) <= 1.0e-12
+    exit_points[through_corner] = entry_points[through_corner]
+    crossing = (t0 < t1) * ~through_corner * ~degenerate
+    touching = through_corner * (0 < t0) * (t0 < 1) * ~degenerate
+    missing = ~crossing * ~touching * (~degenerate + outside_bbox)
+
+    # Sub-segments before, inside and after the rectangle.
+    # Segments touching it are cut at the point of contact.
+    before = numpy.where(crossing * (t0 > 0) + touching)[0]
+    inside = numpy.where(crossing)[0]
+    after = numpy.where(crossing * (t1 < 1) + touching)[0]
+    outside = numpy.where(missing)[0]
+
+    starts = numpy.concatenate((p0[before], entry_points[inside],
+                                exit_points[after], p0[outside]))
+    ends = numpy.concatenate((entry_points[before], exit_points[inside],
+                              p1[after], p1[outside]))
+    sub_segment = numpy.concatenate((before, inside, after, outside))
+    is_inside = numpy.zeros(len(sub_segment), dtype=numpy.bool)
+    is_inside[len(before):len(before) + len(inside)] = True
+
+    # Order sub-segments along segments
+    position = numpy.concatenate((numpy.zeros(len(before)),
+                                  numpy.ones(len(inside)),
+                                  numpy.ones(len(after)) * 2,
+                                  numpy.zeros(len(outside))))
+    idx = numpy.lexsort((position, sub_segment))
+
+    return starts[idx], ends[idx], sub_segment[idx], is_inside[idx]
+
+
+def _join_segment_arrays(starts, ends, line_ids, rtol=1.0e-12, atol=1.0e-12):
+    """Join adjacent line segments given as arrays
+
+    Input
+        starts, ends: Nx2 arrays of segment end points
+        line_ids: Array with the parent line of each segment.
+                  Segments from different lines are never joined.
+        rtol, atol: Optional tolerances as in numpy.allclose
+
+    Output
+        lines: List of Nx2 numpy arrays each corresponding to a continuous
+               line formed from consecutive segments
+        ids: List of parent line ids for each line
+
+    This is the vectorised equivalent of join_line_segments
+    """
+
+    N = len(starts)
+    if N == 0:
+        return [], []
+
+    # Segments are adjacent if the first ends where the next starts
+    difference = numpy.abs(ends[:-1] - starts[1:])
+    tolerance = atol + rtol * numpy.abs(starts[1:])
+    adjacent = numpy.all(difference <= tolerance, axis=1)
+    adjacent *= line_ids[:-1] == line_ids[1:]
+
+    # Each run of adjacent segments forms one line
+    breaks = numpy.where(~adjacent)[0] + 1
+    run_starts = numpy.concatenate(([0], breaks))
+    run_ends = numpy.concatenate((breaks, [N]))
+
+    lines = []
+    for i, j in zip(run_starts, run_ends):
+        line = numpy.zeros((j - i + 1, 2))
+        line[:-1] = starts[i:j]
+        line[-1] = ends[j - 1]
+        lines.append(line)
+
+    return lines, line_ids[run_starts]
 
 
 def clip_line_by_polygon(line, polygon,
@@ -850,8 +2308,6 @@ def clip_line_by_polygon(line, polygon,
                                  closed=closed)
 
 
-# FIXME (Ole, 14 sep 2012): Will clean this up soon, promise
-# pylint: disable=W0613
 def _clip_line_by_polygon(line,
                           polygon,
                           polygon_segments,
@@ -863,163 +2319,12 @@ def _clip_line_by_polygon(line,
     - see public clip_line_by_polygon() for details
     """
 
-    # Algorithm
-    #
-    # 1: Find all intersection points between line segments and polygon edges
-    # 2: For each line segment
-    #    * Calculate distance from first end point to each intersection point
-    #    * Sort intersection points by distance
-    #    * Cut segment into multiple segments
-    # 3: For each new line segment
-    #    * Calculate its midpoint
-    #    * Determine if it is inside or outside clipping polygon
-    # 4: Join adjacent segments into polylines that are either
-    #     fully inside or outside polygon
-    # 5
-
-    # Get bounding box
-    minpx = polygon_bbox[0]
-    maxpx = polygon_bbox[1]
-    minpy = polygon_bbox[2]
-    maxpy = polygon_bbox[3]
-
-    # Lists collecting clipped line segments
-    inside_line_segments = []
-    outside_line_segments = []
-
-    # Loop through line segments
-    M = line.shape[0]
-    for k in range(M - 1):
-        p0 = line[k, :]
-        p1 = line[k + 1, :]
-        segment = [p0, p1]
-
-        #-------------
-        # Optimisation
-        #-------------
-        # Skip segments that are outside polygon bounding box
-
-        # In test_engine.py
-        # test_polygon_to_roads_interpolation_flood_example with
-        # (E_attributes[:-1:100]) took
-        # * Without this: 92s
-        # * With original optimisation: 61s
-        # * With new version: 54s
-        if p0[0] < minpx and p1[0] < minpx:  # Entire segment to the west
-            segment_is_outside_bbox = True
-        elif p0[0] > maxpx and p1[0] > maxpx:  # Entire segment to the east
-            segment_is_outside_bbox = True
-        elif p0[1] < minpy and p1[1] < minpy:  # Entire segment to the south
-            segment_is_outside_bbox = True
-        elif p0[1] > maxpy and p1[1] > maxpy:  # Entire segment to the north
-            segment_is_outside_bbox = True
-        else:
-            # Skip segments where both end points are outside polygon
-            # bounding box and which don't intersect the bounding box
-            segment_is_outside_bbox = True
-            if minpx < p0[0] < maxpx or minpy < p0[1] < maxpy:
-                # First endpoint is inside bounding box
-                segment_is_outside_bbox = False
-            elif minpx < p1[0] < maxpx or minpy < p1[1] < maxpy:
-                # Second endpoint is inside bounding box
-                segment_is_outside_bbox = False
-            else:
-                # Both end points are outside bounding box, but could be on
-                # either side so need to check if segment intersects polygon
-                # bounding box.
-                corners = numpy.array([[minpx, minpy], [maxpx, minpy],
-                                       [maxpx, maxpy], [minpx, maxpy],
-                                       [minpx, minpy]])
-                for i in range(4):
-                    edge = [corners[i, :], corners[i + 1, :]]
-                    value = intersection(segment, edge)
-                    if value is not None:
-                        # Segment intersects polygon bounding box
-                        segment_is_outside_bbox = False
-                        break
-        #-----------------
-        # End optimisation
-        #-----------------
-
-        # Separate segments that are inside from those outside
-        if segment_is_outside_bbox:
-            outside_line_segments.append(segment)
-        else:
-            # Intersect segment with all polygon edges
-            # and decide for each sub-segment whether in or out
-            values = intersection(segment, polygon_segments)
-            mask = -numpy.isnan(values[:, 0])
-            V = values[mask]
-
-            # Array for intersections
-            intersections = numpy.zeros((len(V) + 2, 2))
-
-            # Include end points
-            intersections[0, :] = p0
-            intersections[1, :] = p1
-
-            # Add internal intersections
-            intersections[2:, :] = V
-
-            # For each intersection, computer distance from first end point
-            V = intersections - p0
-            distances = (V * V).sum(axis=1)
-
-            # Sort intersections by distance
-            idx = numpy.argsort(distances)
-            distances = distances[idx]
-            intersections = intersections[idx]
-
-            # Remove duplicate points
-            duplicates = numpy.zeros(len(distances), dtype=bool)
-            duplicates[1:] = distances[1:] - distances[:-1] == 0
-            intersections = intersections[-duplicates, :]
-
-            # FIXME (Ole): Next candidate for vectorisation (11/9/2012) below
-            # Loop through intersections for this line segment
-            #distances = {}
-            #for i in range(len(intersections)):
-            #    v = p0 - intersections[i]
-            #    d = numpy.dot(v, v)
-            #    if d in distances:
-            #        print i, d, distances[d], intersections[i]
-            #        import sys; sys.exit()
-            #    distances[d] = intersections[i]  # Don't record duplicates
-
-            # Sort intersections by distance using Schwarzian transform
-            #A = zip(distances.keys(), distances.values())
-            #A.sort()
-            #_, intersections = zip(*A)
-
-            # Separate segment midpoints according to polygon
-            # Deliberately ignore boundary as midpoints by definition
-            # are fully inside or fully outside.
-            intersections = numpy.array(intersections)
-            midpoints = (intersections[:-1] + intersections[1:]) / 2
-            inside, outside = separate_points_by_polygon(midpoints,
-                                                         polygon,
-                                                         polygon_bbox,
-                                                         check_input=False,
-                                                         closed=closed)
-
-            # Form segments and add to the right lists
-            for i, idx in enumerate([inside, outside]):
-                if len(idx) > 0:
-                    segments = numpy.concatenate((intersections[idx, :],
-                                                  intersections[idx + 1, :]),
-                                                 axis=1)
-                    m, n = segments.shape
-                    segments = numpy.reshape(segments, (m, n / 2, 2))
-                    if i == 0:
-                        inside_line_segments.extend(segments.tolist())
-                    else:
-                        outside_line_segments.extend(segments.tolist())
-
-    # Rejoin adjacent segments and add to result lines
-    inside_lines = join_line_segments(inside_line_segments)
-    outside_lines = join_line_segments(outside_line_segments)
-
-    return inside_lines, outside_lines
+    inside, outside = _clip_lines_by_polygon([line],
+                                             polygon,
+                                             polygon_segments,
+                                             polygon_bbox,
+                                             closed=closed)
+    return inside[0], outside[0]
 
 
 def join_line_segments(segments, rtol=1.0e-12, atol=1.0e-12):
@@ -1083,28 +2388,67 @@ def line_dictionary_to_geometry(D):
 #--------------------------------------------------
 # Helper functions to generate points inside polygon
 #--------------------------------------------------
+def _random_state(seed=None):
+    """Random number generator matching the standard library seeding
+
+    Input:
+       seed - seed as accepted by random.seed (default=None)
+
+    Output:
+       numpy RandomState instance
+
+    Note:
+       Integer seeds are split into 32 bit words the same way random.seed
+       does it so that both generators produce the same sequence.
+       Numbers drawn in batches are therefore identical to those drawn
+       one at a time by random.uniform for the same seed.
+    """
+
+    if seed is None:
+        return numpy.random.RandomState()
+
+    if not isinstance(seed, (int, long)):
+        seed = hash(seed)
+
+    seed = abs(seed)
+    key = []
+    while seed:
+        key.append(seed & 0xffffffff)
+        seed >>= 32
+
+    if len(key) == 0:
+        key = [0]
+
+    return numpy.random.RandomState(key)
+
+
 def generate_random_points_in_bbox(polygon, N, seed=None):
     """Generate random points in polygon bounding box
+
+    Input:
+       polygon - list of vertices of polygon
+       N - number of points
+       seed - seed for random number generator (default=None)
+
+    Output:
+       points - Nx2 array of uniformly distributed points
     """
 
+    polygon = ensure_numeric(polygon)
+
     # Find outer extent of polygon
     minpx = min(polygon[:, 0])
     maxpx = max(polygon[:, 0])
     minpy = min(polygon[:, 1])
     maxpy = max(polygon[:, 1])
 
-    seed_function(seed)
-
-    points = []
-    for _ in range(N):
-        x = uniform(minpx, maxpx)
-        y = uniform(minpy, maxpy)
-        points.append([x, y])
+    random_state = _random_state(seed)
+    return random_state.uniform([minpx, minpy], [maxpx, maxpy],
+                                size=(N, 2))
 
-    return numpy.array(points)
 
-
-def populate_polygon(polygon, number_of_points, seed=None, exclude=None):
+def populate_polygon(polygon, number_of_points, seed=None, exclude=None,
+                     max_batch_size=2 ** 20):
     """Populate given polygon with uniformly distributed points.
 
     Input:
@@ -1117,15 +2461,26 @@ def populate_polygon(polygon, number_of_points, seed=None, exclude=None):
        exclude - list of polygons (inside main polygon) from where points
        should be excluded
 
+       max_batch_size - maximal number of candidate points drawn at a time
+
     Output:
-       points - list of points inside polygon
+       points - Nx2 array of points inside polygon
 
     Examples:
        populate_polygon( [[0,0], [1,0], [1,1], [0,1]], 5 )
        will return five randomly selected points inside the unit square
+
+    Note:
+       Candidate points are drawn in batches from the bounding box and
+       classified in bulk. Accepted points are kept in the order they were
+       drawn so the result for a given seed is the same as if the points
+       had been drawn and tested one at a time.
     """
 
     polygon = ensure_numeric(polygon)
+    if exclude is None:
+        exclude = []
+    exclude = [ensure_numeric(ex_poly) for ex_poly in exclude]
 
     # Find outer extent of polygon
     minpx = min(polygon[:, 0])
@@ -1133,27 +2488,41 @@ def populate_polygon(polygon, number_of_points, seed=None, exclude=None):
     minpy = min(polygon[:, 1])
     maxpy = max(polygon[:, 1])
 
-    # Generate random points until enough are in polygon
-    seed_function(seed)
-    points = []
-    while len(points) < number_of_points:
-        x = uniform(minpx, maxpx)
-        y = uniform(minpy, maxpy)
+    # Generate batches of random points until enough are in polygon
+    random_state = _random_state(seed)
+    batches = []
+    count = 0
+    drawn = 0
+    while count < number_of_points:
+        # Size next batch from the acceptance rate seen so far
+        missing = number_of_points - count
+        if count == 0:
+            batch_size = 2 * missing + 16
+        else:
+            batch_size = int(1.1 * missing * drawn / count) + 16
+        batch_size = min(batch_size, max_batch_size)
+
+        points = random_state.uniform([minpx, minpy], [maxpx, maxpy],
+                                      size=(batch_size, 2))
+        drawn += batch_size
 
-        append = False
-        if is_inside_polygon([x, y], polygon):
-            append = True
+        # Keep points inside polygon and outside all exclusions
+        indices = inside_polygon(points, polygon, closed=True)
+        points = points[numpy.sort(indices)]
+        for ex_poly in exclude:
+            if len(points) == 0:
+                break
+            indices = outside_polygon(points, ex_poly, closed=True)
+            points = points[numpy.sort(indices)]
 
-            #Check exclusions
-            if exclude is not None:
-                for ex_poly in exclude:
-                    if is_inside_polygon([x, y], ex_poly):
-                        append = False
+        points = points[:missing]
+        batches.append(points)
+        count += len(points)
 
-        if append is True:
-            points.append([x, y])
+    if len(batches) == 0:
+        return numpy.zeros((0, 2))
 
-    return points
+    return numpy.concatenate(batches)
 
 
 #------------------------------------
@@ -1271,10 +2640,325 @@ def intersection(line0, line1):
     return result
 
 
+def intersect_segments(segments0, segments1, max_pairs=2 ** 22):
+    """Find all intersections between two collections of line segments
+
+    Inputs:
+        segments0: Sequence of line segments [[[x0, y0], [x1, y1]], ...]
+                   or the equivalent Mx2x2 numpy array
+        segments1: Sequence of line segments as for segments0
+        max_pairs: Maximal number of candidate pairs to process at a time
+
+    Output:
+        i, j: Arrays with indices of intersecting segments in segments0
+              and segments1 ordered by i then j
+        intersections: Kx2 array with the corresponding intersection points
+
+    Notes:
+
+    Candidate pairs are found by sorting segments1 by their western extent
+    and pruning on x and y extents, so only segments with overlapping
+    bounding boxes are tested. Segments1 are grouped by width before
+    sorting so that a few long segments do not widen the search for the
+    rest.
+
+    Each candidate pair is tested with the same formula as intersection(),
+    so segments that are parallel or coincide partly are considered to not
+    intersect.
+    """
+
+    segments0 = ensure_numeric(segments0, numpy.float).reshape(-1, 2, 2)
+    segments1 = ensure_numeric(segments1, numpy.float).reshape(-1, 2, 2)
+
+    if len(segments0) == 0 or len(segments1) == 0:
+        return (numpy.zeros(0, dtype=numpy.int),
+                numpy.zeros(0, dtype=numpy.int),
+                numpy.zeros((0, 2)))
+
+    x0 = segments0[:, 0, 0]
+    y0 = segments0[:, 0, 1]
+    x1 = segments0[:, 1, 0]
+    y1 = segments0[:, 1, 1]
+    x2 = segments1[:, 0, 0]
+    y2 = segments1[:, 0, 1]
+    x3 = segments1[:, 1, 0]
+    y3 = segments1[:, 1, 1]
+
+    # Extents of segments
+    minx0 = numpy.minimum(x0, x1)
+    maxx0 = numpy.maximum(x0, x1)
+    miny0 = numpy.minimum(y0, y1)
+    maxy0 = numpy.maximum(y0, y1)
+    minx1 = numpy.minimum(x2, x3)
+    maxx1 = numpy.maximum(x2, x3)
+    miny1 = numpy.minimum(y2, y3)
+    maxy1 = numpy.maximum(y2, y3)
+
+    # Sort segments1 by western extent within classes of similar width
+    width = maxx1 - minx1
+    _, width_class = numpy.frexp(width)
+    order = numpy.lexsort((minx1, width_class))
+    sorted_minx = minx1[order]
+    sorted_class = width_class[order]
+    class_limits = numpy.concatenate(
+        ([0], numpy.where(sorted_class[1:] != sorted_class[:-1])[0] + 1,
+         [len(order)]))
+
+    i = []
+    j = []
+    intersections = []
+    for c in range(len(class_limits) - 1):
+        lo = class_limits[c]
+        hi = class_limits[c + 1]
+
+        # Range of candidates in this class for each segment in segments0
+        w = numpy.max(width[order[lo:hi]])
+        start = lo + numpy.searchsorted(sorted_minx[lo:hi], minx0 - w,
+                                        side='left')
+        stop = lo + numpy.searchsorted(sorted_minx[lo:hi], maxx0,
+                                       side='right')
+
+        # Process segments in chunks so that candidate pairs stay bounded
+        cumulative = numpy.cumsum(stop - start)
+        if len(cumulative) == 0 or cumulative[-1] == 0:
+            continue
+        limits = numpy.searchsorted(cumulative,
+                                    numpy.arange(0, cumulative[-1],
+                                                 max_pairs),
+                                    side='right')
+        limits = numpy.unique(numpy.concatenate(([0], limits,
+                                                 [len(segments0)])))
+
+        for k in range(len(limits) - 1):
+            ids = numpy.arange(limits[k], limits[k + 1])
+            p, q = _expand_ranges(ids, start[ids], stop[ids])
+            q = order[q]
+
+            # Prune pairs whose bounding boxes do not overlap
+            mask = ((minx1[q] <= maxx0[p]) * (maxx1[q] >= minx0[p]) *
+                    (miny1[q] <= maxy0[p]) * (maxy1[q] >= miny0[p]))
+            p = p[mask]
+            q = q[mask]
+
+            # Intersection formula as in intersection()
+            y3y2 = y3[q] - y2[q]
+            x3x2 = x3[q] - x2[q]
+            x1x0 = x1[p] - x0[p]
+            y1y0 = y1[p] - y0[p]
+            x2x0 = x2[q] - x0[p]
+            y2y0 = y2[q] - y0[p]
+            denominator = y3y2 * x1x0 - x3x2 * y1y0
+
+            # Suppress numpy warnings (as we'll be dividing by zero)
+            original_numpy_settings = numpy.seterr(invalid='ignore',
+                                                   divide='ignore')
+
+            u0 = (y3y2 * x2x0 - x3x2 * y2y0) / denominator
+            u1 = (x2x0 * y1y0 - y2y0 * x1x0) / denominator
+
+            # Only points that lie within given line segments are true
+            # intersections
+            mask = (0.0 <= u0) * (u0 <= 1.0) * (0.0 <= u1) * (u1 <= 1.0)
+
+            # Restore numpy warnings
+            numpy.seterr(**original_numpy_settings)
+
+            p = p[mask]
+            q = q[mask]
+            u0 = u0[mask]
+            x = x0[p] + u0 * x1x0[mask]
+            y = y0[p] + u0 * y1y0[mask]
+
+            i.append(p)
+            j.append(q)
+            intersections.append(numpy.array([x, y]).T)
+
+    if len(i) == 0:
+        return (numpy.zeros(0, dtype=numpy.int),
+                numpy.zeros(0, dtype=numpy.int),
+                numpy.zeros((0, 2)))
+
+    i = numpy.concatenate(i)
+    j = numpy.concatenate(j)
+    intersections = numpy.concatenate(intersections)
+
+    idx = numpy.lexsort((j, i))
+    return i[idx], j[idx], intersections[idx]
+
+
+def rasterise_polygons(polygons, geotransform, nx, ny, closed=True):
+    """Find grid cells whose centres fall inside each polygon
+
+    Args:
+        * polygons: list of polygon geometry objects, list of polygon arrays
+            or packed polygons (safe.storage.geometry.PackedGeometry)
+        * geotransform: 6-tuple used to locate grid geographically
+            (top left x, w-e pixel resolution, rotation,
+            top left y, rotation, n-s pixel resolution)
+        * nx, ny: Number of grid cells in the w-e and n-s directions
+        * closed: Determine whether cell centres on polygon boundaries
+            should be regarded as inside (see separate_points_by_polygon)
+
+    Returns:
+        * List of sorted arrays of flat indices into an ny x nx grid
+          (A.flat) - one per polygon
+
+    Note:
+        Each polygon is filled scanline by scanline from the crossings of
+        its edges with the rows of cell centres, so no grid coordinates are
+        generated. Cell centres follow the pixel registration of
+        :func:`geotransform_to_axes` and the result is the same as
+        classifying them with in_and_outside_polygon.
+
+        If multiple polygons overlap, the one first encountered will be used.
+    """
+
+    x, y = geotransform_to_axes(geotransform, nx, ny)
+
+    rings = []
+    for polygon in polygons:
+        outer_ring, inner_rings = _polygon_rings(polygon)
+        if isinstance(outer_ring, PreparedPolygon):
+            outer_ring = outer_ring.polygon
+        outer_ring = ensure_numeric(outer_ring, numpy.float)
+        if inner_rings is not None:
+            inner_rings = [ensure_numeric(ring, numpy.float)
+                           for ring in inner_rings]
+
+        rings.append((outer_ring, inner_rings))
+
+    if hasattr(polygons, 'get_bboxes'):
+        # Packed polygons (see safe.storage.geometry.PackedGeometry)
+        bboxes = polygons.get_bboxes()
+    else:
+        bboxes = [get_polygon_bbox(outer_ring) for outer_ring, _ in rings]
+
+    rtree = PackedRTree(bboxes)
+
+    cells_covered = []
+    for i, (outer_ring, inner_rings) in enumerate(rings):
+        cells = _rasterise_ring(outer_ring, x, y, closed)
+
+        # Take care of holes
+        if inner_rings is not None:
+            for ring in inner_rings:
+                in_hole = _rasterise_ring(ring, x, y, not closed)
+                cells = _remove_sorted(cells, in_hole)
+
+        # Remove cells already covered by an earlier polygon
+        for j in rtree.query_bbox(bboxes[i]):
+            if j < i:
+                cells = _remove_sorted(cells, cells_covered[j])
+
+        cells_covered.append(cells)
+
+    return cells_covered
+
+
+def _rasterise_ring(ring, x, y, closed):
+    """Find grid cells whose centres fall inside a ring
+
+    Underlying function.
+    - see rasterise_polygons for details
+
+    Args:
+        * ring: Nx2 array of vertices
+        * x, y: Increasing axes of cell centres as returned by
+            geotransform_to_axes
+        * closed: Determine whether cell centres on ring should be
+            regarded as inside
+
+    Returns:
+        * Sorted array of flat indices into the grid with the northern
+          row first
+    """
+
+    nx = len(x)
+    ny = len(y)
+
+    xi = ring[:, 0]
+    yi = ring[:, 1]
+    xj = numpy.roll(xi, -1)
+    yj = numpy.roll(yi, -1)
+
+    ylo = numpy.minimum(yi, yj)
+    yhi = numpy.maximum(yi, yj)
+
+    # Pair each edge with the rows it crosses: (yi < y <= yj) or
+    # (yj < y <= yi) as in the edge crossing formula of
+    # _separate_points_by_polygon
+    e, row = _expand_ranges(numpy.arange(len(ring)),
+                            numpy.searchsorted(y, ylo, side='right'),
+                            numpy.searchsorted(y, yhi, side='right'))
+
+    sigma = (y[row] - yi[e]) / (yj[e] - yi[e]) * (xj[e] - xi[e])
+    crossings = xi[e] + sigma
+
+    # Sort crossings along each row with the northern row first. Each row
+    # is crossed an even number of times and cell centres between the
+    # first and second, third and fourth crossing etc are inside
+    row = ny - 1 - row
+    idx = numpy.lexsort((crossings, row))
+    row = row[idx][0::2]
+    crossings = crossings[idx]
+    start = numpy.searchsorted(x, crossings[0::2], side='right')
+    stop = numpy.searchsorted(x, crossings[1::2], side='right')
+
+    # Flat indices (these come out sorted as intervals are disjoint)
+    offsets, columns = _expand_ranges(row * nx, start, stop)
+    cells = offsets + columns
+
+    if closed is None:
+        return cells
+
+    # Find cell centres on the ring. Candidates are the cells nearest to
+    # where an edge meets each row it touches (all cells along the row
+    # for horizontal edges).
+    e, row = _expand_ranges(numpy.arange(len(ring)),
+                            numpy.searchsorted(y, ylo, side='left'),
+                            numpy.searchsorted(y, yhi, side='right'))
+
+    original_numpy_settings = numpy.seterr(invalid='ignore', divide='ignore')
+    sigma = (y[row] - yi[e]) / (yj[e] - yi[e]) * (xj[e] - xi[e])
+    numpy.seterr(**original_numpy_settings)
+
+    horizontal = yi[e] == yj[e]
+    xlo = numpy.where(horizontal, numpy.minimum(xi[e], xj[e]), xi[e] + sigma)
+    xhi = numpy.where(horizontal, numpy.maximum(xi[e], xj[e]), xi[e] + sigma)
+    start = numpy.maximum(numpy.searchsorted(x, xlo, side='left') - 1, 0)
+    stop = numpy.minimum(numpy.searchsorted(x, xhi, side='right') + 1, nx)
+    stop = numpy.maximum(start, stop)
+
+    k, columns = _expand_ranges(numpy.arange(len(e)), start, stop)
+    e = e[k]
+    row = row[k]
+    on_ring = _points_on_segments(x[columns], y[row],
+                                  xi[e], yi[e], xj[e], yj[e])
+    boundary = numpy.unique((ny - 1 - row[on_ring]) * nx + columns[on_ring])
+
+    if closed:
+        return numpy.union1d(cells, boundary)
+    else:
+        return _remove_sorted(cells, boundary)
+
+
+def _remove_sorted(a, b):
+    """Remove elements of sorted array b from sorted array a
+
+    This is numpy.setdiff1d for sorted arrays without repeated elements
+    """
+
+    if len(a) == 0 or len(b) == 0:
+        return a
+
+    idx = numpy.minimum(numpy.searchsorted(b, a), len(b) - 1)
+    return a[b[idx] != a]
+
+
 # Main functions for polygon clipping
 # FIXME (Ole): Both can be rigged to return points or lines
 # outside any polygon by adding that as the entry in the list returned
-def clip_grid_by_polygons(A, geotransform, polygons):
+def clip_grid_by_polygons(A, geotransform, polygons, return_indices=False):
     """Clip raster grid by polygon.
 
     Args:
@@ -1282,10 +2966,14 @@ def clip_grid_by_polygons(A, geotransform, polygons):
         * geotransform: 6-tuple used to locate A geographically
             (top left x, w-e pixel resolution, rotation,
             top left y, rotation, n-s pixel resolution)
-        * polygons: list of polygon geometry objects or list of polygon arrays
+        * polygons: list of polygon geometry objects, list of polygon arrays
+            or packed polygons (safe.storage.geometry.PackedGeometry)
+        * return_indices: If True return flat indices into A instead of
+            point coordinates.
 
     Returns:
         points_covered: List of (points, values) - one per input polygon.
+            If return_indices is True, the list is of (indices, values).
 
     Implementing algorithm suggested in
     https://github.com/AIFDR/inasafe/issues/91#issuecomment-7025120
@@ -1295,54 +2983,44 @@ def clip_grid_by_polygons(A, geotransform, polygons):
         The required half cell shifts are taken care of by the
         function :func:`geotransform_to_axes`.
 
+        Grid cells are found by rasterising each polygon (see
+        rasterise_polygons) so coordinates are only generated for
+        points inside a polygon.
+
         If multiple polygons overlap, the one first encountered will be used.
 
     """
 
-    # Convert raster grid to Nx2 array of points and an N array of pixel values
     ny, nx = A.shape
+    cells_covered = rasterise_polygons(polygons, geotransform, nx, ny,
+                                       closed=True)
+
+    if return_indices:
+        return [(cells, A.flat[cells]) for cells in cells_covered]
+
+    # Coordinates of cell centres computed only for cells inside polygons
     x, y = geotransform_to_axes(geotransform, nx, ny)
-    points, values = grid_to_points(A, x, y)
+    grid_points = GridPoints(x, y)
 
     # Generate list of points and values that fall inside each polygon
     points_covered = []
-    remaining_points = points
-    remaining_values = values
-
-    for polygon in polygons:
-        #print 'Remaining points', len(remaining_points)
-
-        if hasattr(polygon, 'outer_ring'):
-            outer_ring = polygon.outer_ring
-            inner_rings = polygon.inner_rings
-        else:
-            # Assume it is an array
-            outer_ring = polygon
-            inner_rings = None
-
-        inside, outside = in_and_outside_polygon(remaining_points,
-                                                 outer_ring,
-                                                 holes=inner_rings,
-                                                 closed=True,
-                                                 check_input=False)
-        # Add features inside this polygon
-        points_covered.append((remaining_points[inside],
-                               remaining_values[inside]))
-
-        # Select remaining points to clip
-        remaining_points = remaining_points[outside]
-        remaining_values = remaining_values[outside]
+    for cells in cells_covered:
+        points_covered.append((grid_points[cells], A.flat[cells]))
 
     return points_covered
 
 
-def clip_lines_by_polygons(lines, polygons, check_input=True, closed=True):
+def clip_lines_by_polygons(lines, polygons, check_input=True, closed=True,
+                           exclusive=False):
     """Clip multiple lines by multiple polygons
 
     Args:
         * lines: Sequence of polylines: [[p0, p1, ...], [q0, q1, ...], ...]
             where pi and qi are point coordinates (x, y).
         * polygons: list of polygons, each an array of vertices
+            Lines and polygons may also be packed (see
+            safe.storage.geometry.PackedGeometry). Cached bounding boxes
+            of packed lines are used and polygon holes are ignored.
         * closed: optional parameter to determine whether lines that fall on
             an polygon boundary should be considered to be inside
             (closed=True), outside (closed=False) or
@@ -1350,16 +3028,33 @@ def clip_lines_by_polygons(lines, polygons, check_input=True, closed=True):
             algorithm up but lines on boundaries may or may not be
             deemed to fall inside the polygon and so will be
             indeterministic.
+        * exclusive: optional parameter. If True, parts of lines that are
+            inside a polygon are not considered for subsequent polygons.
+            Each clipped part keeps track of the line it came from, so
+            the work shrinks as lines get covered. Default False.
+            If no polygon bounding boxes overlap (see bboxes_overlap)
+            the parts are the same as without exclusive.
 
     Returns:
         lines_covered: List of polylines inside a polygon -o ne per input
-        polygon.
+        polygon. Each is a dictionary keyed by the index of the parent line
+        in lines as returned by clip_lines_by_polygon. If exclusive is True
+        only parent lines with parts inside the polygon are included.
 
 
-    .. note:: If multiple polygons overlap, the one first encountered will be
-        used.
+    .. note:: If multiple polygons overlap, lines inside all of them are
+        returned for each polygon unless exclusive is True in which case
+        the one first encountered will be used.
     """
 
+    # Unpack lines and outer rings of polygons if they are packed
+    line_bboxes = None
+    if hasattr(lines, 'get_bboxes'):
+        line_bboxes = lines.get_bboxes()
+        lines = lines.get_outer_rings()
+    if hasattr(polygons, 'get_outer_rings'):
+        polygons = polygons.get_outer_rings()
+
     if check_input:
         for i in range(len(lines)):
             try:
@@ -1381,36 +3076,171 @@ def clip_lines_by_polygons(lines, polygons, check_input=True, closed=True):
                        % str(e))
                 raise Exception(msg)
 
+    if exclusive:
+        return _clip_lines_by_polygons_exclusive(lines, polygons,
+                                                 closed=closed,
+                                                 bboxes=line_bboxes)
+
     # Initialise structures
     lines_covered = []
-    remaining_lines = lines
 
     # Clip lines to polygons
     for polygon in polygons:
-    #for i, polygon in enumerate(polygons):
-        #print ('Doing polygon %i (%i vertices) of %i with '
-        #       '%i lines' % (i, len(polygon),
-        #                     len(polygons),
-        #                     len(remaining_lines)))
-        inside_lines, _ = clip_lines_by_polygon(remaining_lines,
+        inside_lines, _ = clip_lines_by_polygon(lines,
                                                 polygon,
+                                                closed=closed,
                                                 check_input=False)
-        #print ('- %i segments were inside'
-        #       % len(line_dictionary_to_geometry(inside_lines)))
 
         # Record lines inside this polygon
         lines_covered.append(inside_lines)
 
-        # Use lines outside as remaining lines
-        # FIXME (Ole): This optimisation needs some thought
-        # as lines are often partially clipped. We also need to keep
-        # track of the parent line to get its attributes if we want
-        # to go down this road
-        #remaining_lines = outside_lines
+    return lines_covered
+
+
+def _clip_lines_by_polygons_exclusive(lines, polygons, closed=True,
+                                      bboxes=None):
+    """Clip multiple lines by multiple polygons removing covered parts
+
+    Underlying function.
+    - see clip_lines_by_polygons for details
+
+    Bounding boxes of lines are computed here unless given in bboxes.
+
+    Parts of lines remaining after each polygon are kept together with the
+    index of their parent line and their bounding boxes. Only parts whose
+    bounding boxes overlap a polygon are clipped by it. Parts inside it
+    are recorded for their parent line and parts outside replace the
+    clipped part in the remaining lines.
+    """
+
+    lines_covered = []
+
+    remaining_lines = list(lines)
+    parent_ids = numpy.arange(len(lines))
+    if bboxes is None:
+        bboxes = _line_bboxes(remaining_lines)
+
+    for polygon in polygons:
+        covered = {}
+        lines_covered.append(covered)
+
+        # Select remaining parts that overlap polygon bounding box
+        polygon_bbox = get_polygon_bbox(polygon)
+        candidates = numpy.where((bboxes[:, 0] <= polygon_bbox[1]) *
+                                 (bboxes[:, 1] >= polygon_bbox[0]) *
+                                 (bboxes[:, 2] <= polygon_bbox[3]) *
+                                 (bboxes[:, 3] >= polygon_bbox[2]))[0]
+        if len(candidates) == 0:
+            continue
+
+        inside_lines, outside_lines = _clip_lines_by_polygon(
+            [remaining_lines[k] for k in candidates],
+            polygon,
+            polygon2segments(polygon),
+            polygon_bbox,
+            closed=closed)
+
+        # Record parts inside polygon by parent line and collect
+        # parts outside to replace the candidates
+        pieces = []
+        piece_keys = []
+        for i, k in enumerate(candidates):
+            parent = int(parent_ids[k])
+            if len(inside_lines[i]) > 0:
+                covered.setdefault(parent, []).extend(inside_lines[i])
+            pieces.extend(outside_lines[i])
+            piece_keys.extend([k] * len(outside_lines[i]))
+
+        # Update remaining lines keeping parts in order along their lines
+        keep = numpy.ones(len(remaining_lines), dtype=numpy.bool)
+        keep[candidates] = False
+        kept = numpy.where(keep)[0]
+
+        piece_keys = numpy.array(piece_keys, dtype=numpy.int)
+        order = numpy.argsort(numpy.concatenate((kept, piece_keys)),
+                              kind='mergesort')
+        remaining_lines = [remaining_lines[k] for k in kept] + pieces
+        remaining_lines = [remaining_lines[k] for k in order]
+        parent_ids = numpy.concatenate((parent_ids[kept],
+                                        parent_ids[piece_keys]))[order]
+        bboxes = numpy.concatenate((bboxes[kept],
+                                    _line_bboxes(pieces)))[order]
 
     return lines_covered
 
 
+def _line_bboxes(lines):
+    """Bounding boxes of lines
+
+    Args:
+        * lines: List of Nx2 arrays of line vertices
+
+    Returns:
+        * Array with one bounding box [minx, maxx, miny, maxy] per line.
+          Lines without vertices get nan which does not overlap anything.
+    """
+
+    bboxes = numpy.zeros((len(lines), 4))
+    bboxes[:] = numpy.nan
+    if len(lines) == 0:
+        return bboxes
+
+    lengths = numpy.array([len(line) for line in lines])
+    nonempty = lengths > 0
+    if not numpy.any(nonempty):
+        return bboxes
+
+    vertices = numpy.concatenate([numpy.reshape(line, (-1, 2))
+                                  for line in lines])
+    starts = (numpy.cumsum(lengths) - lengths)[nonempty]
+
+    x = vertices[:, 0]
+    y = vertices[:, 1]
+    bboxes[nonempty, 0] = numpy.minimum.reduceat(x, starts)
+    bboxes[nonempty, 1] = numpy.maximum.reduceat(x, starts)
+    bboxes[nonempty, 2] = numpy.minimum.reduceat(y, starts)
+    bboxes[nonempty, 3] = numpy.maximum.reduceat(y, starts)
+
+    return bboxes
+
+
+def bboxes_overlap(bboxes, max_pairs=2 ** 22):
+    """Determine whether any two bounding boxes overlap
+
+    Args:
+        * bboxes: Nx4 array of bounding boxes [minx, maxx, miny, maxy]
+        * max_pairs: (optional) maximal number of pairs of boxes that
+            overlap in x to compare in y. If there are more, the boxes are
+            assumed to overlap.
+
+    Returns:
+        * True if any two boxes intersect or touch, otherwise False
+
+    Note:
+        Boxes are sorted by minx and each box is only compared with the
+        boxes that start before it ends.
+    """
+
+    bboxes = ensure_numeric(bboxes, numpy.float)
+    N = len(bboxes)
+    if N < 2:
+        return False
+
+    idx = numpy.argsort(bboxes[:, 0], kind='mergesort')
+    bboxes = bboxes[idx]
+
+    # Boxes j > i with minx_j <= maxx_i overlap box i in x
+    start = numpy.arange(1, N + 1)
+    stop = numpy.searchsorted(bboxes[:, 0], bboxes[:, 1], side='right')
+    stop = numpy.maximum(start, stop)
+    if numpy.sum(stop - start) > max_pairs:
+        return True
+
+    i, j = _expand_ranges(numpy.arange(N), start, stop)
+    return bool(numpy.any((bboxes[j, 2] <= bboxes[i, 3]) *
+                          (bboxes[i, 2] <= bboxes[j, 3])))
+
+
 def polygon2segments(polygon):
     """Convert polygon to segments structure suitable for use in intersection
 
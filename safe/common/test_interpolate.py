@@ -2,11 +2,16 @@ import numpy
 import unittest
 
 # Import InaSAFE modules
-from safe.common.interpolation2d import interpolate2d, interpolate_raster
+from safe.common.interpolation2d import (interpolate2d,
+                                         interpolate_raster,
+                                         is_regular_axis,
+                                         regular_axis_index,
+                                         InterpolationPlan)
 from safe.common.interpolation import BoundsError
+from safe.common.exceptions import InaSAFEError
 from safe.common.interpolation1d import interpolate1d
 from safe.common.testing import combine_coordinates
-from safe.common.numerics import nan_allclose
+from safe.common.numerics import nan_allclose, geotransform_to_axes
 
 
 def linear_function(x, y):
@@ -449,6 +454,131 @@ class Test_interpolate(unittest.TestCase):
 
         assert numpy.allclose(vals, refs, rtol=1e-12, atol=1e-12)
 
+    def test_interpolation_regular_grid(self):
+        """Regular grid fast path agrees with binary search
+        """
+
+        # Axes from geotransform are equidistant
+        G = (105.3, 0.0083333, 0, -5.7, 0, -0.0083333)
+        longitudes, latitudes = geotransform_to_axes(G, 300, 200)
+        assert is_regular_axis(longitudes)
+        assert is_regular_axis(latitudes)
+        assert not is_regular_axis([1.0, 2.0, 4.0])
+        assert not is_regular_axis([1.0])
+
+        # Indices agree for random points, grid points and end points
+        for x in [longitudes, latitudes]:
+            xi = numpy.random.uniform(x[0], x[-1], 10000)
+            xi = numpy.concatenate([xi, x, (x[1:] + x[:-1]) / 2])
+            idx = regular_axis_index(x, xi)
+            ref = numpy.searchsorted(x, xi, side='left')
+            assert numpy.all(idx == ref)
+
+        # Interpolated values agree with those on a perturbed axis which
+        # is not regular and hence uses the general path
+        A = numpy.random.uniform(0, 10, (200, 300))
+        A[50:60, 100:110] = numpy.nan
+        points = numpy.array([numpy.random.uniform(longitudes[0] - 0.1,
+                                                   longitudes[-1] + 0.1,
+                                                   5000),
+                              numpy.random.uniform(latitudes[0] - 0.1,
+                                                   latitudes[-1] + 0.1,
+                                                   5000)]).T
+        perturbed = longitudes.copy()
+        perturbed[1] += 1.0e-4
+        assert not is_regular_axis(perturbed)
+
+        for mode in ['linear', 'constant']:
+            vals = interpolate_raster(longitudes, latitudes, A, points,
+                                      mode=mode)
+            refs = interpolate_raster(perturbed, latitudes, A, points,
+                                      mode=mode)
+
+            # Only points away from the perturbed cell can be compared
+            mask = points[:, 0] > perturbed[2]
+            assert nan_allclose(vals[mask], refs[mask],
+                                rtol=1e-12, atol=1e-12)
+
+    def test_interpolation_plan(self):
+        """Interpolation plan reproduces interpolate_raster
+        """
+
+        G = (105.3, 0.01, 0, -5.7, 0, -0.01)
+        rows, columns = 40, 60
+        longitudes, latitudes = geotransform_to_axes(G, columns, rows)
+
+        # Points inside, outside, on grid points and NaN
+        points = numpy.array([numpy.random.uniform(longitudes[0] - 0.05,
+                                                   longitudes[-1] + 0.05,
+                                                   2000),
+                              numpy.random.uniform(latitudes[0] - 0.05,
+                                                   latitudes[-1] + 0.05,
+                                                   2000)]).T
+        points[0] = [longitudes[0], latitudes[0]]
+        points[1] = [longitudes[-1], latitudes[-1]]
+        points[2] = [longitudes[5], latitudes[7]]
+        points[3] = [numpy.nan, latitudes[7]]
+
+        for mode in ['linear', 'constant']:
+            plan = InterpolationPlan(G, rows, columns, points, mode=mode)
+            assert len(plan) == len(points)
+            assert plan.is_compatible(G, rows, columns)
+            assert not plan.is_compatible(G, rows + 1, columns)
+
+            # Same plan applied to several grids
+            for _ in range(3):
+                A = numpy.random.uniform(0, 10, (rows, columns))
+                A[10:15, 20:30] = numpy.nan
+
+                vals = plan.apply(A)
+                refs = interpolate_raster(longitudes, latitudes, A, points,
+                                          mode=mode)
+                assert nan_allclose(vals, refs, rtol=1e-12, atol=1e-12)
+                assert numpy.isnan(vals[3])
+
+            # Grid of wrong dimensions is rejected
+            try:
+                plan.apply(numpy.zeros((rows, columns + 1)))
+            except InaSAFEError:
+                pass
+            else:
+                msg = 'Should have raised exception for wrong grid size'
+                raise Exception(msg)
+
+    def test_interpolation_raster_bands(self):
+        """Stacks of bands are interpolated like each band on its own
+        """
+
+        G = (105.3, 0.01, 0, -5.7, 0, -0.01)
+        rows, columns, bands = 30, 50, 4
+        longitudes, latitudes = geotransform_to_axes(G, columns, rows)
+
+        A = numpy.random.uniform(0, 10, (bands, rows, columns))
+        A[1, 10:15, 20:30] = numpy.nan
+        points = numpy.array([numpy.random.uniform(longitudes[0] - 0.05,
+                                                   longitudes[-1] + 0.05,
+                                                   1000),
+                              numpy.random.uniform(latitudes[0] - 0.05,
+                                                   latitudes[-1] + 0.05,
+                                                   1000)]).T
+
+        for mode in ['linear', 'constant']:
+            vals = interpolate_raster(longitudes, latitudes, A, points,
+                                      mode=mode)
+            assert vals.shape == (len(points), bands)
+
+            plan = InterpolationPlan(G, rows, columns, points, mode=mode)
+            plan_vals = plan.apply(A)
+            assert plan_vals.shape == (len(points), bands)
+
+            for i in range(bands):
+                refs = interpolate_raster(longitudes, latitudes, A[i],
+                                          points, mode=mode)
+                assert nan_allclose(vals[:, i], refs,
+                                    rtol=1e-12, atol=1e-12)
+                assert nan_allclose(plan_vals[:, i], refs,
+                                    rtol=1e-12, atol=1e-12)
+
     #-----------------------
     # 1D interpolation tests
     #-----------------------
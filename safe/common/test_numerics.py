@@ -11,6 +11,7 @@ import numpy
 #from safe.common.numerics import erf
 from safe.common.numerics import axes_to_points
 from safe.common.numerics import grid_to_points
+from safe.common.numerics import GridPoints
 #from safe.common.numerics import geotransform_to_axes
 
 
@@ -76,6 +77,55 @@ class Test_Numerics(unittest.TestCase):
         assert numpy.allclose(P[:L:N, 1], latitudes[::-1])
         assert numpy.allclose(V, A.flat[:])
 
+    def test_grid_points(self):
+        """Lazy grid points agree with full coordinate array
+        """
+
+        x = numpy.linspace(100, 110, 7)
+        y = numpy.linspace(-4, 0, 5)
+        ref = axes_to_points(x, y)
+
+        P = GridPoints(x, y)
+        assert len(P) == len(ref)
+        assert P.shape == ref.shape
+        assert numpy.allclose(numpy.array(P), ref, rtol=0.0, atol=0.0)
+
+        # Indexing
+        assert numpy.allclose(P[12], ref[12])
+        assert numpy.allclose(P[-1], ref[-1])
+        assert numpy.allclose(P[3:20:4], ref[3:20:4])
+        assert numpy.allclose(P[:7, 0], x)
+        assert numpy.allclose(P[::7, 1], y[::-1])
+        assert numpy.allclose(P[5, 1], ref[5, 1])
+
+        indices = numpy.array([0, 34, 17, 17, 2])
+        assert numpy.allclose(P[indices], ref[indices])
+
+        mask = ref[:, 0] > 104
+        assert numpy.allclose(P[mask], ref[mask])
+
+        try:
+            P[len(ref)]
+        except IndexError:
+            pass
+        else:
+            msg = 'Should have raised IndexError'
+            raise Exception(msg)
+
+        # Chunked iteration visits all points once
+        chunks = list(P.iter_chunks(chunk_size=8))
+        assert len(chunks) == 5
+        assert [start for start, _ in chunks] == [0, 8, 16, 24, 32]
+        assert numpy.allclose(numpy.concatenate([c for _, c in chunks]), ref)
+        assert numpy.allclose([point for point in P], ref)
+
+        # Lazy points from grid_to_points
+        A = numpy.arange(35).reshape((5, 7))
+        P, V = grid_to_points(A, x, y, lazy=True)
+        assert isinstance(P, GridPoints)
+        assert numpy.allclose(numpy.array(P), ref)
+        assert numpy.allclose(V, A.flat[:])
+
 
 if __name__ == '__main__':
     suite = unittest.makeSuite(Test_Numerics, 'test')
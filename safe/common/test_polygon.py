@@ -3,7 +3,7 @@ import numpy
 
 from safe.storage.vector import Vector
 from safe.storage.raster import Raster
-from safe.storage.geometry import Polygon
+from safe.storage.geometry import Polygon, pack_polygons
 from safe.common.polygon import (separate_points_by_polygon,
                                  is_inside_polygon,
                                  is_outside_polygon,
@@ -12,17 +12,33 @@ from safe.common.polygon import (separate_points_by_polygon,
                                  inside_polygon,
                                  clip_lines_by_polygon,
                                  clip_lines_by_polygons,
+                                 bboxes_overlap,
                                  in_and_outside_polygon,
+                                 inside_polygons,
+                                 label_points_by_polygons,
+                                 PackedRTree,
+                                 PreparedPolygon,
+                                 PolygonGrid,
+                                 get_polygon_shape,
+                                 get_polygon_bbox,
+                                 _separate_points_by_polygon,
+                                 _separate_points_by_prepared_polygon,
+                                 _clip_lines_by_polygon,
+                                 polygon2segments,
                                  intersection,
+                                 intersect_segments,
                                  join_line_segments,
                                  clip_line_by_polygon,
                                  clip_grid_by_polygons,
+                                 rasterise_polygons,
                                  populate_polygon,
                                  generate_random_points_in_bbox,
                                  PolygonInputError,
                                  line_dictionary_to_geometry)
 from safe.common.testing import test_polygon, test_lines
-from safe.common.numerics import ensure_numeric
+from safe.common.numerics import ensure_numeric, grid_to_points
+from safe.common.numerics import geotransform_to_axes
+from safe.common.exceptions import InaSAFEError
 
 
 def linear_function(x, y):
@@ -648,6 +664,177 @@ class Test_Polygon(unittest.TestCase):
             Vector(geometry=points,
                    data=values).write_to_file('test_points.shp')
 
+    def test_rasterise_polygons(self):
+        """Polygons are rasterised consistently with point in polygon tests
+        """
+
+        # Grid with cell centres at 0.25, 0.75, ... so that centres fall on
+        # polygon edges and vertices
+        nx = 12
+        ny = 10
+        geotransform = (0.0, 0.5, 0, 5.0, 0, -0.5)
+        A = numpy.arange(nx * ny).reshape((ny, nx))
+        x, y = geotransform_to_axes(geotransform, nx, ny)
+        points, _ = grid_to_points(A, x, y)
+
+        polygons = [[[0.25, 0.25], [2.25, 0.25], [2.25, 2.25], [0.25, 2.25]],
+                    [[1.0, 1.0], [5.0, 1.2], [3.75, 4.75]],
+                    Polygon(outer_ring=[[3.25, 0.25], [5.75, 0.25],
+                                        [5.75, 4.25], [3.25, 4.25]],
+                            inner_rings=[[[4.25, 1.25], [4.75, 1.25],
+                                          [4.75, 3.25], [4.25, 3.25]]]),
+                    [[10, 10], [11, 10], [11, 11]]]  # Outside grid
+
+        for closed in [True, False]:
+            cells = rasterise_polygons(polygons, geotransform, nx, ny,
+                                       closed=closed)
+            assert len(cells) == len(polygons)
+            assert len(cells[3]) == 0
+
+            # Compare to point in polygon tests giving first polygon
+            # precedence where they overlap
+            claimed = numpy.zeros(nx * ny, dtype=numpy.bool)
+            for i, polygon in enumerate(polygons):
+                if isinstance(polygon, Polygon):
+                    inside, _ = in_and_outside_polygon(
+                        points, polygon.outer_ring, closed=closed,
+                        holes=polygon.inner_rings)
+                else:
+                    inside, _ = in_and_outside_polygon(points, polygon,
+                                                       closed=closed)
+                inside = numpy.sort(inside)
+                inside = inside[~claimed[inside]]
+                claimed[inside] = True
+
+                assert numpy.all(cells[i] == inside)
+
+        # Boundary cells of the square are included when closed
+        cells = rasterise_polygons(polygons[:1], geotransform, nx, ny)[0]
+        assert len(cells) == 25
+
+        # Indices and values are returned by clip_grid_by_polygons
+        res = clip_grid_by_polygons(A, geotransform, polygons,
+                                    return_indices=True)
+        assert numpy.all(res[0][0] == cells)
+        assert numpy.all(res[0][1] == A.flat[cells])
+
+        res = clip_grid_by_polygons(A, geotransform, polygons)
+        assert numpy.allclose(res[0][0], points[cells])
+        assert numpy.all(res[0][1] == A.flat[cells])
+
+    def test_polygon_shape(self):
+        """Rectangles and convex polygons are recognised
+        """
+
+        square = [[0, 0], [1, 0], [1, 1], [0, 1]]
+        assert get_polygon_shape(square) == 'rectangle'
+        assert get_polygon_shape(square[::-1]) == 'rectangle'
+        assert get_polygon_shape(square + [[0, 0]]) == 'rectangle'
+        assert get_polygon_shape([[0, 0], [0.5, 0], [1, 0],
+                                  [1, 1], [0, 1]]) == 'rectangle'
+        assert get_polygon_shape(PreparedPolygon(square)) == 'rectangle'
+
+        assert get_polygon_shape([[0, 0], [1, 0], [0, 1]]) == 'convex'
+        angles = numpy.linspace(0, 2 * numpy.pi, 361)[:-1]
+        circle = numpy.array([numpy.cos(angles), numpy.sin(angles)]).T
+        assert get_polygon_shape(circle) == 'convex'
+        assert get_polygon_shape(circle[::-1]) == 'convex'
+
+        # Concave, self intersecting and degenerate polygons
+        assert get_polygon_shape([[0, 0], [2, 0], [1, 1],
+                                  [2, 2], [0, 2]]) == 'general'
+        assert get_polygon_shape([[0, 0], [1, 1], [1, 0],
+                                  [0, 1]]) == 'general'
+        pentagram = numpy.array([circle[(144 * i) % 360] for i in range(5)])
+        assert get_polygon_shape(pentagram) == 'general'
+        assert get_polygon_shape([[0, 0], [1, 0], [2, 0]]) == 'general'
+        assert get_polygon_shape([[0, 0], [1, 0]]) == 'general'
+
+    def test_convex_polygon_fast_paths(self):
+        """Points and lines are classified correctly by convex polygons
+        """
+
+        rectangle = numpy.array([[0, 0], [2, 0], [2, 1], [0, 1]],
+                                dtype=numpy.float)
+        hexagon = numpy.array([[1, 0], [2, 0], [3, 1], [2, 2],
+                               [1, 2], [0, 1]], dtype=numpy.float)
+
+        # Points on grid hitting edges and vertices
+        x, y = numpy.meshgrid(numpy.linspace(-1, 4, 21),
+                              numpy.linspace(-1, 3, 17))
+        points = numpy.array([x.flatten(), y.flatten()]).T
+
+        for polygon in [rectangle, hexagon]:
+            for closed in [True, False]:
+                inside, outside = separate_points_by_polygon(points, polygon,
+                                                             closed=closed)
+                ref_inside, ref_outside = _separate_points_by_polygon(
+                    points, polygon, closed=closed)
+                assert numpy.all(numpy.sort(ref_inside) == inside)
+                assert numpy.all(ref_outside == outside)
+
+        # Lines clipped by rectangle
+        lines = [numpy.array([[-1, 0.5], [3, 0.5]]),
+                 numpy.array([[-1, -1], [1, 1], [3, 3]]),
+                 numpy.array([[-1, 0], [3, 0]]),  # Along boundary
+                 numpy.array([[1, -1], [3, 1]]),  # Touching corner
+                 numpy.array([[0.5, 0.5], [1.5, 0.5]]),
+                 numpy.array([[5, 5], [6, 6]])]
+        inside, outside = clip_lines_by_polygon(lines, rectangle)
+        assert numpy.allclose(inside[0], [[[0, 0.5], [2, 0.5]]])
+        assert numpy.allclose(outside[0], [[[-1, 0.5], [0, 0.5]],
+                                           [[2, 0.5], [3, 0.5]]])
+        assert numpy.allclose(inside[1], [[[0, 0], [1, 1]]])
+        assert numpy.allclose(outside[1], [[[-1, -1], [0, 0]],
+                                           [[1, 1], [3, 3]]])
+        assert numpy.allclose(inside[2], [[[0, 0], [2, 0]]])
+        assert len(inside[3]) == 0
+        assert numpy.allclose(outside[3], [[[1, -1], [2, 0], [3, 1]]])
+        assert numpy.allclose(inside[4], [lines[4]])
+        assert len(outside[4]) == 0
+        assert len(inside[5]) == 0
+
+        # Line through corner where rounding gives entry before exit
+        polygon = 0.3 * numpy.array([[-1, -1], [2, -1], [2, 1.5], [-1, 1.5]])
+        line = numpy.array([[2.0, -1.3], [0.4, 0.7]])
+        inside, outside = clip_lines_by_polygon([line], polygon)
+        assert len(inside[0]) == 0
+        assert len(outside[0]) == 1
+        assert numpy.allclose(outside[0][0], [[2.0, -1.3], [0.6, 0.45],
+                                              [0.4, 0.7]])
+
+    def test_separate_points_by_polygon_workers(self):
+        """Points can be classified by polygon in parallel
+        """
+
+        polygon = [[0, 0], [2, 0], [1, 1], [2, 2], [0, 2]]
+        numpy.random.seed(13)
+        points = numpy.random.uniform(-1, 3, (120000, 2))
+
+        inside, outside = separate_points_by_polygon(points, polygon)
+        for workers in [1, 2, 3, 2L, numpy.int64(2)]:
+            res_inside, res_outside = separate_points_by_polygon(
+                points, polygon, workers=workers)
+            assert numpy.all(res_inside == inside)
+            assert numpy.all(res_outside == outside)
+
+        # Grids are used in the worker processes too
+        grid = PolygonGrid(polygon)
+        res_inside, res_outside = separate_points_by_polygon(
+            points, polygon, grid=grid, workers=2)
+        assert numpy.all(res_inside == inside)
+        assert numpy.all(res_outside == outside)
+
+        # Invalid number of workers
+        for workers in [0, 1.5, 'many', True]:
+            try:
+                separate_points_by_polygon(points, polygon, workers=workers)
+            except PolygonInputError:
+                pass
+            else:
+                msg = 'Should have raised exception for workers=%s' % workers
+                raise Exception(msg)
+
     def test_populate_polygon(self):
         """Polygon can be populated by random points
         """
@@ -759,6 +946,59 @@ class Test_Polygon(unittest.TestCase):
 
     test_populate_polygon_with_exclude2.slow = True
 
+    def test_populate_polygon_batches(self):
+        """Batched population is reproducible and matches point by point
+        """
+
+        from random import uniform, seed as seed_function
+
+        polygon = [[0, 0], [10, 10], [15, 5], [20, 10], [25, 0],
+                   [30, 10], [40, -10]]
+        ex_poly = [[-1, -1], [5, 0], [5, 5], [-1, 5]]
+        M = 300
+
+        # Reference result drawing and testing one point at a time
+        seed_function(17)
+        reference = []
+        while len(reference) < M:
+            x = uniform(0, 40)
+            y = uniform(-10, 10)
+            if (is_inside_polygon([x, y], polygon) and
+                    not is_inside_polygon([x, y], ex_poly)):
+                reference.append([x, y])
+        reference = numpy.array(reference)
+
+        # Result must not depend on batch size
+        for max_batch_size in [1, 7, 100, 2 ** 20]:
+            points = populate_polygon(polygon, M, seed=17,
+                                      exclude=[ex_poly],
+                                      max_batch_size=max_batch_size)
+            assert points.shape == (M, 2)
+            assert numpy.allclose(points, reference)
+
+        # Same seed gives same points, different seed does not
+        points1 = populate_polygon(polygon, M, seed=13)
+        points2 = populate_polygon(polygon, M, seed=13)
+        points3 = populate_polygon(polygon, M, seed=14)
+        assert numpy.allclose(points1, points2)
+        assert not numpy.allclose(points1, points3)
+
+        # Bounding box points are reproducible too
+        points1 = generate_random_points_in_bbox(numpy.array(polygon),
+                                                 100, seed=13)
+        points2 = generate_random_points_in_bbox(numpy.array(polygon),
+                                                 100, seed=13)
+        assert points1.shape == (100, 2)
+        assert numpy.allclose(points1, points2)
+        assert numpy.all(points1[:, 0] >= 0)
+        assert numpy.all(points1[:, 0] <= 40)
+        assert numpy.all(points1[:, 1] >= -10)
+        assert numpy.all(points1[:, 1] <= 10)
+
+        # Zero points requested
+        points = populate_polygon(polygon, 0)
+        assert points.shape == (0, 2)
+
     def test_large_example(self):
         """Large polygon clipping example works
         """
@@ -910,6 +1150,117 @@ class Test_Polygon(unittest.TestCase):
 
     test_large_convoluted_example_random.slow = True
 
+    def test_prepared_polygon(self):
+        """Prepared polygons separate points like raw polygon arrays
+        """
+
+        # Convoluted polygon with many vertices
+        N = 500
+        t = numpy.linspace(0, 2 * numpy.pi, N, endpoint=False)
+        r = 1 + 0.3 * numpy.sin(7 * t)
+        polygon = numpy.array([r * numpy.cos(t), r * numpy.sin(t)]).T
+
+        # Random points plus points on vertices and edges
+        points = generate_random_points_in_bbox(polygon, 3000, seed=17)
+        points[:50] = polygon[:50]
+        points[50:100] = (polygon[50:100] + polygon[51:101]) / 2
+        points[100] = [0, 0]  # Centre
+        points[101] = [5, 5]  # Outside bounding box
+
+        prepared = PreparedPolygon(polygon)
+        assert len(prepared) == N
+
+        for closed in [False, True]:
+            # Reference result testing all points against all edges
+            ref_inside, ref_outside = _separate_points_by_polygon(
+                points, polygon, closed=closed)
+            inside, outside = separate_points_by_polygon(points, prepared,
+                                                         closed=closed)
+            assert numpy.all(inside == ref_inside)
+            assert numpy.all(outside == ref_outside)
+
+            # Same result when prepared automatically
+            inside, outside = separate_points_by_polygon(points, polygon,
+                                                         closed=closed)
+            assert numpy.all(inside == ref_inside)
+            assert numpy.all(outside == ref_outside)
+
+        assert 100 in inside
+        assert 101 in outside
+        assert numpy.all(inside_polygon(points, prepared) == inside)
+        assert is_inside_polygon([0, 0], prepared)
+
+        # Slabs with only a few edges each and small chunks
+        prepared = PreparedPolygon(polygon, number_of_slabs=3)
+        inside, outside = _separate_points_by_prepared_polygon(
+            points, prepared, closed=True, max_pairs=1000)
+        ref_inside, ref_outside = _separate_points_by_polygon(points, polygon,
+                                                              closed=True)
+        assert numpy.all(inside == ref_inside)
+        assert numpy.all(outside == ref_outside)
+
+        # Prepared polygons can be used as outer rings with holes
+        hole = [[-0.2, -0.2], [0.2, -0.2], [0.2, 0.2], [-0.2, 0.2]]
+        inside = inside_polygon(points, prepared, holes=[hole])
+        ref_inside = inside_polygon(points, polygon, holes=[hole])
+        assert numpy.all(inside == ref_inside)
+        assert 100 not in inside
+
+    def test_polygon_grid(self):
+        """Classified grids give same separation as exact algorithm
+        """
+
+        # Convoluted polygon with a hole
+        N = 300
+        t = numpy.linspace(0, 2 * numpy.pi, N, endpoint=False)
+        r = 1 + 0.3 * numpy.sin(7 * t)
+        polygon = numpy.array([r * numpy.cos(t), r * numpy.sin(t)]).T
+        holes = [numpy.array([[-0.2, -0.2], [0.2, -0.2],
+                              [0.2, 0.2], [-0.2, 0.2]])]
+
+        # Random points plus points on vertices, edges and the hole
+        points = generate_random_points_in_bbox(polygon, 5000, seed=17)
+        points[:50] = polygon[:50]
+        points[50:100] = (polygon[50:100] + polygon[51:101]) / 2
+        points[100:104] = holes[0]
+        points[104] = [0, 0]  # In hole
+        points[105] = [5, 5]  # Outside bounding box
+
+        grid = PolygonGrid(polygon, number_of_cells=2000)
+        assert grid.nx * grid.ny >= 2000
+        status = grid.cell_status(points)
+        assert numpy.all(status[:100] == PolygonGrid.BOUNDARY)
+        assert status[104] == PolygonGrid.INSIDE
+        assert status[105] == PolygonGrid.OUTSIDE
+
+        for closed in [True, False]:
+            ref_inside, ref_outside = separate_points_by_polygon(
+                points, polygon, closed=closed)
+            inside, outside = separate_points_by_polygon(
+                points, polygon, closed=closed, grid=grid)
+            assert numpy.all(inside == ref_inside)
+            assert numpy.all(outside == ref_outside)
+
+        # Grid with holes is reused for both boundary conventions
+        grid = PolygonGrid(polygon, holes=holes)
+        assert grid.cell_status(points)[104] == PolygonGrid.OUTSIDE
+        for closed in [True, False]:
+            ref_inside, ref_outside = in_and_outside_polygon(
+                points, polygon, holes=holes, closed=closed)
+            inside, outside = in_and_outside_polygon(
+                points, polygon, holes=holes, closed=closed, grid=grid)
+            assert numpy.all(inside == ref_inside)
+            assert numpy.all(outside == numpy.sort(ref_outside))
+
+        # Grids with holes are not accepted by separate_points_by_polygon
+        try:
+            separate_points_by_polygon(points, polygon, grid=grid)
+        except InaSAFEError:
+            pass
+        else:
+            msg = 'Should have raised InaSAFEError'
+            raise Exception(msg)
+
     def test_in_and_outside_polygon_main(self):
         """Set of points is correctly separated according to polygon (2)
         """
@@ -951,6 +1302,59 @@ class Test_Polygon(unittest.TestCase):
         assert numpy.alltrue(inside == [1, 3])
         assert numpy.alltrue(outside == [0, 2, 4, 5])
 
+    def test_in_and_outside_polygon_with_holes(self):
+        """Points are separated by polygon with holes in one pass
+        """
+
+        polygon = [[0, 0], [10, 0], [10, 10], [0, 10]]
+        holes = [[[1, 1], [3, 1], [3, 3], [1, 3]],
+                 [[5, 5], [8, 5], [6, 8]]]
+
+        points = [[0.5, 0.5],  # Inside
+                  [2, 2],  # In first hole
+                  [6, 6],  # In second hole
+                  [2, 1],  # On boundary of first hole
+                  [5.5, 6.5],  # On boundary of second hole
+                  [10, 5],  # On outer boundary
+                  [11, 5],  # Outside
+                  [4, 4]]  # Inside between holes
+
+        inside, outside = in_and_outside_polygon(points, polygon,
+                                                 holes=holes, closed=True)
+        assert numpy.alltrue(inside == [0, 3, 4, 5, 7])
+        assert numpy.alltrue(outside == [1, 2, 6])
+
+        inside, outside = in_and_outside_polygon(points, polygon,
+                                                 holes=holes, closed=False)
+        assert numpy.alltrue(inside == [0, 7])
+        assert numpy.alltrue(outside == [1, 2, 3, 4, 5, 6])
+
+        # Same as classifying by outer ring and each hole in turn
+        numpy.random.seed(17)
+        points = numpy.random.uniform(-1, 11, (1000, 2))
+        for closed in [True, False]:
+            inside, outside = in_and_outside_polygon(points, polygon,
+                                                     holes=holes,
+                                                     closed=closed)
+
+            ref_inside, _ = separate_points_by_polygon(points, polygon,
+                                                       closed=closed)
+            for hole in holes:
+                _, out_hole = separate_points_by_polygon(
+                    points[ref_inside], hole, closed=not closed)
+                ref_inside = ref_inside[out_hole]
+
+            assert numpy.alltrue(inside == ref_inside)
+            assert len(inside) + len(outside) == len(points)
+
+        # Prepared polygons can include holes
+        prepared = PreparedPolygon(polygon, holes=holes)
+        assert len(prepared.holes) == 2
+        assert prepared.polygon_shape == 'general'
+        inside, _ = separate_points_by_polygon(points, prepared)
+        assert numpy.alltrue(inside == in_and_outside_polygon(
+            points, polygon, holes=holes)[0])
+
     def test_clip_points_by_polygons_with_holes(self):
         """Points can be separated by polygons with holes
         """
@@ -1004,6 +1408,156 @@ class Test_Polygon(unittest.TestCase):
 
     test_clip_points_by_polygons_with_holes.slow = True
 
+    def test_packed_rtree(self):
+        """Packed R-tree finds the same boxes as brute force search
+        """
+
+        # Random boxes of varying size
+        numpy.random.seed(17)
+        N = 500
+        x0 = numpy.random.uniform(0, 100, N)
+        y0 = numpy.random.uniform(0, 100, N)
+        w = numpy.random.uniform(0, 10, N)
+        h = numpy.random.uniform(0, 10, N)
+        bboxes = numpy.array([x0, x0 + w, y0, y0 + h]).T
+
+        points = numpy.random.uniform(-5, 115, (2000, 2))
+        # Include some corner points which must count as inside
+        points[:10] = bboxes[:10, [0, 2]]
+
+        # Use small capacity and chunks to exercise several levels
+        tree = PackedRTree(bboxes, node_capacity=4)
+        assert len(tree) == N
+        point_indices, box_indices = tree.query_points(points, chunk_size=300)
+
+        # Brute force reference
+        x = points[:, 0]
+        y = points[:, 1]
+        ref_points = []
+        ref_boxes = []
+        for i in range(N):
+            minx, maxx, miny, maxy = bboxes[i]
+            idx = numpy.where((minx <= x) * (x <= maxx) *
+                              (miny <= y) * (y <= maxy))[0]
+            ref_points.extend(idx)
+            ref_boxes.extend([i] * len(idx))
+
+        assert numpy.all(point_indices == ref_points)
+        assert numpy.all(box_indices == ref_boxes)
+        for i in range(10):
+            assert i in box_indices[point_indices == i]
+
+        # Bounding box queries
+        bbox = [20, 40, 50, 60]
+        ref = numpy.where((bboxes[:, 0] <= 40) * (bboxes[:, 1] >= 20) *
+                          (bboxes[:, 2] <= 60) * (bboxes[:, 3] >= 50))[0]
+        assert numpy.all(tree.query_bbox(bbox) == ref)
+
+        # Degenerate trees
+        tree = PackedRTree(bboxes[:1])
+        point_indices, box_indices = tree.query_points(points)
+        assert numpy.all(box_indices == 0)
+
+        tree = PackedRTree([])
+        point_indices, box_indices = tree.query_points(points)
+        assert len(point_indices) == len(box_indices) == 0
+
+    def test_inside_polygons(self):
+        """Points can be classified by many polygons using spatial index
+        """
+
+        # A small grid of non overlapping squares plus one overlapping
+        # polygon with a hole
+        polygons = []
+        for i in range(10):
+            for j in range(10):
+                polygons.append(numpy.array([[i, j], [i + 1, j],
+                                             [i + 1, j + 1], [i, j + 1]],
+                                            dtype='d'))
+        polygons.append(Polygon(
+            outer_ring=numpy.array([[2.5, 2.5], [7.5, 2.5], [5, 7.5]]),
+            inner_rings=[numpy.array([[4.5, 4], [5.5, 4], [5, 5]])]))
+
+        points = generate_random_points_in_bbox(numpy.array([[-1, -1],
+                                                             [11, 11]]),
+                                                3000, seed=17)
+
+        res = inside_polygons(points, polygons)
+        assert len(res) == len(polygons)
+        for i, polygon in enumerate(polygons[:-1]):
+            assert numpy.all(res[i] == inside_polygon(points, polygon))
+
+        assert numpy.all(res[-1] == inside_polygon(
+            points, polygons[-1].outer_ring,
+            holes=polygons[-1].inner_rings))
+
+        # Each point inside the squares is counted exactly once
+        # (boundary points excluded as they belong to several squares)
+        count = sum([len(x) for x in res[:-1]])
+        assert count == len(inside_polygon(points, [[0, 0], [10, 0],
+                                                     [10, 10], [0, 10]]))
+
+        # Packed polygons give the same result
+        res_packed = inside_polygons(points, pack_polygons(polygons))
+        assert len(res_packed) == len(polygons)
+        for i in range(len(polygons)):
+            assert numpy.all(res_packed[i] == res[i])
+
+    def test_label_points_by_polygons(self):
+        """Points are labelled by the first polygon they fall inside
+        """
+
+        # Two overlapping squares, one with a hole, and one far away
+        polygons = [Polygon(outer_ring=numpy.array([[0, 0], [2, 0],
+                                                    [2, 2], [0, 2]]),
+                            inner_rings=[numpy.array([[0.5, 0.5],
+                                                      [1.0, 0.5],
+                                                      [1.0, 1.0],
+                                                      [0.5, 1.0]])]),
+                    numpy.array([[1, 1], [3, 1], [3, 3], [1, 3]]),
+                    numpy.array([[10, 10], [11, 10], [11, 11], [10, 11]])]
+
+        points = [[0.25, 0.25],  # In first polygon
+                  [0.75, 0.75],  # In hole of first polygon
+                  [1.5, 1.5],  # In both, first wins
+                  [2.5, 2.5],  # In second polygon only
+                  [2.0, 1.5],  # On boundary of first polygon
+                  [0.75, 0.5],  # On boundary of hole
+                  [5, 5],  # Outside all
+                  [10.5, 10.5]]  # In last polygon
+
+        labels = label_points_by_polygons(points, polygons)
+        assert labels.dtype == numpy.int32
+        assert numpy.all(labels == [0, -1, 0, 1, 0, 0, -1, 2])
+
+        labels = label_points_by_polygons(points, polygons, closed=False)
+        assert numpy.all(labels == [0, -1, 0, 1, 1, -1, -1, 2])
+
+        labels = label_points_by_polygons(points, pack_polygons(polygons))
+        assert numpy.all(labels == [0, -1, 0, 1, 0, 0, -1, 2])
+
+        # Compare to separating remaining points one polygon at a time
+        points = generate_random_points_in_bbox(numpy.array([[-1, -1],
+                                                             [12, 12]]),
+                                                2000, seed=13)
+        labels = label_points_by_polygons(points, polygons)
+        remaining = numpy.arange(len(points))
+        for i, polygon in enumerate(polygons):
+            if hasattr(polygon, 'outer_ring'):
+                inside, outside = in_and_outside_polygon(
+                    points[remaining], polygon.outer_ring,
+                    holes=polygon.inner_rings)
+            else:
+                inside, outside = in_and_outside_polygon(points[remaining],
+                                                         polygon)
+            assert numpy.all(labels[remaining[inside]] == i)
+            remaining = remaining[outside]
+        assert numpy.all(labels[remaining] == -1)
+
+        # Counts by polygon with bincount
+        counts = numpy.bincount(labels[labels >= 0], minlength=3)
+        assert counts.sum() == len(points) - len(remaining)
+
     def test_intersection1(self):
         """Intersection of two simple lines works
         """
@@ -1197,6 +1751,54 @@ class Test_Polygon(unittest.TestCase):
         value = intersection(line0, line1)
         assert value is None
 
+    def test_intersect_segments(self):
+        """Intersections between segment collections agree with intersection
+        """
+
+        # Simple example with crossing, collinear and parallel segments
+        segments0 = [[[0, 0], [2, 2]],
+                     [[0, 1], [2, 1]],
+                     [[5, 5], [6, 6]]]
+        segments1 = [[[0, 2], [2, 0]],
+                     [[2, 1], [3, 1]],
+                     [[0, 0.5], [2, 2.5]]]
+        i, j, points = intersect_segments(segments0, segments1)
+        assert numpy.allclose(i, [0, 1, 1])
+        assert numpy.allclose(j, [0, 0, 2])
+        assert numpy.allclose(points, [[1, 1], [1, 1], [0.5, 1]])
+
+        # Random segments including long ones compared to intersection()
+        numpy.random.seed(11)
+        segments0 = numpy.random.uniform(-5, 5, (40, 2, 2))
+        segments1 = numpy.random.uniform(-5, 5, (30, 2, 2))
+        segments1[0] = [[-100, 0], [100, 0.5]]
+        vectorised = numpy.transpose(segments1, (1, 2, 0))
+
+        ref_i = []
+        ref_j = []
+        ref_points = []
+        for k, segment in enumerate(segments0):
+            value = intersection(segment, vectorised)
+            idx = numpy.where(~numpy.isnan(value[:, 0]))[0]
+            ref_i.extend([k] * len(idx))
+            ref_j.extend(idx)
+            ref_points.extend(value[idx])
+
+        for max_pairs in [1, 10, 2 ** 22]:
+            i, j, points = intersect_segments(segments0, segments1,
+                                              max_pairs=max_pairs)
+            assert numpy.allclose(i, ref_i)
+            assert numpy.allclose(j, ref_j)
+            assert numpy.allclose(points, ref_points)
+
+        # No segments
+        for a, b in [(numpy.zeros((0, 2, 2)), segments1),
+                     (segments0, numpy.zeros((0, 2, 2))),
+                     ([], [])]:
+            i, j, points = intersect_segments(a, b)
+            assert len(i) == len(j) == len(points) == 0
+            assert points.shape == (0, 2)
+
     def test_clip_line_by_polygon_simple(self):
         """Simple lines are clipped and classified by polygon
         """
@@ -1524,6 +2126,84 @@ class Test_Polygon(unittest.TestCase):
                               [[0.3, 0.2],
                                [0.31666667, 0.31666667]])
 
+    def test_clip_lines_by_multiple_polygons_exclusive(self):
+        """Lines are assigned to the first polygon covering them if exclusive
+        """
+
+        polygons = [[[0, 0], [1, 0], [1, 1], [0, 1]],  # Unit square
+                    [[1, 0], [3, 0], [2, 1]],  # Adjacent triangle
+                    [[-1, -1], [6, -1], [6, 6]]]  # Covers the others
+        input_lines = [[[0, 0.5], [4, 0.5]],
+                       [[10, 10], [30, 10]],
+                       [[0.2, 0.2], [0.8, 0.2]]]
+
+        lines_covered = clip_lines_by_polygons(input_lines, polygons,
+                                               exclusive=True)
+        assert len(lines_covered) == len(polygons)
+
+        # Only lines with parts inside a polygon are recorded
+        assert sorted(lines_covered[0].keys()) == [0, 2]
+        assert lines_covered[1].keys() == [0]
+        assert lines_covered[2].keys() == [0]
+
+        assert numpy.allclose(lines_covered[0][0], [[[0, 0.5], [1, 0.5]]])
+        assert numpy.allclose(lines_covered[0][2], [input_lines[2]])
+        assert numpy.allclose(lines_covered[1][0],
+                              [[[1.5, 0.5], [2.5, 0.5]]])
+
+        # Parts covered by earlier polygons are left out
+        assert len(lines_covered[2][0]) == 2
+        assert numpy.allclose(lines_covered[2][0][0], [[1, 0.5], [1.5, 0.5]])
+        assert numpy.allclose(lines_covered[2][0][1], [[2.5, 0.5], [4, 0.5]])
+
+        # Without exclusive the last polygon gets all of its parts
+        lines_covered = clip_lines_by_polygons(input_lines, polygons)
+        assert numpy.allclose(lines_covered[2][0], [[[0.5, 0.5], [4, 0.5]]])
+        assert numpy.allclose(lines_covered[2][2], [[[0.2, 0.2],
+                                                     [0.8, 0.2]]])
+
+    def test_bboxes_overlap(self):
+        """Overlapping bounding boxes are detected
+        """
+
+        assert not bboxes_overlap(numpy.zeros((0, 4)))
+        assert not bboxes_overlap([[0, 1, 0, 1]])
+
+        # Boxes overlapping in x or y only
+        bboxes = [[0, 1, 0, 1], [2, 3, 0, 1], [0.5, 2.5, 2, 3]]
+        assert not bboxes_overlap(bboxes)
+
+        # Touching and overlapping boxes
+        assert bboxes_overlap(bboxes + [[3, 4, 1, 2]])
+        assert bboxes_overlap(bboxes + [[2.9, 4, -1, 0.1]])
+        assert bboxes_overlap(bboxes + [[0.2, 0.3, 0.2, 0.3]])
+
+        # Too many pairs to compare are assumed to overlap
+        bboxes = [[0, 10, i, i + 0.5] for i in range(5)]
+        assert not bboxes_overlap(bboxes)
+        assert bboxes_overlap(bboxes, max_pairs=3)
+
+        # Clipping by polygons with disjoint bounding boxes gives the
+        # same parts whether covered parts are pruned or not
+        polygons = [[[0, 0], [1, 0], [1, 1], [0, 1]],
+                    [[1.5, 0], [3, 0], [2, 1]],
+                    [[4, -1], [6, -1], [6, 6]]]
+        assert not bboxes_overlap([get_polygon_bbox(p) for p in polygons])
+
+        input_lines = [[[0, 0.5], [5.5, 0.5]],
+                       [[10, 10], [30, 10]],
+                       [[0.2, 0.2], [0.8, 0.2], [2, 0.5]]]
+        exclusive = clip_lines_by_polygons(input_lines, polygons,
+                                           exclusive=True)
+        default = clip_lines_by_polygons(input_lines, polygons)
+        for i in range(len(polygons)):
+            for j in range(len(input_lines)):
+                a = exclusive[i].get(j, [])
+                b = default[i][j]
+                assert len(a) == len(b)
+                for x, y in zip(a, b):
+                    assert numpy.allclose(x, y)
+
     def test_clip_lines_by_polygon_real_data(self):
         """Real roads are clipped by complex polygon
         """
@@ -1628,6 +2308,67 @@ class Test_Polygon(unittest.TestCase):
 
     test_clip_lines_by_polygon_real_data.slow = True
 
+    def test_clip_lines_by_polygon_batch(self):
+        """Batch clipping of lines agrees with clipping one line at a time
+        """
+
+        polygon = ensure_numeric([[0, 0], [2, 0], [2, 1],
+                                  [1, 1], [1, 2], [0, 2]], numpy.float)
+        polygon_segments = polygon2segments(polygon)
+        polygon_bbox = [0, 2, 0, 2]
+
+        numpy.random.seed(17)
+        lines = [numpy.random.uniform(-1, 3, (n, 2))
+                 for n in [2, 3, 5, 8, 1]]
+        lines.append(numpy.array([[3.0, 3.0], [4.0, 3.0]]))  # Outside bbox
+        lines.append(numpy.array([[-1.0, 0.5], [0.5, 0.5],
+                                  [0.5, 1.5], [3.0, 1.5]]))
+
+        for max_pairs in [1, 7, 2 ** 22]:
+            inside, outside = _clip_lines_by_polygon(lines,
+                                                     polygon,
+                                                     polygon_segments,
+                                                     polygon_bbox,
+                                                     max_pairs=max_pairs)
+            assert len(inside) == len(outside) == len(lines)
+
+            for k, line in enumerate(lines):
+                ref_inside, ref_outside = clip_line_by_polygon(line, polygon)
+                for result, reference in [(inside[k], ref_inside),
+                                          (outside[k], ref_outside)]:
+                    assert len(result) == len(reference)
+                    for a, b in zip(result, reference):
+                        assert numpy.allclose(a, b)
+
+        # Line outside bounding box is returned unchanged
+        assert len(inside[5]) == 0
+        assert numpy.allclose(outside[5], [lines[5]])
+
+        # Line entering and leaving the L-shaped polygon
+        assert numpy.allclose(inside[6], [[[0.0, 0.5], [0.5, 0.5],
+                                           [0.5, 1.5], [1.0, 1.5]]])
+        assert len(outside[6]) == 2
+        assert numpy.allclose(outside[6][0], [[-1.0, 0.5], [0.0, 0.5]])
+        assert numpy.allclose(outside[6][1], [[1.0, 1.5], [3.0, 1.5]])
+
+    def test_clip_lines_by_polygon_degenerate_at_vertex(self):
+        """Zero length segments at a polygon vertex are outside polygon
+        """
+
+        polygon = ensure_numeric([[0, 0], [2, 0], [0, 2]], numpy.float)
+        polygon_segments = polygon2segments(polygon)
+        polygon_bbox = [0, 2, 0, 2]
+        lines = [numpy.array([[0.0, 0.0], [0.0, 0.0], [1.0, 0.5]])]
+
+        inside, outside = _clip_lines_by_polygon(lines,
+                                                 polygon,
+                                                 polygon_segments,
+                                                 polygon_bbox)
+        assert len(inside[0]) == 1
+        assert numpy.allclose(inside[0][0], [[0.0, 0.0], [1.0, 0.5]])
+        assert len(outside[0]) == 1
+        assert numpy.allclose(outside[0][0], [[0.0, 0.0], [0.0, 0.0]])
+
     def test_join_segments(self):
         """Consecutive line segments can be joined into continuous line
         """
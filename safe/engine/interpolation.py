@@ -6,13 +6,14 @@ to another irrespective of layer types.
 
 import numpy
 
-from safe.common.interpolation2d import interpolate_raster
+from safe.common.interpolation2d import (interpolate_raster,
+                                         InterpolationPlan)
 from safe.common.utilities import verify
 from safe.common.utilities import ugettext as tr
 from safe.common.numerics import ensure_numeric
 from safe.common.geodesy import Point
 from safe.common.exceptions import InaSAFEError, BoundsError
-from safe.common.polygon import (inside_polygon,
+from safe.common.polygon import (inside_polygons, bboxes_overlap,
                                  clip_lines_by_polygons, clip_grid_by_polygons)
 
 from safe.storage.vector import Vector, convert_polygons_to_centroids
@@ -24,7 +25,9 @@ from safe.storage.geometry import Polygon
 def assign_hazard_values_to_exposure_data(hazard, exposure,
                                           layer_name=None,
                                           attribute_name=None,
-                                          mode='linear'):
+                                          mode='linear',
+                                          windowed=False,
+                                          plan=None):
     """Assign hazard values to exposure data
 
         This is the high level wrapper around interpolation functions for
@@ -60,6 +63,20 @@ def assign_hazard_values_to_exposure_data(hazard, exposure,
                  all the way down to the underlying interpolation function
                  interpolate2d (module common/interpolation2d.py)
 
+            * windowed:
+                 Optional flag for raster to point interpolation only.
+                 If True, the hazard raster is read and interpolated one
+                 window of blocks at a time so that the whole grid never
+                 needs to be held in memory. Default False.
+
+            * plan:
+                 Optional interpolation plan for raster to point
+                 interpolation only. Either an InterpolationPlan instance
+                 (see module common/interpolation2d.py) or True, in which
+                 case a plan is computed once and cached on the exposure
+                 layer for subsequent hazard rasters with the same
+                 geotransform. See get_interpolation_plan. Default None.
+
     Returns:
             Layer representing the exposure data with hazard levels assigned.
 
@@ -144,7 +161,9 @@ def assign_hazard_values_to_exposure_data(hazard, exposure,
         return interpolate_raster_vector(hazard, exposure,
                                          layer_name=layer_name,
                                          attribute_name=attribute_name,
-                                         mode=mode)
+                                         mode=mode,
+                                         windowed=windowed,
+                                         plan=plan)
     # Raster-Raster
     elif hazard.is_raster and exposure.is_raster:
         return interpolate_raster_raster(hazard, exposure)
@@ -223,7 +242,7 @@ def check_inputs(hazard, exposure, layer_name, attribute_name):
 #-------------------------------------------------------------
 def interpolate_raster_vector(source, target,
                               layer_name=None, attribute_name=None,
-                              mode='linear'):
+                              mode='linear', windowed=False, plan=None):
     """Interpolate from raster layer to vector data
 
     Args:
@@ -233,6 +252,11 @@ def interpolate_raster_vector(source, target,
               If None the name of V is used for the returned layer.
         * attribute_name: Name for new attribute.
               If None (default) the name of R is used
+        * mode: 'linear' or 'constant' interpolation
+        * windowed: If True read and interpolate source block by block.
+              See interpolate_raster_vector_points.
+        * plan: Optional InterpolationPlan or True to use a plan cached
+              on target. See get_interpolation_plan.
 
     Returns:
         I: Vector data set; points located as target with values
@@ -246,12 +270,22 @@ def interpolate_raster_vector(source, target,
     verify(source.is_raster)
     verify(target.is_vector)
 
+    # Centroids of polygon data have always been interpolated bilinearly
+    if target.is_polygon_data:
+        mode = 'linear'
+
+    # Plans are cached on the original target rather than on centroids
+    if plan is True and (target.is_point_data or target.is_polygon_data):
+        plan = get_interpolation_plan(source, target, mode=mode)
+
     if target.is_point_data:
         # Interpolate from raster to point data
         R = interpolate_raster_vector_points(source, target,
                                              layer_name=layer_name,
                                              attribute_name=attribute_name,
-                                             mode=mode)
+                                             mode=mode,
+                                             windowed=windowed,
+                                             plan=plan)
     #elif target.is_line_data:
     # TBA - issue https://github.com/AIFDR/inasafe/issues/36
     #
@@ -260,7 +294,10 @@ def interpolate_raster_vector(source, target,
         P = convert_polygons_to_centroids(target)
         R = interpolate_raster_vector_points(source, P,
                                              layer_name=layer_name,
-                                             attribute_name=attribute_name)
+                                             attribute_name=attribute_name,
+                                             mode=mode,
+                                             windowed=windowed,
+                                             plan=plan)
         # In case of polygon data, restore the polygon geometry
         # Do this setting the geometry of the returned set to
         # that of the original polygon
@@ -356,7 +393,7 @@ def interpolate_polygon_raster(source, target,
     verify(source.is_polygon_data)
 
     # Run underlying clipping algorithm
-    polygon_geometry = source.get_geometry(as_geometry_objects=True)
+    polygon_geometry = source.get_geometry(packed=True)
 
     polygon_attributes = source.get_data()
     res = clip_grid_by_polygons(target.get_data(scaling=False),
@@ -387,7 +424,9 @@ def interpolate_polygon_raster(source, target,
 def interpolate_raster_vector_points(source, target,
                                      layer_name=None,
                                      attribute_name=None,
-                                     mode='linear'):
+                                     mode='linear',
+                                     windowed=False,
+                                     plan=None):
     """Interpolate from raster layer to point data
 
     Args:
@@ -399,11 +438,23 @@ def interpolate_raster_vector_points(source, target,
               If None (default) the name of layer source is used
         * mode: 'linear' or 'constant' - determines whether interpolation
               from grid to points should be bilinear or piecewise constant
+        * windowed: If True, only the windows of source that contain
+              points are read, one at a time, and peak memory is bounded
+              by the window size rather than the raster size.
+              See interpolate_raster_windowed. Default False.
+        * plan: Optional InterpolationPlan for the geometry of source and
+              the points of target, or True to use a plan cached on target.
+              If given, indices and weights are not recomputed.
+              See get_interpolation_plan. Default None.
 
     Output
         I: Vector data set; points located as target with values
            interpolated from source
 
+    Note:
+        If source has more than one band, all bands are interpolated in one
+        pass and the values are stored in one attribute per band named as
+        returned by get_band_attribute_names.
     """
 
     msg = ('There are no data points to interpolate to. Perhaps zoom out '
@@ -415,12 +466,6 @@ def interpolate_raster_vector_points(source, target,
     verify(target.is_vector)
     verify(target.is_point_data)
 
-    # Get raster data and corresponding x and y axes
-    A = source.get_data(nan=True)
-    longitudes, latitudes = source.get_geometry()
-    verify(len(longitudes) == A.shape[1])
-    verify(len(latitudes) == A.shape[0])
-
     # Get vector point geometry as Nx2 array
     coordinates = numpy.array(target.get_geometry(),
                               dtype='d',
@@ -428,10 +473,42 @@ def interpolate_raster_vector_points(source, target,
     # Get original attributes
     attributes = target.get_data()
 
+    if plan is True:
+        plan = get_interpolation_plan(source, target, mode=mode)
+
+    if plan is not None:
+        msg = 'Interpolation plan can not be combined with windowed reading'
+        verify(not windowed, msg)
+
+        msg = ('Interpolation plan for mode "%s" can not be used with '
+               'mode "%s"' % (plan.mode, mode))
+        verify(plan.mode == mode, msg)
+
+        msg = ('Interpolation plan does not match geometry of raster %s'
+               % source.get_name())
+        verify(plan.is_compatible(source.get_geotransform(),
+                                  source.rows, source.columns), msg)
+
+        msg = ('Interpolation plan has %i points but vector layer %s '
+               'has %i' % (len(plan), target.get_name(), len(target)))
+        verify(len(plan) == len(target), msg)
+
     # Create new attribute and interpolate
     try:
-        values = interpolate_raster(longitudes, latitudes, A,
-                                    coordinates, mode=mode)
+        if plan is not None:
+            values = plan.apply(get_raster_data(source))
+        elif windowed:
+            values = interpolate_raster_windowed(source, coordinates,
+                                                 mode=mode)
+        else:
+            # Get raster data and corresponding x and y axes
+            A = get_raster_data(source)
+            longitudes, latitudes = source.get_geometry()
+            verify(len(longitudes) == A.shape[-1])
+            verify(len(latitudes) == A.shape[-2])
+
+            values = interpolate_raster(longitudes, latitudes, A,
+                                        coordinates, mode=mode)
     except (BoundsError, InaSAFEError), e:
         msg = (tr('Could not interpolate from raster layer %(raster)s to '
                  'vector layer %(vector)s. Error message: %(error)s')
@@ -442,8 +519,14 @@ def interpolate_raster_vector_points(source, target,
 
     # Add interpolated attribute to existing attributes and return
     N = len(target)
-    for i in range(N):
-        attributes[i][attribute_name] = values[i]
+    if len(values.shape) == 1:
+        for i in range(N):
+            attributes[i][attribute_name] = values[i]
+    else:
+        names = get_band_attribute_names(attribute_name, values.shape[1])
+        for i in range(N):
+            for j, name in enumerate(names):
+                attributes[i][name] = values[i, j]
 
     return Vector(data=attributes,
                   projection=target.get_projection(),
@@ -451,6 +534,171 @@ def interpolate_raster_vector_points(source, target,
                   name=layer_name)
 
 
+def get_raster_data(source, window=None):
+    """Get raster data with NaN for missing values as needed for interpolation
+
+    Args:
+        * source: Raster data set (grid)
+        * window: Optional window (col, row, ncols, nrows). See
+              Raster.get_data
+
+    Returns:
+        MxN array for single band rasters and BxMxN array of all bands
+        for multi-band rasters
+    """
+
+    if source.number_of_bands > 1:
+        return source.get_bands(nan=True, window=window)
+    else:
+        return source.get_data(nan=True, window=window)
+
+
+def get_band_attribute_names(attribute_name, number_of_bands):
+    """Names of attributes holding values interpolated from each band
+
+    Args:
+        * attribute_name: Name of interpolated attribute
+        * number_of_bands: Number of bands in raster
+
+    Returns:
+        List of names of the form <attribute_name>_<band> where band
+        counts from 1. Names are truncated to fit into a shapefile.
+    """
+
+    names = []
+    for i in range(number_of_bands):
+        suffix = '_%i' % (i + 1)
+        names.append(str(attribute_name)[:10 - len(suffix)] + suffix)
+
+    return names
+
+
+def get_interpolation_plan(source, target, mode='linear'):
+    """Get interpolation plan from raster grid to vector data
+
+    Args:
+        * source: Raster data set (grid)
+        * target: Vector data set (points or polygons)
+        * mode: 'linear' or 'constant' interpolation
+
+    Returns:
+        InterpolationPlan for the geometry of source and the points of
+        target (centroids for polygon data).
+
+    Note:
+        Plans are cached on target, keyed by geotransform, grid dimensions
+        and mode. Interpolating many hazard rasters that share one
+        geotransform to the same exposure layer therefore computes
+        neighbour indices and weights only once.
+    """
+
+    verify(source.is_raster)
+    verify(target.is_vector)
+
+    key = (tuple(source.get_geotransform()),
+           source.rows, source.columns, mode)
+
+    if not hasattr(target, 'interpolation_plans'):
+        target.interpolation_plans = {}
+
+    if key not in target.interpolation_plans:
+        if target.is_polygon_data:
+            points = convert_polygons_to_centroids(target).get_geometry()
+        else:
+            points = target.get_geometry()
+
+        target.interpolation_plans[key] = InterpolationPlan(
+            source.get_geotransform(), source.rows, source.columns,
+            points, mode=mode)
+
+    return target.interpolation_plans[key]
+
+
+def interpolate_raster_windowed(source, points, mode='linear',
+                                window_cells=2 ** 20):
+    """Interpolate from raster layer to points one window at a time
+
+    Args:
+        * source: Raster data set (grid)
+        * points: Nx2 array of x, y (lon, lat) coordinates
+        * mode: 'linear' or 'constant' interpolation
+        * window_cells: Approximate number of grid cells in each window.
+              Windows are made up of whole blocks as reported by
+              source.get_block_size()
+
+    Returns:
+        N array of interpolated values or NxB array for rasters with B
+        bands. Points outside the grid get NaN.
+
+    Note:
+        Points are sorted by the window containing them and only windows
+        with points are read. Each window is padded with a halo of one
+        pixel so that all neighbours needed for interpolation are present.
+        The result is the same as that of interpolate_raster applied to
+        the whole grid.
+    """
+
+    points = ensure_numeric(points, numpy.float)
+    N = len(points)
+    if source.number_of_bands > 1:
+        values = numpy.zeros((N, source.number_of_bands))
+    else:
+        values = numpy.zeros(N)
+    values[:] = numpy.nan
+    if N == 0:
+        return values
+
+    rows = source.rows
+    columns = source.columns
+    longitudes, latitudes = source.get_geometry()
+
+    # Window size as multiples of the natural block size
+    block_cols, block_rows = source.get_block_size()
+    block_cols = max(1, min(block_cols, columns))
+    block_rows = max(1, min(block_rows, rows))
+    factor = max(1, window_cells // (block_cols * block_rows))
+    window_cols = block_cols
+    window_rows = min(rows, block_rows * factor)
+
+    # Locate pixel containing each point
+    g = source.get_geotransform()
+    col = (points[:, 0] - g[0]) / g[1]
+    row = (points[:, 1] - g[3]) / g[5]
+    inside = (col >= 0) & (col < columns) & (row >= 0) & (row < rows)
+    indices = numpy.flatnonzero(inside)
+    col = col[indices].astype(numpy.int)
+    row = row[indices].astype(numpy.int)
+
+    # Sort points by window
+    windows_across = (columns - 1) // window_cols + 1
+    key = (row // window_rows) * windows_across + col // window_cols
+    order = numpy.argsort(key, kind='mergesort')
+    indices = indices[order]
+    key = key[order]
+    starts = numpy.flatnonzero(numpy.diff(key)) + 1
+    starts = numpy.concatenate([[0], starts, [len(key)]])
+
+    for i in range(len(starts) - 1):
+        k = key[starts[i]]
+        idx = indices[starts[i]:starts[i + 1]]
+
+        # Window of blocks with one pixel halo
+        col0 = max(0, (k % windows_across) * window_cols - 1)
+        col1 = min(columns, (k % windows_across + 1) * window_cols + 1)
+        row0 = max(0, (k // windows_across) * window_rows - 1)
+        row1 = min(rows, (k // windows_across + 1) * window_rows + 1)
+
+        A = get_raster_data(source,
+                            window=(col0, row0, col1 - col0, row1 - row0))
+
+        # Latitudes go south to north whereas rows go north to south
+        values[idx] = interpolate_raster(longitudes[col0:col1],
+                                         latitudes[rows - row1:rows - row0],
+                                         A, points[idx], mode=mode)
+
+    return values
+
+
 def interpolate_polygon_points(source, target,
                                layer_name=None):
     """Interpolate from polygon vector layer to point vector data
@@ -492,7 +740,7 @@ def interpolate_polygon_points(source, target,
     original_geometry = target.get_geometry()  # Geometry for returned data
 
     # Extract polygon features
-    geom = source.get_geometry(as_geometry_objects=True)
+    geom = source.get_geometry(packed=True)
     data = source.get_data()
     verify(len(geom) == len(data))
 
@@ -506,18 +754,19 @@ def interpolate_polygon_points(source, target,
         for key in attribute_names:
             a[key] = None
 
+    # Clip data points by polygons using a spatial index so that each
+    # point is only tested against polygons whose bounding box contains it
+    indices_inside = inside_polygons(points, geom)
+
     # Traverse polygons and assign attributes to points that fall inside
-    for i, polygon in enumerate(geom):
+    for i, indices in enumerate(indices_inside):
         # Carry all attributes across from source
         poly_attr = data[i]
 
         # Assign default attribute to indicate points inside
         poly_attr[DEFAULT_ATTRIBUTE] = True
 
-        # Clip data points by polygons and add polygon attributes
-        indices = inside_polygon(points, polygon.outer_ring,
-                                 holes=polygon.inner_rings)
-
+        # Add polygon attributes
         for k in indices:
             for key in poly_attr:
                 # Assign attributes from polygon to points
@@ -551,14 +800,14 @@ def interpolate_polygon_lines(source, target,
     """
 
     # Extract line features
-    lines = target.get_geometry()
+    lines = target.get_geometry(packed=True)
     line_attributes = target.get_data()
     N = len(target)
     verify(len(lines) == N)
     verify(len(line_attributes) == N)
 
     # Extract polygon features
-    polygons = source.get_geometry()
+    polygons = source.get_geometry(packed=True)
     polygon_attributes = source.get_data()
     verify(len(polygons) == len(polygon_attributes))
 
@@ -566,8 +815,12 @@ def interpolate_polygon_lines(source, target,
     #clipped_geometry = []
     #clipped_attributes = []
 
-    # Clip line lines to polygons
-    lines_covered = clip_lines_by_polygons(lines, polygons)
+    # Clip line lines to polygons. If no polygon bounding boxes overlap,
+    # parts of lines can only be inside one polygon so parts already
+    # covered need not be clipped by the remaining polygons.
+    exclusive = not bboxes_overlap(polygons.get_bboxes())
+    lines_covered = clip_lines_by_polygons(lines, polygons,
+                                           exclusive=exclusive)
 
     # Create one new line data layer with joined attributes
     # from polygons and lines
@@ -576,7 +829,7 @@ def interpolate_polygon_lines(source, target,
     for i in range(len(polygons)):
         # Loop over polygons
 
-        for j in lines_covered[i]:
+        for j in sorted(lines_covered[i]):
             # Loop over parent lines
 
             lines = lines_covered[i][j]
@@ -688,23 +941,20 @@ def tag_polygons_by_grid(polygons, grid, threshold=0, tag='affected'):
     verify(grid.is_raster)
 
     polygon_attributes = polygons.get_data()
-    polygon_geometry = polygons.get_geometry(as_geometry_objects=True)
+    polygon_geometry = polygons.get_geometry(packed=True)
 
-    # Separate grid points by polygon
+    # Separate grid values by polygon
     res = clip_grid_by_polygons(grid.get_data(),
                                 grid.get_geotransform(),
-                                polygon_geometry)
+                                polygon_geometry,
+                                return_indices=True)
 
     # Create new polygon layer with tag set according to grid values
     # and threshold
     new_attributes = []
     for i, (_, values) in enumerate(res):
         # For each polygon check if any grid value in it exceeds the threshold
-        affected = False
-        for val in values:
-            # Check each grid value in this polygon
-            if val > threshold:
-                affected = True
+        affected = numpy.any(values > threshold)
 
         # Existing attributes for this polygon
         attr = polygon_attributes[i].copy()
@@ -9,6 +9,8 @@ from os.path import join
 from safe.engine.core import calculate_impact
 from safe.engine.interpolation import interpolate_polygon_raster
 from safe.engine.interpolation import interpolate_raster_vector_points
+from safe.engine.interpolation import interpolate_raster_windowed
+from safe.engine.interpolation import get_interpolation_plan
 from safe.engine.interpolation import assign_hazard_values_to_exposure_data
 from safe.engine.interpolation import tag_polygons_by_grid
 
@@ -17,6 +19,7 @@ from safe.storage.core import read_layer
 from safe.storage.core import write_vector_data
 from safe.storage.core import write_raster_data
 from safe.storage.vector import Vector
+from safe.storage.raster import Raster
 from safe.storage.utilities import DEFAULT_ATTRIBUTE
 
 from safe.common.polygon import separate_points_by_polygon
@@ -53,6 +56,8 @@ from impact_functions_for_testing import itb_fatality_model_org
 from impact_functions_for_testing import padang_building_impact_model
 from safe.impact_functions.earthquake.pager_earthquake_fatality_model import (
 PAGFatalityFunction)
+from safe.impact_functions.earthquake.itb_earthquake_fatality_model import (
+ITBFatalityFunction)
 # pylint: enable=W0611
 
 
@@ -390,6 +395,49 @@ class Test_Engine(unittest.TestCase):
             msg = 'Expected %s in impact_summary: %s' % (x, summary)
             assert x in summary, msg
 
+    def test_fatality_rate_tables(self):
+        """Fatality rates for continuous MMI agree with the rate functions
+        """
+
+        # MMI grid with values around the ITB threshold and NaN
+        mmi = numpy.random.uniform(1, 10, (100, 120))
+        mmi[0, :10] = [1, 3.5, 3.999, 4, 4.001, 5.25, 7.5, 9.99, 10, 12]
+        mmi[1, 0] = numpy.nan
+        population = numpy.random.uniform(0, 1000, mmi.shape)
+
+        for IF in [ITBFatalityFunction(), PAGFatalityFunction()]:
+            rates = IF.fatality_rates(mmi)
+            assert rates.shape == mmi.shape
+            assert numpy.isnan(rates[1, 0])
+
+            refs = numpy.zeros(mmi.shape)
+            for i in range(mmi.shape[0]):
+                for j in range(mmi.shape[1]):
+                    if numpy.isnan(mmi[i, j]):
+                        refs[i, j] = numpy.nan
+                    else:
+                        refs[i, j] = IF.fatality_rate(mmi[i, j])
+
+            assert nan_allclose(rates, refs, rtol=1.0e-3, atol=1.0e-12)
+            assert nan_allclose(IF.fatalities(mmi, population),
+                                refs * population,
+                                rtol=1.0e-3, atol=1.0e-9)
+
+            # Table is cached for the same coefficients
+            table = IF.fatality_rate_table()
+            assert table is IF.fatality_rate_table()
+
+        # Rate below threshold of ITB model is exactly zero
+        IF = ITBFatalityFunction()
+        assert IF.fatality_rates(3.999) == 0
+        assert IF.fatality_rates(4.0) == IF.fatality_rate(4.0)
+
+        # Changing coefficients gives a new table
+        IF.parameters = IF.parameters.copy()
+        IF.parameters['x'] = 0.5
+        assert numpy.allclose(IF.fatality_rates(7.5), IF.fatality_rate(7.5),
+                              rtol=1.0e-3)
+
     def test_earthquake_fatality_estimation_ghasemi(self):
         """Fatalities from ground shaking can be computed correctly 2
            using the Hadi Ghasemi function.
@@ -1761,6 +1809,121 @@ class Test_Engine(unittest.TestCase):
             if not numpy.isnan(interpolated_depth):
                 assert depth_min <= interpolated_depth <= depth_max, msg
 
+    def test_interpolation_windowed(self):
+        """Windowed interpolation gives same result as whole grid
+        """
+
+        hazard_filename = ('%s/tsunami_max_inundation_depth_4326.tif'
+                           % TESTDATA)
+        exposure_filename = ('%s/tsunami_building_exposure.shp' % TESTDATA)
+
+        H = read_layer(hazard_filename)
+        E = read_layer(exposure_filename)
+        coordinates = E.get_geometry()
+
+        # Windows of full grid agree with whole grid
+        A = H.get_data()
+        B = H.get_data(window=(3, 5, 10, 7))
+        assert nan_allclose(A[5:12, 3:13], B)
+
+        for mode in ['linear', 'constant']:
+            I = assign_hazard_values_to_exposure_data(H, E,
+                                                      attribute_name='depth',
+                                                      mode=mode)
+            J = assign_hazard_values_to_exposure_data(H, E,
+                                                      attribute_name='depth',
+                                                      mode=mode,
+                                                      windowed=True)
+            assert numpy.allclose(J.get_geometry(), coordinates)
+            assert nan_allclose(I.get_data('depth'), J.get_data('depth'),
+                                rtol=1.0e-12, atol=1.0e-12)
+
+            # Small windows exercise halos and many reads
+            values = interpolate_raster_windowed(H, coordinates, mode=mode,
+                                                 window_cells=16)
+            assert nan_allclose(I.get_data('depth'), values,
+                                rtol=1.0e-12, atol=1.0e-12)
+
+        # Points outside grid get NaN
+        values = interpolate_raster_windowed(H, [[0, 0], [1000, 1000]])
+        assert numpy.all(numpy.isnan(values))
+
+    def test_interpolation_plan(self):
+        """Cached interpolation plan gives same result as full interpolation
+        """
+
+        hazard_filename = ('%s/tsunami_max_inundation_depth_4326.tif'
+                           % TESTDATA)
+        exposure_filename = ('%s/tsunami_building_exposure.shp' % TESTDATA)
+
+        H = read_layer(hazard_filename)
+        E = read_layer(exposure_filename)
+
+        # Second hazard realisation on the same grid
+        H2 = Raster(data=H.get_data() * 2,
+                    projection=H.get_projection(),
+                    geotransform=H.get_geotransform())
+
+        for mode in ['linear', 'constant']:
+            for hazard in [H, H2]:
+                I = assign_hazard_values_to_exposure_data(
+                    hazard, E, attribute_name='depth', mode=mode)
+                J = assign_hazard_values_to_exposure_data(
+                    hazard, E, attribute_name='depth', mode=mode, plan=True)
+                assert nan_allclose(I.get_data('depth'),
+                                    J.get_data('depth'),
+                                    rtol=1.0e-12, atol=1.0e-12)
+
+        # One plan per mode was cached and is reused
+        plan = get_interpolation_plan(H, E)
+        assert len(E.interpolation_plans) == 2
+        assert plan is get_interpolation_plan(H2, E)
+
+        # Plan can also be passed explicitly
+        J = assign_hazard_values_to_exposure_data(
+            H2, E, attribute_name='depth', plan=plan)
+        assert len(J) == len(E)
+
+    def test_interpolation_bands(self):
+        """All bands of multi-band raster are interpolated in one pass
+        """
+
+        hazard_filename = ('%s/tsunami_max_inundation_depth_4326.tif'
+                           % TESTDATA)
+        exposure_filename = ('%s/tsunami_building_exposure.shp' % TESTDATA)
+
+        H = read_layer(hazard_filename)
+        E = read_layer(exposure_filename)
+
+        # Stack of three realisations
+        A = H.get_data()
+        S = Raster(data=numpy.array([A, 2 * A, A + 1]),
+                   projection=H.get_projection(),
+                   geotransform=H.get_geotransform())
+        assert S.number_of_bands == 3
+        assert S.rows == H.rows and S.columns == H.columns
+        assert nan_allclose(S.get_data(band=2), 2 * A)
+
+        # Multi-band rasters survive a round trip to file
+        filename = unique_filename(suffix='.tif')
+        S.write_to_file(filename)
+        F = read_layer(filename)
+        assert F.number_of_bands == 3
+        assert nan_allclose(F.get_bands(), S.get_bands())
+
+        I = assign_hazard_values_to_exposure_data(H, E,
+                                                  attribute_name='depth')
+        refs = numpy.array(I.get_data('depth'))
+        names = ['depth_1', 'depth_2', 'depth_3']
+        for source in [S, F]:
+            for kwargs in [{}, {'windowed': True}, {'plan': True}]:
+                J = assign_hazard_values_to_exposure_data(
+                    source, E, attribute_name='depth', **kwargs)
+                for name, expected in zip(names,
+                                          [refs, 2 * refs, refs + 1]):
+                    assert nan_allclose(J.get_data(name), expected,
+                                        rtol=1.0e-12, atol=1.0e-12)
+
     def test_interpolation_tsunami_maumere(self):
         """Interpolation using tsunami data set from Maumere
 
@@ -3035,6 +3198,66 @@ class Test_Engine(unittest.TestCase):
         msg = 'Expected %.12f, but got %.12f' % (r, x)
         assert numpy.allclose(x, r, rtol=1.0e-6, atol=1.0e-6), msg
 
+    def test_cdf_arrays(self):
+        """ERF and CDFs work on grids in place and keep float32
+        """
+
+        A = numpy.random.uniform(-4, 4, (200, 300))
+
+        # Reference computed elementwise
+        R = numpy.array([erf(a) for a in A.flat]).reshape(A.shape)
+        assert numpy.allclose(erf(A), R, rtol=1.0e-12, atol=1.0e-12)
+
+        # Float32 is not upcast
+        A32 = A.astype(numpy.float32)
+        for func in [erf, normal_cdf]:
+            X = func(A32)
+            assert X.dtype == numpy.float32
+            assert numpy.allclose(X, func(A), rtol=1.0e-5, atol=1.0e-6)
+
+        X = log_normal_cdf(numpy.abs(A32) + 1, median=2, sigma=0.5)
+        assert X.dtype == numpy.float32
+        assert numpy.allclose(X, log_normal_cdf(numpy.abs(A) + 1,
+                                                median=2, sigma=0.5),
+                              rtol=1.0e-5, atol=1.0e-6)
+
+        # Integer input gives float64
+        assert erf(numpy.arange(3)).dtype == numpy.float64
+
+        # Scalar input gives scalars
+        for value, ref in [(erf(0.3), 0.32862676),
+                           (erf(-0.3), -0.32862676),
+                           (erf(numpy.float32(0.3)), 0.32862676),
+                           (normal_cdf(0.5), 0.69146246),
+                           (log_normal_cdf(2.0), 0.75589140),
+                           (log_normal_cdf(7, median=7, sigma=0.6), 0.5)]:
+            assert numpy.isscalar(value)
+            assert numpy.allclose(value, ref, rtol=1.0e-6, atol=1.0e-7)
+
+        # Output array may be supplied and may be the input itself
+        out = numpy.zeros(A.shape)
+        X = normal_cdf(A, mu=0.5, sigma=2, out=out)
+        assert X is out
+        assert numpy.allclose(out, normal_cdf(A, mu=0.5, sigma=2),
+                              rtol=1.0e-12, atol=1.0e-12)
+
+        B = A.copy()
+        X = erf(B, out=B)
+        assert X is B
+        assert numpy.allclose(B, R, rtol=1.0e-12, atol=1.0e-12)
+
+        B = numpy.abs(A) + 1
+        ref = log_normal_cdf(B, median=3, sigma=0.6)
+        log_normal_cdf(B, median=3, sigma=0.6, out=B)
+        assert numpy.allclose(B, ref, rtol=1.0e-12, atol=1.0e-12)
+
+        # Means may be arrays broadcast against x
+        mu = numpy.linspace(-1, 1, A.shape[1])
+        X = normal_cdf(A, mu=mu)
+        assert X.shape == A.shape
+        assert numpy.allclose(X[:, 7], normal_cdf(A[:, 7] - mu[7]),
+                              rtol=1.0e-12, atol=1.0e-12)
+
 if __name__ == '__main__':
     suite = unittest.makeSuite(Test_Engine, 'test')
     runner = unittest.TextTestRunner(verbosity=2)
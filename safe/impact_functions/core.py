@@ -14,7 +14,7 @@ import numpy
 from third_party.odict import OrderedDict
 
 import keyword as python_keywords
-from safe.common.polygon import inside_polygon
+from safe.common.polygon import inside_polygons
 from safe.common.utilities import ugettext as tr
 from safe.common.tables import Table, TableCell, TableRow
 from utilities import pretty_string, remove_double_spaces
@@ -515,12 +515,11 @@ def aggregate_point_data(data=None, boundaries=None,
     points = data.get_geometry()
     attributes = data.get_data()
 
-    result = []
-    #for i, polygon in enumerate(polygon_geoms):
-    for polygon in polygon_geoms:
-        indices = inside_polygon(points, polygon)
+    # Clip points by all polygons at once using a spatial index
+    indices_inside = inside_polygons(points, polygon_geoms)
 
-        #print 'Found %i points in polygon %i' % (len(indices), i)
+    result = []
+    for indices in indices_inside:
 
         # Aggregate numbers
         if aggregation_function == 'count':
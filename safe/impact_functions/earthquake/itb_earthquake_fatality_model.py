@@ -165,6 +165,16 @@ class ITBFatalityFunction(FunctionProvider):
             ('MinimumNeeds', {'on': True})])),
         ('minimum needs', default_minimum_needs())])
 
+    # Model coefficients that determine the fatality rate curve
+    rate_parameters = ['x', 'y']
+
+    # Sampling of the fatality rate curve used by fatality_rates.
+    # Breakpoints are MMI values where the rate curve jumps. They are
+    # sampled on both sides so the jump is not smeared by interpolation.
+    rate_table_range = (1.0, 12.0)
+    rate_table_step = 0.001
+    rate_table_breakpoints = [4]
+
     def fatality_rate(self, mmi):
         """
         ITB method to compute fatality rate
@@ -179,6 +189,72 @@ class ITBFatalityFunction(FunctionProvider):
         y = self.parameters['y']
         return numpy.power(10.0, x * mmi - y)
 
+    def fatality_rate_table(self):
+        """Fatality rate curve sampled for the current model coefficients
+
+        :returns: Two arrays (mmi, rate) with fatality_rate(mmi) sampled
+            every rate_table_step over rate_table_range and immediately
+            either side of each of rate_table_breakpoints.
+
+        Tables are computed once per set of coefficients and cached.
+        """
+
+        key = tuple(self.parameters[name] for name in self.rate_parameters)
+        if not hasattr(self, 'rate_tables'):
+            self.rate_tables = {}
+
+        if key not in self.rate_tables:
+            mmi_min, mmi_max = self.rate_table_range
+            number_of_samples = int(round((mmi_max - mmi_min) /
+                                          self.rate_table_step)) + 1
+            mmi = numpy.linspace(mmi_min, mmi_max, number_of_samples)
+            for breakpoint in self.rate_table_breakpoints:
+                mmi = mmi[numpy.abs(mmi - breakpoint) > 1.0e-6]
+                mmi = numpy.concatenate([mmi, [breakpoint - 1.0e-9,
+                                               breakpoint]])
+            mmi.sort()
+            rate = numpy.array([self.fatality_rate(m) for m in mmi])
+            self.rate_tables[key] = (mmi, rate)
+
+        return self.rate_tables[key]
+
+    def fatality_rates(self, mmi):
+        """Fatality rates for continuous MMI values
+
+        :param mmi: Scalar or array (e.g. a whole grid) of MMI values.
+        :type mmi: numpy.ndarray, float
+
+        :returns: Array of same shape as mmi with fatality rates looked up
+            by linear interpolation in fatality_rate_table. MMI values
+            outside the table get the rate at the nearest end and NaN
+            values remain NaN.
+        :rtype: numpy.ndarray
+        """
+
+        table_mmi, table_rate = self.fatality_rate_table()
+
+        mmi = numpy.asarray(mmi, dtype=numpy.float64)
+        rates = numpy.interp(mmi.ravel(), table_mmi, table_rate)
+        rates = rates.reshape(mmi.shape)
+        rates[numpy.isnan(mmi)] = numpy.nan
+
+        return rates
+
+    def fatalities(self, mmi, population):
+        """Expected fatalities per cell for continuous MMI
+
+        :param mmi: Grid of MMI values
+        :type mmi: numpy.ndarray
+
+        :param population: Grid of people per cell, same shape as mmi
+        :type population: numpy.ndarray
+
+        :returns: Grid of expected number of fatalities per cell
+        :rtype: numpy.ndarray
+        """
+
+        return self.fatality_rates(mmi) * population
+
     def run(self, layers):
         """Indonesian Earthquake Fatality Model
 
@@ -73,6 +73,10 @@ class PAGFatalityFunction(ITBFatalityFunction):
             ('MinimumNeeds', {'on': True})])),
         ('minimum needs', default_needs)])
 
+    # Model coefficients that determine the fatality rate curve
+    rate_parameters = ['Theta', 'Beta']
+    rate_table_breakpoints = []
+
     def fatality_rate(self, mmi):
         """Pager method to compute fatality rate"""
 
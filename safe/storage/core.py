@@ -16,16 +16,31 @@ import logging
 logger = logging.getLogger('inasafe')
 
 
-def read_layer(filename):
+def read_layer(filename, bbox=None, fields=None, cache=None):
     """Read spatial layer from file.
     This can be either raster or vector data.
+
+    Args:
+        * filename: Name of raster or vector file
+        * bbox: Optional bounding box [West, South, East, North]. Only
+            vector features intersecting it are read.
+        * fields: Optional list of vector attribute names to read.
+        * cache: Optional cache for parsed vector data. True to keep cache
+            files next to the vector file or name of a cache directory.
+
+    Note:
+        bbox, fields and cache apply to vector data only. See
+        Vector.read_from_file for details.
     """
 
     _, ext = os.path.splitext(filename)
     if ext in ['.asc', '.tif', '.nc']:
+        msg = ('Bounding box and fields can only be specified when reading '
+               'vector data. I got raster file %s' % filename)
+        verify(bbox is None and fields is None, msg)
         return Raster(filename)
     elif ext in ['.shp', '.sqlite']:
-        return Vector(filename)
+        return Vector(filename, bbox=bbox, fields=fields, cache=cache)
     else:
         msg = ('Could not read %s. '
                'Extension "%s" has not been implemented' % (filename, ext))
@@ -1,5 +1,9 @@
 # Geometry types
 
+import numpy
+
+from safe.common.utilities import verify
+
 
 class Geometry:
     """Common class for geometries
@@ -28,3 +32,316 @@ class Polygon(Geometry):
         s = 'Polygon(%s, inner_rings=%s' % (self.outer_ring,
                                             self.inner_rings)
         return s
+
+
+class PackedGeometry(Geometry):
+    """Polygons or lines packed into flat arrays
+
+    All vertices are stored in one array. Rings are consecutive ranges of
+    vertices and features are consecutive ranges of rings.
+
+    Args:
+        * coordinates: Mx2 array of vertex coordinates lon, lat
+        * ring_offsets: Array of R + 1 increasing indices into coordinates.
+            Ring r has vertices coordinates[ring_offsets[r]:ring_offsets[r+1]]
+        * feature_offsets: Array of N + 1 increasing indices into the rings.
+            Feature i has rings feature_offsets[i]:feature_offsets[i + 1].
+            For polygons the first is the outer ring and the others are
+            inner rings. Lines have one ring each.
+        * geometry_type: 'polygon' or 'line'
+
+    Note:
+        Features are handed out as views into coordinates, i.e. Polygon
+        instances for polygons and Nx2 arrays for lines, so vertices are
+        never copied. Use pack_polygons or pack_lines to create instances
+        from lists of geometries.
+
+        Bounding boxes, areas and centroids refer to the outer rings and
+        are computed for all features at once.
+    """
+
+    def __init__(self, coordinates, ring_offsets, feature_offsets,
+                 geometry_type='polygon'):
+
+        self.coordinates = numpy.array(coordinates, dtype='d', copy=False)
+        self.ring_offsets = numpy.array(ring_offsets, dtype=numpy.int_,
+                                        copy=False)
+        self.feature_offsets = numpy.array(feature_offsets,
+                                           dtype=numpy.int_, copy=False)
+        self.geometry_type = geometry_type
+
+        msg = ('Geometry type must be either "polygon" or "line". '
+               'I got %s' % geometry_type)
+        verify(geometry_type in ['polygon', 'line'], msg)
+
+        msg = ('Coordinates must be an Mx2 array. I got shape %s'
+               % str(self.coordinates.shape))
+        verify(len(self.coordinates.shape) == 2 and
+               self.coordinates.shape[1] == 2, msg)
+
+        msg = 'Ring offsets must span all coordinates'
+        verify(self.ring_offsets[0] == 0, msg)
+        verify(self.ring_offsets[-1] == len(self.coordinates), msg)
+
+        msg = 'Feature offsets must span all rings'
+        verify(self.feature_offsets[0] == 0, msg)
+        verify(self.feature_offsets[-1] == len(self.ring_offsets) - 1, msg)
+
+        starts, stops = self._outer_ring_ranges()
+        msg = 'Each feature must have an outer ring with vertices'
+        verify(numpy.all(stops > starts), msg)
+
+        # Computed when first needed
+        self._bboxes = None
+
+    def __len__(self):
+        """Number of features
+        """
+        return len(self.feature_offsets) - 1
+
+    def __getitem__(self, i):
+        """Polygon or line feature i as a view into the packed arrays
+        """
+
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('Feature index %i out of range' % i)
+
+        if self.geometry_type == 'polygon':
+            return self.get_polygon(i)
+        else:
+            return self.get_ring(self.feature_offsets[i])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return ('PackedGeometry(%i %s features, %i rings, %i vertices)'
+                % (len(self), self.geometry_type,
+                   len(self.ring_offsets) - 1, len(self.coordinates)))
+
+    def _outer_ring_ranges(self):
+        """Start and stop indices into coordinates of each outer ring
+        """
+
+        first_rings = self.feature_offsets[:-1]
+        return (self.ring_offsets[first_rings],
+                self.ring_offsets[first_rings + 1])
+
+    def _sum_outer_rings(self, terms):
+        """Sum terms over the edges of each outer ring
+
+        Args:
+            * terms: Array of M - 1 values. Entry k belongs to the edge
+                from vertex k to vertex k + 1.
+
+        Returns:
+            * Array with one sum for each feature
+        """
+
+        starts, stops = self._outer_ring_ranges()
+        if len(starts) == 0:
+            return numpy.zeros(0)
+
+        # Pairs of (first edge, last edge + 1) for numpy.add.reduceat
+        # which requires indices to be within the array
+        indices = numpy.zeros(2 * len(starts), dtype=numpy.int_)
+        indices[0::2] = starts
+        indices[1::2] = stops - 1
+        terms = numpy.concatenate((terms, [0.0]))
+        sums = numpy.add.reduceat(terms, indices)[0::2]
+
+        # Rings with one vertex have no edges
+        return numpy.where(stops - 1 > starts, sums, 0.0)
+
+    def get_ring(self, r):
+        """Vertices of ring r as a view into the coordinates
+        """
+        return self.coordinates[self.ring_offsets[r]:self.ring_offsets[r + 1]]
+
+    def get_rings(self, i):
+        """List of rings of feature i, outer ring first
+        """
+        return [self.get_ring(r) for r in range(self.feature_offsets[i],
+                                                self.feature_offsets[i + 1])]
+
+    def get_polygon(self, i):
+        """Feature i as a Polygon instance holding views of its rings
+        """
+
+        rings = self.get_rings(i)
+        return Polygon(outer_ring=rings[0], inner_rings=rings[1:])
+
+    def get_outer_rings(self):
+        """List of outer rings of all features (the lines for line data)
+        """
+
+        starts, stops = self._outer_ring_ranges()
+        return [self.coordinates[start:stop]
+                for start, stop in zip(starts.tolist(), stops.tolist())]
+
+    def get_bboxes(self):
+        """Bounding boxes of all features
+
+        Returns:
+            * Nx4 array with rows [minx, maxx, miny, maxy] as used in
+              safe.common.polygon. It is computed once and cached.
+        """
+
+        if self._bboxes is not None:
+            return self._bboxes
+
+        starts, stops = self._outer_ring_ranges()
+        bboxes = numpy.zeros((len(starts), 4))
+        if len(starts) > 0:
+            # Pairs of (start, stop) for reduceat as in _sum_outer_rings
+            indices = numpy.zeros(2 * len(starts), dtype=numpy.int_)
+            indices[0::2] = starts
+            indices[1::2] = stops
+            for k in [0, 1]:
+                values = numpy.concatenate((self.coordinates[:, k], [0.0]))
+                bboxes[:, 2 * k] = numpy.minimum.reduceat(values,
+                                                          indices)[0::2]
+                bboxes[:, 2 * k + 1] = numpy.maximum.reduceat(values,
+                                                              indices)[0::2]
+
+        self._bboxes = bboxes
+        return bboxes
+
+    def get_areas(self, signed=False):
+        """Areas of all features
+
+        Args:
+            * signed: If True areas of clockwise outer rings are negative
+
+        Returns:
+            * Array with one area for each feature computed from its outer
+              ring as in safe.storage.utilities.calculate_polygon_area
+        """
+
+        x = self.coordinates[:, 0]
+        y = self.coordinates[:, 1]
+
+        # 0.5 sum_{i=0}^{N-1} (x_i y_{i+1} - x_{i+1} y_i) for each ring
+        A = self._sum_outer_rings(x[:-1] * y[1:] - y[:-1] * x[1:]) / 2.
+
+        if signed:
+            return A
+        else:
+            return abs(A)
+
+    def get_centroids(self):
+        """Centroids of all features
+
+        Returns:
+            * Nx2 array with one centroid for each feature computed from its
+              outer ring as in
+              safe.storage.utilities.calculate_polygon_centroid
+        """
+
+        N = len(self)
+        if N == 0:
+            return numpy.zeros((0, 2))
+
+        # Normalise each feature to the lower left corner of its bounding
+        # box for numerical accuracy
+        bboxes = self.get_bboxes()
+        origins = bboxes[:, [0, 2]]
+        vertex_counts = (self.ring_offsets[self.feature_offsets[1:]] -
+                         self.ring_offsets[self.feature_offsets[:-1]])
+        P = self.coordinates - numpy.repeat(origins, vertex_counts, axis=0)
+
+        A = self.get_areas(signed=True)
+
+        x = P[:, 0]
+        y = P[:, 1]
+
+        # Cx = sum_{i=0}^{N-1} (x_i + x_{i+1})(x_i y_{i+1} - x_{i+1} y_i)/(6A)
+        # Cy = sum_{i=0}^{N-1} (y_i + y_{i+1})(x_i y_{i+1} - x_{i+1} y_i)/(6A)
+        d = x[:-1] * y[1:] - y[:-1] * x[1:]
+        Cx = self._sum_outer_rings((x[:-1] + x[1:]) * d) / (6. * A)
+        Cy = self._sum_outer_rings((y[:-1] + y[1:]) * d) / (6. * A)
+
+        # Translate back to real location
+        return numpy.array([Cx, Cy]).T + origins
+
+    def copy(self):
+        """Return copy of packed geometry with its own arrays
+        """
+
+        return PackedGeometry(self.coordinates.copy(),
+                              self.ring_offsets.copy(),
+                              self.feature_offsets.copy(),
+                              geometry_type=self.geometry_type)
+
+
+def pack_polygons(polygons):
+    """Pack polygons into one PackedGeometry
+
+    Args:
+        * polygons: List of Polygon instances or Nx2 arrays of vertices
+
+    Returns:
+        * PackedGeometry instance with geometry_type 'polygon'
+    """
+
+    rings = []
+    ring_counts = []
+    for polygon in polygons:
+        if isinstance(polygon, Polygon):
+            rings.append(polygon.outer_ring)
+            rings.extend(polygon.inner_rings)
+            ring_counts.append(1 + len(polygon.inner_rings))
+        else:
+            rings.append(polygon)
+            ring_counts.append(1)
+
+    return pack_rings(rings, ring_counts, geometry_type='polygon')
+
+
+def pack_lines(lines):
+    """Pack lines into one PackedGeometry
+
+    Args:
+        * lines: List of Nx2 arrays of vertices
+
+    Returns:
+        * PackedGeometry instance with geometry_type 'line'
+    """
+
+    return pack_rings(lines, [1] * len(lines), geometry_type='line')
+
+
+def pack_rings(rings, ring_counts, geometry_type='polygon'):
+    """Pack rings into one PackedGeometry
+
+    Args:
+        * rings: List of Nx2 arrays of vertices
+        * ring_counts: Number of consecutive rings in each feature
+        * geometry_type: 'polygon' or 'line'
+
+    Returns:
+        * PackedGeometry instance
+    """
+
+    arrays = []
+    for ring in rings:
+        A = numpy.array(ring, dtype='d', copy=False)
+        msg = ('Rings must be Nx2 arrays of vertices. I got shape %s'
+               % str(A.shape))
+        verify(len(A.shape) == 2 and A.shape[1] == 2, msg)
+        arrays.append(A)
+
+    if len(arrays) > 0:
+        coordinates = numpy.concatenate(arrays)
+    else:
+        coordinates = numpy.zeros((0, 2))
+
+    lengths = [len(A) for A in arrays]
+    ring_offsets = numpy.concatenate(([0], numpy.cumsum(lengths)))
+    feature_offsets = numpy.concatenate(([0], numpy.cumsum(ring_counts)))
+
+    return PackedGeometry(coordinates, ring_offsets, feature_offsets,
+                          geometry_type=geometry_type)
@@ -33,6 +33,7 @@ class Raster(Layer):
         * data: Can be either
             * a filename of a raster file format known to GDAL
             * an MxN array of raster data
+            * a BxMxN array of raster data with B bands
             * None (FIXME (Ole): Don't think we need this option)
         * projection: Geospatial reference in WKT format.
             Only used if data is provide as a numeric array,
@@ -80,11 +81,15 @@ class Raster(Layer):
                        keywords=keywords,
                        style_info=style_info)
 
+        # Grid kept by get_data(shared=True)
+        self.clear_data_cache()
+
         # Input checks
         if data is None:
             # Instantiate empty object
             self.geotransform = None
             self.rows = self.columns = 0
+            self.number_of_bands = 0
             return
 
         # Initialisation
@@ -103,10 +108,15 @@ class Raster(Layer):
                 check_geotransform(geotransform)
             self.geotransform = geotransform
 
-            self.rows = data.shape[0]
-            self.columns = data.shape[1]
-
-            self.number_of_bands = 1
+            if len(self.data.shape) == 3:
+                # Stack of bands
+                self.number_of_bands = self.data.shape[0]
+                self.rows = self.data.shape[1]
+                self.columns = self.data.shape[2]
+            else:
+                self.number_of_bands = 1
+                self.rows = self.data.shape[0]
+                self.columns = self.data.shape[1]
 
             # We assume internal numpy layers are using nan correctly
             # FIXME (Ole): If read from file is refactored to load the data
@@ -122,7 +132,7 @@ class Raster(Layer):
     def __len__(self):
         """Size of data set defined as total number of grid points
         """
-        return len(self.get_data().flat)
+        return self.rows * self.columns
 
     def __eq__(self, other, rtol=1.0e-5, atol=1.0e-8):
         """Override '==' to allow comparison with other raster objecs
@@ -164,6 +174,9 @@ class Raster(Layer):
         """Read and unpack raster data
         """
 
+        # Forget data decoded from any previous source
+        self.clear_data_cache()
+
         # Open data file for reading
         # File must be kept open, otherwise GDAL methods segfault.
         fid = self.fid = gdal.Open(filename, gdal.GA_ReadOnly)
@@ -217,16 +230,8 @@ class Raster(Layer):
         self.rows = fid.RasterYSize
         self.number_of_bands = fid.RasterCount
 
-        # Assume that file contains all data in one band
-        msg = 'Only one raster band currently allowed'
-        if self.number_of_bands > 1:
-            msg = ('WARNING: Number of bands in %s are %i. '
-                   'Only the first band will currently be '
-                   'used.' % (filename, self.number_of_bands))
-            # FIXME(Ole): Let us use python warnings here
-            raise ReadLayerError(msg)
-
-        # Get first band.
+        # Get first band. Further bands are only used by get_data(band=...)
+        # and get_bands()
         band = self.band = fid.GetRasterBand(1)
         if band is None:
             msg = 'Could not read raster band from %s' % filename
@@ -253,17 +258,17 @@ class Raster(Layer):
         file_format = DRIVER_MAP[extension]
 
         # Get raster data
-        A = self.get_data()
+        A = self.get_bands()
 
         # Get Dimensions. Note numpy and Gdal swap order
-        N, M = A.shape
+        B, N, M = A.shape
 
         # Create empty file.
         # FIXME (Ole): It appears that this is created as single
         #              precision even though Float64 is specified
         #              - see issue #17
         driver = gdal.GetDriverByName(file_format)
-        fid = driver.Create(filename, M, N, 1, gdal.GDT_Float64)
+        fid = driver.Create(filename, M, N, B, gdal.GDT_Float64)
         if fid is None:
             msg = ('Gdal could not create filename %s using '
                    'format %s' % (filename, file_format))
@@ -276,14 +281,17 @@ class Raster(Layer):
         fid.SetGeoTransform(self.geotransform)
 
         # Write data
-        fid.GetRasterBand(1).WriteArray(A)
-        fid.GetRasterBand(1).SetNoDataValue(self.get_nodata_value())
+        for i in range(B):
+            fid.GetRasterBand(i + 1).WriteArray(A[i])
+            fid.GetRasterBand(i + 1).SetNoDataValue(
+                self.get_nodata_value(band=i + 1))
         fid = None  # Close
 
         # Write keywords if any
         write_keywords(self.keywords, basename + '.keywords')
 
-    def get_data(self, nan=True, scaling=None, copy=False):
+    def get_data(self, nan=True, scaling=None, copy=False, window=None,
+                 band=1, shared=False):
         """Get raster data as numeric array
 
         Args:
@@ -316,67 +324,174 @@ class Raster(Layer):
 
             * copy (optional): If present and True return copy
 
+            * window (optional): Tuple (col, row, ncols, nrows) of pixel
+                                 offsets and sizes. If given, only that
+                                 part of the grid is returned and, for
+                                 layers read from file, only that part
+                                 is read from disk.
+
+            * band (optional): Number of band to get, counting from 1.
+                               Default is the first band. See also
+                               get_bands.
+
+            * shared (optional): If True the returned array may be shared
+                                 with the layer and is read only. The
+                                 decoded grid is then kept so that the
+                                 next call with the same band, nan and
+                                 scaling does not read and decode the
+                                 data again. Only the most recently
+                                 decoded grid is kept. If False (default)
+                                 a new writable array is returned.
+
         Note:
             Scaling does not currently work with projected layers.
             See issue #123
         """
 
-        if hasattr(self, 'data') and self.data is not None:
-            # Return internal data grid
-            if copy:
+        if window is not None:
+            col, row, ncols, nrows = [int(w) for w in window]
+            msg = ('Window %s is not within raster of %i columns and %i rows'
+                   % (str(window), self.columns, self.rows))
+            verify(col >= 0 and row >= 0 and ncols > 0 and nrows > 0, msg)
+            verify(col + ncols <= self.columns, msg)
+            verify(row + nrows <= self.rows, msg)
+        else:
+            col, row, ncols, nrows = 0, 0, self.columns, self.rows
 
-                A = copy_module.deepcopy(self.data)
-            else:
-                A = self.data
-            verify(A.shape[0] == self.rows and A.shape[1] == self.columns)
+        msg = ('Band %s does not exist in raster %s with %i band(s)'
+               % (str(band), self.get_name(), self.number_of_bands))
+        verify(1 <= band <= self.number_of_bands, msg)
 
+        NAN, sigma, key = self._get_decoding(nan, scaling, band)
+
+        # Grid decoded by an earlier shared request
+        if self._decoded_data is not None and self._decoded_key == key:
+            A = self._decoded_data
+            if window is not None:
+                A = A[row:row + nrows, col:col + ncols]
+            if copy or not shared:
+                A = A.copy()
+            return A
+
+        if shared and not copy and window is None:
+            # Free grid decoded earlier before decoding a new one
+            self.clear_data_cache()
+
+        if hasattr(self, 'data') and self.data is not None:
+            # Internal data grid. It is copied only if it must be changed.
+            A = self.data
+            if len(A.shape) == 3:
+                A = A[band - 1]
+            verify(A.shape[0] == self.rows and A.shape[1] == self.columns)
+            if window is not None:
+                A = A[row:row + nrows, col:col + ncols]
+            private = False
         else:
-            # Force garbage collection to free up any memory we can (TS)
-            gc.collect()
+            if window is None:
+                # Force garbage collection to free up any memory we can (TS)
+                gc.collect()
 
             # Read from raster file
             # FIXME: This can be slow so should be moved to read_from_file
-            A = self.band.ReadAsArray()
+            A = self.get_band(band).ReadAsArray(col, row, ncols, nrows)
 
             # Convert to double precision (issue #75)
-            A = numpy.array(A, dtype=numpy.float64)
+            A = numpy.array(A, dtype=numpy.float64, copy=False)
+            private = True
 
             # Self check
             M, N = A.shape
             msg = ('Dimensions of raster array do not match those of '
                    'raster file %s' % self.filename)
-            verify(M == self.rows, msg)
-            verify(N == self.columns, msg)
+            verify(M == nrows, msg)
+            verify(N == ncols, msg)
 
         # Handle no data value
         # FIXME (Ole): This only pertains to data read from file
         # and should be moved to read_from_file.
-        nodata = self.get_nodata_value()
+        nodata = self.get_nodata_value(band=band)
+        if NAN is not None and not numpy.isnan(nodata):
+            # Replace NODATA_VALUE with NaN in place
+            mask = A == nodata
+            if mask.any():
+                if not private:
+                    A = A.copy()
+                    private = True
+                A[mask] = NAN
+            del mask
+
+        # Take care of possible scaling
+        if sigma != 1:
+            if private:
+                A *= sigma
+            else:
+                A = sigma * A
+                private = True
+
+        if not private:
+            if copy or not shared:
+                A = A.copy()
+            else:
+                # Share internal data grid as read only view
+                A = A.view()
+                A.flags.writeable = False
+        elif shared and not copy and window is None:
+            # Keep decoded grid for later shared requests replacing any
+            # grid decoded earlier
+            A.flags.writeable = False
+            self._decoded_key = key
+            self._decoded_data = A
+
+        return A
+
+    def _get_decoding(self, nan, scaling, band):
+        """Get how data is decoded in get_data
+
+        Args:
+            * nan, scaling, band: See get_data
+
+        Returns:
+            * NAN: Value replacing nodata or None if it is kept
+            * sigma: Scaling factor
+            * key: Key identifying the decoded grid
+        """
 
         # Must explicit comparison to False and True as nan can be a number
         # so 0 would evaluate to False and e.g. 1 to True.
         if nan is False:
             # No change
-            pass
+            NAN = None
+        elif nan is True:
+            NAN = numpy.nan  # Use numpy's nan value
         else:
-            # Nan value should be changed
-            if nan is True:
-                NAN = numpy.nan  # Use numpy's nan value
-            else:
-                try:
-                    # Use user specified number
-                    NAN = float(nan)
-                except (ValueError, TypeError):
-                    msg = ('Argument nan must be either True, False or a '
-                           'number. I got "nan=%s"' % str(nan))
-                    raise InaSAFEError(msg)
-
-            # Replace NODATA_VALUE with NaN array
-            #print 'Replacing', nodata, 'with', NAN
-            NaN = numpy.ones(A.shape, A.dtype) * NAN
-            A = numpy.where(A == nodata, NaN, A)
+            try:
+                # Use user specified number
+                NAN = float(nan)
+            except (ValueError, TypeError):
+                msg = ('Argument nan must be either True, False or a '
+                       'number. I got "nan=%s"' % str(nan))
+                raise InaSAFEError(msg)
+
+        sigma = self._get_scaling_factor(scaling)
+
+        # NaN can not be compared as it is not equal to itself
+        if NAN is not None and numpy.isnan(NAN):
+            key = (band, 'nan', sigma)
+        else:
+            key = (band, NAN, sigma)
+
+        return NAN, sigma, key
+
+    def _get_scaling_factor(self, scaling):
+        """Get factor by which data is scaled in get_data
+
+        Args:
+            * scaling: See get_data
+
+        Returns:
+            * Scaling factor sigma. It is 1 if data is not to be scaled.
+        """
 
-        # Take care of possible scaling
         if scaling is None:
             # Redefine scaling from density keyword if possible
             kw = self.get_keywords()
@@ -408,8 +523,62 @@ class Raster(Layer):
                        'number: %s' % (scaling, str(e)))
                 raise GetDataError(msg)
 
-        # Return possibly scaled data
-        return sigma * A
+        return sigma
+
+    def clear_data_cache(self):
+        """Forget grid kept by get_data
+
+        Note:
+            get_data(shared=True) keeps the most recently decoded grid so
+            that repeated calls do not decode the data again. Call this to
+            free the memory or after the underlying data has been changed.
+        """
+
+        self._decoded_key = None
+        self._decoded_data = None
+
+    def get_bands(self, nan=True, scaling=None, window=None):
+        """Get all raster bands as one numeric array
+
+        Args:
+            * nan, scaling, window: See get_data
+
+        Returns:
+            * BxMxN array of B bands each with M rows and N columns.
+              The array is always a new copy.
+        """
+
+        B = self.number_of_bands
+        A = None
+        for i in range(B):
+            data = self.get_data(nan=nan, scaling=scaling, window=window,
+                                 band=i + 1)
+            if A is None:
+                A = numpy.zeros((B,) + data.shape, dtype=data.dtype)
+            A[i] = data
+
+        return A
+
+    def get_band(self, band=1):
+        """Get GDAL band of raster read from file
+
+        Args:
+            * band: Number of band counting from 1
+
+        Returns:
+            * GDAL raster band object
+        """
+
+        if band == 1:
+            return self.band
+
+        band_object = self.fid.GetRasterBand(band)
+        if band_object is None:
+            msg = ('Could not read raster band %i from %s'
+                   % (band, self.filename))
+            raise GetDataError(msg)
+
+        return band_object
 
     def get_geotransform(self, copy=False):
         """Return geotransform for this raster layer
@@ -430,6 +599,70 @@ class Raster(Layer):
         else:
             return self.geotransform
 
+    def get_block_size(self):
+        """Get natural block size of raster as a 2-tuple (ncols, nrows)
+
+        Note:
+            For layers read from file this is the block size reported by
+            GDAL, i.e. the size of the chunks in which the file is stored.
+            Reading whole blocks is the most efficient way of accessing
+            parts of the grid. For layers held in memory the whole grid
+            is one block.
+        """
+
+        if hasattr(self, 'band'):
+            ncols, nrows = self.band.GetBlockSize()
+        else:
+            ncols, nrows = self.columns, self.rows
+
+        return int(ncols), int(nrows)
+
+    def iter_blocks(self, nan=True, scaling=None, band=1, window_cells=None):
+        """Iterate over raster data one block at a time
+
+        Args:
+            * nan, scaling, band: See get_data
+            * window_cells: Optional approximate number of grid cells in
+                  each block. If given, consecutive rows of natural blocks
+                  are combined into windows of about that size. This is
+                  useful for files stored in strips of single rows.
+                  Default is to use the natural block size.
+
+        Returns:
+            * Generator of tuples (window, geotransform, A) where window
+              is (col, row, ncols, nrows) as used by get_data, geotransform
+              is the GDAL geotransform of the block and A is its nrows x
+              ncols array of data with nodata handled as in get_data.
+
+        Note:
+            Blocks are aligned to the natural block size of the raster as
+            reported by get_block_size and are visited row by row from the
+            top left corner. Only one block is held in memory at a time
+            for layers read from file.
+        """
+
+        block_cols, block_rows = self.get_block_size()
+        block_cols = max(1, min(block_cols, self.columns))
+        block_rows = max(1, min(block_rows, self.rows))
+        if window_cells is not None:
+            factor = max(1, int(window_cells) // (block_cols * block_rows))
+            block_rows = min(self.rows, block_rows * factor)
+
+        g = self.get_geotransform()
+        for row in range(0, self.rows, block_rows):
+            nrows = min(block_rows, self.rows - row)
+            for col in range(0, self.columns, block_cols):
+                ncols = min(block_cols, self.columns - col)
+                window = (col, row, ncols, nrows)
+
+                # Move origin to top left corner of block
+                geotransform = (g[0] + col * g[1] + row * g[2], g[1], g[2],
+                                g[3] + col * g[4] + row * g[5], g[4], g[5])
+
+                A = self.get_data(nan=nan, scaling=scaling, window=window,
+                                  band=band)
+                yield window, geotransform, A
+
     def get_geometry(self):
         """Return longitudes and latitudes (the axes) for grid.
 
@@ -463,7 +696,12 @@ class Raster(Layer):
         This copy will be equal to self in the sense defined by __eq__
         """
 
-        return Raster(data=self.get_data(copy=True),
+        if self.number_of_bands > 1:
+            data = self.get_bands(nan=False, scaling=False)
+        else:
+            data = self.get_data(copy=True)
+
+        return Raster(data=data,
                       geotransform=self.get_geotransform(copy=True),
                       projection=self.get_projection(),
                       keywords=self.get_keywords())
@@ -490,15 +728,18 @@ class Raster(Layer):
 
         return Amin, Amax
 
-    def get_nodata_value(self):
+    def get_nodata_value(self, band=1):
         """Get the internal representation of NODATA
 
+        Args:
+            * band: Number of band counting from 1
+
         Note:
             If the internal value is None, the standard -9999 is assumed
         """
 
         if hasattr(self, 'band'):
-            nodata = self.band.GetNoDataValue()
+            nodata = self.get_band(band).GetNoDataValue()
 
             # FIXME (Ole): Too hacky, but probably the reality
             if nodata is None:
@@ -603,18 +844,36 @@ class Raster(Layer):
         # Return either 2-tuple or scale depending on isotropic
         return res
 
-    def to_vector_points(self):
+    def to_vector_points(self, lazy=False):
         """Convert raster grid to vector point data
 
+        Args:
+            * lazy: If True, coordinates are returned as a GridPoints
+                    instance which computes them on demand and supports
+                    indexing and chunked iteration (see safe.common.numerics)
+
         Returns:
            * coordinates: Nx2 array of x, y (lon, lat) coordinates
            * values: N array of corresponding grid values
+
+        Note:
+            If get_data(shared=True) has kept the grid, only the values
+            are copied from it. Otherwise the values are a view of a new
+            grid and nothing is kept by the layer.
         """
 
         # Convert grid data to point data
-        A = self.get_data()
+        _, _, key = self._get_decoding(True, None, 1)
+        kept = self._decoded_data is not None and self._decoded_key == key
+        if kept:
+            A = self._decoded_data
+        else:
+            A = self.get_data()
         x, y = self.get_geometry()
-        P, V = grid_to_points(A, x, y)
+        P, V = grid_to_points(A, x, y, lazy=lazy)
+
+        if kept:
+            V = V.copy()
 
         return P, V
 
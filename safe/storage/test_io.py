@@ -28,7 +28,7 @@ from core import get_bounding_box
 from core import bboxlist2string, bboxstring2list
 from core import check_bbox_string
 from utilities_test import same_API
-from geometry import Polygon
+from geometry import Polygon, PackedGeometry, pack_polygons, pack_lines
 from safe.common.numerics import nan_allclose
 from safe.common.testing import TESTDATA, HAZDATA, DATADIR
 from safe.common.testing import FEATURE_COUNTS
@@ -754,6 +754,142 @@ class Test_IO(unittest.TestCase):
         assert V_tmp == V_new
         assert not V_tmp != V_new
 
+    def test_vector_columns(self):
+        """Vector attributes can be used as columns
+        """
+
+        filename = '%s/%s' % (TESTDATA, 'test_buildings.shp')
+        V = read_layer(filename)
+        N = len(V)
+
+        # Columns are returned without copying
+        area = V.get_column('FLOOR_AREA')
+        assert isinstance(area, numpy.ndarray)
+        assert area.shape == (N,)
+        assert V.get_column('FLOOR_AREA') is area
+        assert V.get_column('FLOOR_AREA', copy=True) is not area
+        assert numpy.allclose(area, V.get_data('FLOOR_AREA'))
+        assert V.get_data('FLOOR_AREA', 3) == area[3]
+
+        # Add column and check that it appears in all views
+        V.add_column('AREA2', 2 * area)
+        assert 'AREA2' in V.get_attribute_names()
+        assert numpy.allclose(V.get_data('AREA2'), 2 * area)
+
+        data = V.get_data()
+        assert len(data) == N
+        for i in range(N):
+            assert numpy.allclose(data[i]['AREA2'], 2 * area[i])
+
+        # Changes to the list of dictionaries are seen by the layer
+        data[0]['FLOOR_AREA'] = -1.0
+        assert V.get_data('FLOOR_AREA', 0) == -1.0
+        assert V.get_column('FLOOR_AREA')[0] == -1.0
+
+        # and the list stays the data of the layer when columns are used
+        V.add_column('AREA3', 3 * area)
+        assert data[1]['AREA3'] == 3 * area[1]
+        data[2]['AREA3'] = -3.0
+        assert V.get_column('AREA3')[2] == -3.0
+        assert V.get_data() is data
+
+        # Setting the data again stores it column wise
+        V.data = data
+        assert V.get_column('AREA3') is V.get_column('AREA3')
+        assert V.get_column('AREA3')[2] == -3.0
+
+        # Wrong number of values
+        try:
+            V.add_column('BAD', area[1:])
+        except VerificationError:
+            pass
+        else:
+            msg = 'Wrong number of values should have raised an exception'
+            raise Exception(msg)
+
+        # Create layer from columns
+        geometry = [[0.0, 0.0], [1.0, 0.0], [2.0, 1.0]]
+        V = Vector(data={'ID': [1, 2, 3],
+                         'NAME': ['a', 'b', None],
+                         'DEPTH': numpy.array([0.5, 1.0, 2.0])},
+                   geometry=geometry)
+        assert V.get_column('ID').dtype == numpy.int_
+        assert V.get_column('NAME').dtype == object
+        assert V.get_column('DEPTH').dtype == numpy.float64
+        assert V.get_data() == [{'ID': 1, 'NAME': 'a', 'DEPTH': 0.5},
+                                {'ID': 2, 'NAME': 'b', 'DEPTH': 1.0},
+                                {'ID': 3, 'NAME': None, 'DEPTH': 2.0}]
+        assert V == V.copy()
+
+        # Features with different attributes are kept as they are
+        data = [{'ID': 1}, {'NAME': 'b'}, {'ID': 3}]
+        V = Vector(data=data, geometry=geometry)
+        assert V.get_data() is data
+        V.add_column('DEPTH', numpy.array([0.5, 1.0, 2.0]))
+        assert data[1] == {'NAME': 'b', 'DEPTH': 1.0}
+
+    def test_read_vector_subset(self):
+        """Vector layers can be read for a bounding box and some attributes
+        """
+
+        filename = '%s/%s' % (TESTDATA, 'test_buildings.shp')
+        V = read_layer(filename)
+        assert V.is_point_data
+
+        # South west quarter of layer
+        W, S, E, N = V.get_bounding_box()
+        bbox = [W, S, (W + E) / 2, (S + N) / 2]
+
+        points = numpy.array(V.get_geometry())
+        inside = ((points[:, 0] >= bbox[0]) * (points[:, 0] <= bbox[2]) *
+                  (points[:, 1] >= bbox[1]) * (points[:, 1] <= bbox[3]))
+
+        R = read_layer(filename, bbox=bbox, fields=['FLOOR_AREA'])
+        assert 0 < len(R) < len(V)
+        assert len(R) == numpy.sum(inside)
+        assert numpy.allclose(R.get_geometry(), points[inside])
+        assert R.get_attribute_names() == ['FLOOR_AREA']
+        assert numpy.allclose(R.get_data('FLOOR_AREA'),
+                              V.get_column('FLOOR_AREA')[inside])
+
+        # Extent is that of the features read
+        r = R.get_bounding_box()
+        assert bbox[0] <= r[0] <= r[2] <= bbox[2]
+        assert bbox[1] <= r[1] <= r[3] <= bbox[3]
+
+        # Only bounding box or only fields
+        R = read_layer(filename, bbox=bbox)
+        assert len(R) == numpy.sum(inside)
+        assert (sorted(R.get_attribute_names()) ==
+                sorted(V.get_attribute_names()))
+
+        R = read_layer(filename, fields=[])
+        assert len(R) == len(V)
+        assert R.get_attribute_names() == []
+        assert R.get_bounding_box() == V.get_bounding_box()
+
+        # Invalid input
+        for kwargs in [{'fields': ['NO_SUCH_FIELD']},
+                       {'bbox': [E, S, W, N]},
+                       {'bbox': [W, S, E]}]:
+            try:
+                read_layer(filename, **kwargs)
+            except VerificationError:
+                pass
+            else:
+                msg = 'Invalid input %s should have failed' % kwargs
+                raise Exception(msg)
+
+        try:
+            read_layer(os.path.join(HAZDATA,
+                                    'Lembang_Earthquake_Scenario.asc'),
+                       bbox=bbox)
+        except VerificationError:
+            pass
+        else:
+            msg = 'Bounding box can not be used with raster layers'
+            raise Exception(msg)
+
     def test_reading_and_writing_of_vector_polygon_data(self):
         """Vector polygon data can be read and written correctly
         """
@@ -1515,6 +1651,24 @@ class Test_IO(unittest.TestCase):
         assert numpy.allclose(coordinates[:L:N, 1], latitudes[::-1])
         assert nan_allclose(A.flat[:], values)
 
+        # Lazy coordinates are the same
+        lazy_coordinates, lazy_values = R.to_vector_points(lazy=True)
+        assert numpy.allclose(numpy.array(lazy_coordinates), coordinates)
+        assert numpy.allclose(lazy_coordinates[:N, 0], longitudes)
+
+        # Values belong to the caller and no grid is kept by the layer
+        assert nan_allclose(lazy_values, values)
+        assert lazy_values.flags.writeable
+        assert R._decoded_data is None
+
+        # A grid kept by the layer is used without being changed
+        S = R.get_data(shared=True)
+        _, kept_values = R.to_vector_points(lazy=True)
+        assert nan_allclose(kept_values, values)
+        assert kept_values.flags.writeable
+        assert not numpy.may_share_memory(kept_values, S)
+        assert R.get_data(shared=True) is S
+
         # Generate vector layer
         V = R.to_vector_layer()
         geometry = V.get_geometry()
@@ -1716,6 +1870,116 @@ class Test_IO(unittest.TestCase):
                    % (str(D_bbox), str(D), str(L_bbox)))
             assert numpy.allclose(D_bbox, L_bbox), msg
 
+    def test_raster_iter_blocks(self):
+        """Raster data can be iterated over block by block
+        """
+
+        filename = os.path.join(HAZDATA, 'Lembang_Earthquake_Scenario.asc')
+        R = read_layer(filename)
+        A = R.get_data()
+        G = R.get_geotransform()
+        block_cols, block_rows = R.get_block_size()
+
+        for window_cells in [None, 1000]:
+            B = numpy.zeros(A.shape)
+            B[:] = -1
+            count = 0
+            for window, g, data in R.iter_blocks(window_cells=window_cells):
+                col, row, ncols, nrows = window
+                assert data.shape == (nrows, ncols)
+                if window_cells is None:
+                    assert col % block_cols == 0
+                    assert row % block_rows == 0
+
+                # Geotransform is that of the top left pixel of the block
+                assert numpy.allclose(g, [G[0] + col * G[1], G[1], G[2],
+                                          G[3] + row * G[5], G[4], G[5]])
+
+                # Blocks do not overlap
+                assert numpy.all(B[row:row + nrows, col:col + ncols] == -1)
+                B[row:row + nrows, col:col + ncols] = data
+                count += 1
+
+            if block_cols < R.columns or block_rows < R.rows:
+                assert count > 1
+            assert nan_allclose(A, B)
+
+        # Nodata handling is as in get_data
+        for window, g, data in R.iter_blocks(nan=0.0):
+            col, row, ncols, nrows = window
+            assert numpy.allclose(data, R.get_data(nan=0.0, window=window))
+
+        # Layers held in memory are one block
+        M = Raster(data=A, projection=R.get_projection(), geotransform=G)
+        blocks = list(M.iter_blocks())
+        assert len(blocks) == 1
+        window, g, data = blocks[0]
+        assert window == (0, 0, R.columns, R.rows)
+        assert numpy.allclose(g, G)
+        assert nan_allclose(data, A)
+
+    def test_raster_data_shared(self):
+        """Decoded raster data can be shared read only and is kept
+        """
+
+        filename = os.path.join(HAZDATA, 'Lembang_Earthquake_Scenario.asc')
+        R = read_layer(filename)
+
+        # By default get_data returns new writable arrays
+        A = R.get_data()
+        assert A.flags.writeable
+        assert R.get_data() is not A
+        B = R.get_data(nan=0.0)
+        B /= 100
+        assert numpy.allclose(R.get_data(nan=0.0), 100 * B)
+        assert numpy.allclose(B[~numpy.isnan(A)], A[~numpy.isnan(A)] / 100)
+        assert numpy.all(B[numpy.isnan(A)] == 0.0)
+
+        # Shared grids are read only and kept until another is decoded
+        S = R.get_data(shared=True)
+        assert not S.flags.writeable
+        assert nan_allclose(S, A)
+        assert R.get_data(shared=True) is S
+        assert R.get_data(nan=True, scaling=False, shared=True) is S
+
+        C = R.get_data(scaling=2, shared=True)
+        assert nan_allclose(C, 2 * A)
+        assert R.get_data(scaling=2, shared=True) is C
+        assert R.get_data(shared=True) is not S
+
+        # Copies and windows are taken from the kept grid
+        D = R.get_data(shared=True)
+        E = R.get_data(shared=True, copy=True)
+        assert E is not D
+        assert E.flags.writeable
+        E[:] = 0
+        assert nan_allclose(R.get_data(), A)
+        W = R.get_data(window=(1, 2, 3, 4))
+        assert W.flags.writeable
+        assert nan_allclose(W, A[2:6, 1:4])
+
+        # Clearing the cache forces data to be decoded again
+        R.clear_data_cache()
+        F = R.get_data(shared=True)
+        assert F is not D
+        assert nan_allclose(F, A)
+
+        # Data held in memory is shared as read only view unless changed
+        M = Raster(data=A.copy(), projection=R.get_projection(),
+                   geotransform=R.get_geotransform())
+        G = M.get_data(shared=True)
+        assert numpy.may_share_memory(G, M.data)
+        assert not G.flags.writeable
+        G = M.get_data(scaling=2, shared=True)
+        assert not numpy.may_share_memory(G, M.data)
+        assert nan_allclose(G, 2 * A)
+
+        # and copied otherwise
+        G = M.get_data(nan=0)
+        assert not numpy.may_share_memory(G, M.data)
+        G /= 100
+        assert nan_allclose(M.get_data(), A)
+
     def test_layer_API(self):
         """Vector and Raster instances have a similar API
         """
@@ -1723,8 +1987,15 @@ class Test_IO(unittest.TestCase):
         # Exceptions
         exclude = ['get_topN', 'get_bins',
                    'get_geotransform',
+                   'get_block_size',
+                   'iter_blocks',
+                   'clear_data_cache',
+                   'get_band',
+                   'get_bands',
                    'get_nodata_value',
                    'get_attribute_names',
+                   'get_column',
+                   'add_column',
                    'get_resolution',
                    'get_geometry_type',
                    'get_geometry_name',
@@ -2268,6 +2539,81 @@ class Test_IO(unittest.TestCase):
                    name='Test centroid')
         V.write_to_file(out_filename)
 
+    def test_packed_geometry(self):
+        """Lines and polygons are packed into flat arrays
+        """
+
+        # Two polygons, the second with two holes, and their lines
+        outer_rings = [numpy.array([[168, -2], [169, -2], [169, -1],
+                                    [168, -1], [168, -2]]),
+                       numpy.array([[0, 0], [4, 0], [4, 3], [0, 3], [0, 0]])]
+        inner_rings = [[],
+                       [numpy.array([[1, 1], [1, 2], [2, 2], [2, 1], [1, 1]]),
+                        numpy.array([[3, 1], [3, 2], [3.5, 2], [3, 1]])]]
+        polygons = [Polygon(outer_ring=outer_rings[i],
+                            inner_rings=inner_rings[i]) for i in range(2)]
+
+        P = pack_polygons(polygons)
+        assert len(P) == 2
+        assert P.coordinates.shape == (19, 2)
+        assert numpy.all(P.ring_offsets == [0, 5, 10, 15, 19])
+        assert numpy.all(P.feature_offsets == [0, 1, 3])
+        assert numpy.allclose(P.get_bboxes(), [[168, 169, -2, -1],
+                                               [0, 4, 0, 3]])
+        assert P.get_bboxes() is P.get_bboxes()
+
+        # Features are views into the packed coordinates
+        for i, polygon in enumerate(P):
+            assert isinstance(polygon, Polygon)
+            assert numpy.may_share_memory(polygon.outer_ring, P.coordinates)
+            assert numpy.allclose(polygon.outer_ring, outer_rings[i])
+            assert len(polygon.inner_rings) == len(inner_rings[i])
+            for j, ring in enumerate(polygon.inner_rings):
+                assert numpy.allclose(ring, inner_rings[i][j])
+
+        # Areas and centroids agree with those of single polygons
+        for signed in [True, False]:
+            A = P.get_areas(signed=signed)
+            for i, ring in enumerate(outer_rings):
+                assert numpy.allclose(A[i], calculate_polygon_area(
+                    ring, signed=signed))
+
+        C = P.get_centroids()
+        for i, ring in enumerate(outer_rings):
+            assert numpy.allclose(C[i], calculate_polygon_centroid(ring))
+
+        # Vector layers keep lines and polygons packed
+        V = Vector(geometry=polygons)
+        assert isinstance(V.get_geometry(packed=True), PackedGeometry)
+        assert numpy.allclose(V.get_bounding_box(), [0, -2, 169, 3])
+        assert V.copy() == V
+        geometry = V.get_geometry(as_geometry_objects=True)
+        assert numpy.allclose(geometry[1].inner_rings[1], inner_rings[1][1])
+
+        C = convert_polygons_to_centroids(V).get_geometry()
+        assert numpy.allclose(C, P.get_centroids())
+
+        L = Vector(geometry=pack_lines(outer_rings))
+        assert L.is_line_data
+        assert len(L.get_geometry()) == 2
+        assert numpy.allclose(L.get_geometry()[0], outer_rings[0])
+
+        try:
+            Vector(geometry=[[0, 0], [1, 1]]).get_geometry(packed=True)
+        except InaSAFEError:
+            pass
+        else:
+            msg = 'Point data can not be packed'
+            raise Exception(msg)
+
+        # Packed geometry is written and read back
+        for layer in [V, L]:
+            tmp_filename = unique_filename(suffix='.shp')
+            layer.write_to_file(tmp_filename)
+            R = read_layer(tmp_filename)
+            assert isinstance(R.get_geometry(packed=True), PackedGeometry)
+            assert R == layer
+
     def test_line_to_points(self):
         """Points along line are computed correctly
         """
@@ -9,13 +9,18 @@ __copyright__ = 'Copyright 2012, Australia Indonesia Facility for '
 __copyright__ += 'Disaster Reduction'
 
 import os
+import shutil
 import logging
 import unittest
+import numpy
 
 from safe.common.testing import UNITDATA
 from safe.common.utilities import temp_dir, unique_filename
 from safe.storage.utilities import read_keywords
-from safe.storage.vector import Vector
+from safe.storage.vector import Vector, get_vector_cache_key
+from safe.storage.vector import load_cache_arrays, pack_cache_values
+from safe.storage.vector import VECTOR_CACHE_VERSION
+from safe.storage.geometry import PackedGeometry
 
 LOGGER = logging.getLogger('InaSAFE')
 KEYWORD_PATH = os.path.abspath(
@@ -65,3 +70,72 @@ class VectorTest(unittest.TestCase):
         test_file = unique_filename(suffix='.sqlite', dir=test_dir)
         layer.write_to_file(test_file, sublayer='foo')
     testSqliteWriting.slow = True
+
+    def testVectorCache(self):
+        """Test that parsed vector data can be cached and reused."""
+        # Work on a copy of the shapefile
+        test_dir = temp_dir(sub_dir='test')
+        base_name = unique_filename(dir=test_dir)
+        for extension in ['.shp', '.shx', '.dbf', '.prj', '.keywords']:
+            if os.path.exists(SHP_BASE + extension):
+                shutil.copy(SHP_BASE + extension, base_name + extension)
+        filename = base_name + '.shp'
+
+        layer = Vector(data=filename, cache=True)
+        cache_filename, key = get_vector_cache_key(filename, True)
+        msg = 'Expected cache file %s to be written' % cache_filename
+        assert os.path.isfile(cache_filename), msg
+
+        # Cache files hold no pickled objects
+        D = load_cache_arrays(cache_filename)
+        try:
+            for name in D.files:
+                assert not D[name].dtype.hasobject, name
+        finally:
+            D.close()
+
+        values, is_none = pack_cache_values(['a', None, 'bcd'])
+        assert values.dtype.kind == 'S'
+        assert values.tolist() == ['a', '', 'bcd']
+        assert is_none.tolist() == [False, True, False]
+        values, is_none = pack_cache_values([None, 1.5])
+        assert values.tolist() == [0.0, 1.5]
+        assert is_none.tolist() == [True, False]
+        assert pack_cache_values(['a', 1]) is None
+        assert pack_cache_values([{}]) is None
+        assert pack_cache_values(['a\x00']) is None
+
+        # Cache files with pickled objects are not read
+        pickled_filename = unique_filename(suffix='.npz', dir=test_dir)
+        numpy.savez(pickled_filename, version=VECTOR_CACHE_VERSION,
+                    source=key, field_names=numpy.array(['a'], dtype=object))
+        assert not Vector()._read_cache(pickled_filename, key)
+
+        # Later reads use the cache file
+        assert Vector()._read_cache(cache_filename, key)
+        cached = Vector(data=filename, cache=True)
+        assert cached.is_polygon_data
+        assert isinstance(cached.get_geometry(packed=True), PackedGeometry)
+        assert numpy.allclose(cached.get_bounding_box(),
+                              layer.get_bounding_box())
+        assert cached == layer
+
+        # Bounding box and fields are cached separately
+        west, south, east, north = layer.get_bounding_box()
+        bbox = [west, south, (west + east) / 2, (south + north) / 2]
+        fields = layer.get_attribute_names()[:1]
+        subset = Vector(data=filename, bbox=bbox, fields=fields, cache=True)
+        assert 0 < len(subset) <= len(layer)
+        assert subset.get_attribute_names() == fields
+        cached = Vector(data=filename, bbox=bbox, fields=fields, cache=True)
+        assert cached == subset
+
+        # Changes to the attribute file invalidate the cache
+        os.utime(base_name + '.dbf', (0, 0))
+        _, new_key = get_vector_cache_key(filename, True)
+        assert new_key != key
+        assert not Vector()._read_cache(cache_filename, new_key)
+
+        cached = Vector(data=filename, cache=True)
+        assert cached == layer
+        assert Vector()._read_cache(cache_filename, new_key)
@@ -741,6 +741,76 @@ def is_sequence(x):
         return True
 
 
+# Python types of attribute values that can be stored in typed arrays
+# without changing the values returned to the user
+COLUMN_TYPES = [(set([bool]), numpy.bool_),
+                (set([int]), numpy.int_),
+                (set([float, numpy.float64]), numpy.float64)]
+
+
+def make_column(values):
+    """Store attribute values for all features in one numpy array
+
+    :param values: One attribute value for each feature
+    :type values: numpy.ndarray, list
+
+    :returns: One dimensional array. Values are stored in an array of
+        type bool, int or float if they all have that type and in an array
+        of objects otherwise. One dimensional numeric arrays are returned
+        as they are.
+    :rtype: numpy.ndarray
+    """
+
+    if isinstance(values, numpy.ndarray) and len(values.shape) == 1:
+        if values.dtype.kind in 'biufO':
+            return values
+        elif values.dtype.kind in 'SU':
+            return values.astype(object)
+
+    values = list(values)
+    types = set([type(x) for x in values])
+    if len(types) > 0:
+        for column_types, dtype in COLUMN_TYPES:
+            if types <= column_types:
+                return numpy.array(values, dtype=dtype)
+
+    # Store values as they are
+    column = numpy.empty(len(values), dtype=object)
+    for i, x in enumerate(values):
+        column[i] = x
+    return column
+
+
+def rows_to_columns(rows):
+    """Convert list of attribute dictionaries to columns
+
+    :param rows: List with one dictionary of attributes for each feature
+    :type rows: list
+
+    :returns: Dictionary with one array for each attribute
+        (see make_column) or None if rows is empty or if the features
+        do not all have the same attribute names.
+    :rtype: dict, None
+    """
+
+    if len(rows) == 0 or not isinstance(rows[0], dict):
+        return None
+
+    names = rows[0].keys()
+    for row in rows:
+        if not isinstance(row, dict) or len(row) != len(names):
+            return None
+
+    columns = {}
+    try:
+        for name in names:
+            columns[name] = make_column([row[name] for row in rows])
+    except KeyError:
+        return None
+
+    return columns
+
+
 def array_to_line(A, geometry_type=ogr.wkbLinearRing):
     """Convert coordinates to linear_ring
 
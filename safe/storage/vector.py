@@ -19,8 +19,9 @@ __copyright__ = 'Copyright 2012, Australia Indonesia Facility for '
 __copyright__ += 'Disaster Reduction'
 
 import os
-import sys
 import numpy
+import zipfile
+import hashlib
 import logging
 
 import copy as copy_module
@@ -32,22 +33,27 @@ from safe.common.exceptions import GetDataError, InaSAFEError
 
 from layer import Layer
 from projection import Projection
-from geometry import Polygon
-from utilities import DRIVER_MAP, TYPE_MAP
+from geometry import Polygon, PackedGeometry
+from geometry import pack_polygons, pack_lines, pack_rings
+from utilities import DRIVER_MAP, TYPE_MAP, INVERSE_GEOMETRY_TYPE_MAP
 from utilities import read_keywords
 from utilities import write_keywords
 from utilities import get_geometry_type
 from utilities import is_sequence
 from utilities import array_to_line
-from utilities import calculate_polygon_centroid
 from utilities import points_along_line
 from utilities import geometry_type_to_string
 from utilities import get_ring_data, get_polygon_data
 from utilities import rings_equal
+from utilities import make_column, rows_to_columns
 
 LOGGER = logging.getLogger('InaSAFE')
 _pseudo_inf = float(99999999)
 
+# Format of vector cache files (see Vector.read_from_file).
+# Increase when their contents change so that old files are not used.
+VECTOR_CACHE_VERSION = 2
+
 
 # noinspection PyExceptionInherit
 class Vector(Layer):
@@ -59,6 +65,8 @@ class Vector(Layer):
                 * A filename of a vector file format known to GDAL.
                 * List of dictionaries of field names and attribute values
                   associated with each point coordinate.
+                * Dictionary of field names and sequences of attribute
+                  values, one value for each feature.
                 * None
             * projection: Geospatial reference in WKT format.
                 Only used if geometry is provided as a numeric array,
@@ -84,6 +92,14 @@ class Vector(Layer):
                   table name in case of sqlite etc.) to load. Only applicable
                   to those dataformats supporting more than one layer in the
                   data file.
+            * bbox: Optional bounding box [West, South, East, North] in
+                the coordinates of the file. Only features intersecting it
+                are read. Only used if data is a filename.
+            * fields: Optional list of attribute names to read. Other
+                attributes are skipped. Only used if data is a filename.
+            * cache: Optional cache of parsed vector files. Either True to
+                keep cache files next to the file or the name of a
+                directory for them. Only used if data is a filename.
 
         Returns:
             * InaSAFE vector layer instance
@@ -113,6 +129,13 @@ class Vector(Layer):
             list of polygon geometry objects
             (as defined in module geometry.py)
 
+            Attributes are stored column wise as one numpy array per field.
+            Fields whose values are all of type bool, int or float are
+            stored as typed arrays, all other fields as object arrays.
+            The list of dictionaries returned by get_data() is built
+            on demand. Use get_column and add_column to work on attribute
+            values as arrays.
+
     """
 
     def __init__(
@@ -124,7 +147,10 @@ class Vector(Layer):
             name=None,
             keywords=None,
             style_info=None,
-            sublayer=None):
+            sublayer=None,
+            bbox=None,
+            fields=None,
+            cache=None):
         """Initialise object with either geometry or filename
 
         NOTE: Doc strings in constructor are not harvested and exposed in
@@ -149,7 +175,7 @@ class Vector(Layer):
             return
 
         if isinstance(data, basestring):
-            self.read_from_file(data)
+            self.read_from_file(data, bbox=bbox, fields=fields, cache=cache)
         else:
             # Assume that data is provided as sequences provided as
             # arguments to the Vector constructor
@@ -158,18 +184,26 @@ class Vector(Layer):
             msg = 'Geometry must be specified'
             verify(geometry is not None, msg)
 
-            msg = 'Geometry must be a sequence'
-            verify(is_sequence(geometry), msg)
-
-            if len(geometry) > 0 and isinstance(geometry[0], Polygon):
-                self.geometry_type = ogr.wkbPolygon
+            if isinstance(geometry, PackedGeometry):
+                # Use packed lines or polygons as they are
+                self.geometry_type = INVERSE_GEOMETRY_TYPE_MAP[
+                    geometry.geometry_type]
                 self.geometry = geometry
             else:
-                self.geometry_type = get_geometry_type(geometry, geometry_type)
+                msg = 'Geometry must be a sequence'
+                verify(is_sequence(geometry), msg)
+
+                if len(geometry) > 0 and isinstance(geometry[0], Polygon):
+                    self.geometry_type = ogr.wkbPolygon
+                else:
+                    self.geometry_type = get_geometry_type(geometry,
+                                                           geometry_type)
 
                 if self.is_polygon_data:
-                    # Convert to objects if input is a list of simple arrays
-                    self.geometry = [Polygon(outer_ring=x) for x in geometry]
+                    # Pack polygon objects or simple arrays
+                    self.geometry = pack_polygons(geometry)
+                elif self.is_line_data:
+                    self.geometry = pack_lines(geometry)
                 else:
                     # Convert to list if input is an array
                     if isinstance(geometry, numpy.ndarray):
@@ -180,52 +214,46 @@ class Vector(Layer):
             if data is None:
                 # Generate default attribute as OGR will do that anyway
                 # when writing
-                data = []
-                for i in range(len(geometry)):
-                    data.append({'ID': i})
+                data = {'ID': numpy.arange(len(geometry))}
 
             # Check data
-            self.data = data
-            if data is not None:
-                msg = 'Data must be a sequence'
-                verify(is_sequence(data), msg)
-
-                msg = ('The number of entries in geometry and data '
-                       'must be the same')
+            msg = ('The number of entries in geometry and data '
+                   'must be the same')
+            if isinstance(data, dict):
+                for name in data:
+                    verify(len(geometry) == len(data[name]), msg)
+            else:
+                verify(is_sequence(data), 'Data must be a sequence')
                 verify(len(geometry) == len(data), msg)
+            self.data = data
 
             # Establish extent
-            if len(geometry) == 0:
-                # Degenerate layer
-                self.extent = [0, 0, 0, 0]
-                return
+            self.extent = self._get_extent()
 
-            # Compute bounding box for each geometry type
-            minx = miny = sys.maxint
-            maxx = maxy = -minx
-            if self.is_point_data:
-                A = numpy.array(self.get_geometry())
-                minx = min(A[:, 0])
-                maxx = max(A[:, 0])
-                miny = min(A[:, 1])
-                maxy = max(A[:, 1])
-            elif self.is_line_data:
-                for g in self.get_geometry():
-                    A = numpy.array(g)
-                    minx = min(minx, min(A[:, 0]))
-                    maxx = max(maxx, max(A[:, 0]))
-                    miny = min(miny, min(A[:, 1]))
-                    maxy = max(maxy, max(A[:, 1]))
-            elif self.is_polygon_data:
-                # Do outer ring only
-                for g in self.get_geometry(as_geometry_objects=False):
-                    A = numpy.array(g)
-                    minx = min(minx, min(A[:, 0]))
-                    maxx = max(maxx, max(A[:, 0]))
-                    miny = min(miny, min(A[:, 1]))
-                    maxy = max(maxy, max(A[:, 1]))
+    def _get_extent(self):
+        """Compute extent [minx, maxx, miny, maxy] of all features
+        """
+
+        if len(self) == 0:
+            # Degenerate layer
+            return [0, 0, 0, 0]
+
+        # Compute bounding box for each geometry type
+        if self.is_point_data:
+            A = numpy.array(self.get_geometry())
+            minx = min(A[:, 0])
+            maxx = max(A[:, 0])
+            miny = min(A[:, 1])
+            maxy = max(A[:, 1])
+        else:
+            # Lines or outer rings of polygons
+            bboxes = self.geometry.get_bboxes()
+            minx = min(bboxes[:, 0])
+            maxx = max(bboxes[:, 1])
+            miny = min(bboxes[:, 2])
+            maxy = max(bboxes[:, 3])
 
-            self.extent = [minx, maxx, miny, maxy]
+        return [minx, maxx, miny, maxy]
 
     def __str__(self):
         """Render as name, number of features, geometry type
@@ -326,8 +354,8 @@ class Vector(Layer):
             raise InaSAFEError(msg)
 
         # Check keys for attribute values
-        x = self.get_data()
-        y = other.get_data()
+        x = self._get_rows()
+        y = other._get_rows()
 
         if x is None:
             if y is not None:
@@ -373,7 +401,7 @@ class Vector(Layer):
         return True
 
     # noinspection PyExceptionInherit
-    def read_from_file(self, filename):
+    def read_from_file(self, filename, bbox=None, fields=None, cache=None):
         """Read and unpack vector data.
 
         It is assumed that the file contains only one layer with the
@@ -402,7 +430,34 @@ class Vector(Layer):
         :param filename: a fully qualified location to the file
         :type filename: str
 
+        :param bbox: Optional bounding box [West, South, East, North] in
+            the coordinates of the file. If given, only features
+            intersecting it are read and the extent of the layer is that
+            of these features.
+        :type bbox: list
+
+        :param fields: Optional list of names of the attributes to read.
+            If None all attributes are read.
+        :type fields: list
+
+        :param cache: Optional cache of parsed vector files. Either True to
+            keep cache files next to filename or the name of a directory
+            for them. If None or False no cache is used.
+        :type cache: bool, str
+
         :raises: ReadLayerError
+
+        Note:
+            The bounding box and the attribute names are passed on to OGR
+            as a spatial filter and a list of ignored fields so that
+            features and attributes that are not needed are not decoded.
+
+            If cache is given, geometry and attributes are saved as arrays
+            in a .npz file after reading the file with OGR. Later reads of
+            the same file, sublayer, bbox and fields load the arrays
+            instead, provided the size and modification time of the file
+            (and .shx, .dbf and .prj files for shapefiles) have not
+            changed. Keywords are always read from the keywords file.
         """
 
         base_name = os.path.splitext(filename)[0]
@@ -429,6 +484,14 @@ class Vector(Layer):
         self.filename = filename
         self.geometry_type = None  # In case there are no features
 
+        # Use cached arrays if they are up to date
+        if cache:
+            cache_filename, source_key = get_vector_cache_key(
+                filename, cache, sublayer=self.sublayer, bbox=bbox,
+                fields=fields)
+            if self._read_cache(cache_filename, source_key):
+                return
+
         fid = ogr.Open(filename)
         if fid is None:
             msg = 'Could not open %s' % filename
@@ -458,11 +521,45 @@ class Vector(Layer):
         p = layer.GetSpatialRef()
         self.projection = Projection(p)
 
+        # Only read features intersecting bounding box
+        if bbox is not None:
+            msg = ('Bounding box must be a list of four numbers '
+                   '[West, South, East, North]. I got %s' % str(bbox))
+            verify(is_sequence(bbox) and len(bbox) == 4, msg)
+            verify(bbox[0] <= bbox[2] and bbox[1] <= bbox[3], msg)
+
+            layer.SetSpatialFilterRect(float(bbox[0]), float(bbox[1]),
+                                       float(bbox[2]), float(bbox[3]))
+
         layer.ResetReading()
 
+        # Get attribute names
+        layer_def = layer.GetLayerDefn()
+        names = [layer_def.GetFieldDefn(j).GetName()
+                 for j in range(layer_def.GetFieldCount())]
+        field_indices = range(len(names))
+
+        # Only read requested attributes
+        if fields is not None:
+            msg = ('Fields must be a list of attribute names. I got %s'
+                   % str(fields))
+            verify(is_sequence(fields), msg)
+
+            for name in fields:
+                msg = ('Specified attribute %s does not exist in %s. '
+                       'Valid names are %s' % (name, filename, names))
+                verify(name in names, msg)
+
+            layer.SetIgnoredFields([name for name in names
+                                    if name not in fields])
+            field_indices = [j for j in field_indices if names[j] in fields]
+            names = [names[j] for j in field_indices]
+
         # Extract coordinates and attributes for all features
         geometry = []
-        data = []
+        rings = []
+        ring_counts = []
+        values = [[] for _ in names]
         # Use feature iterator
         for feature in layer:
             # Record coordinates ordered as Longitude, Latitude
@@ -475,11 +572,13 @@ class Vector(Layer):
                 if self.is_point_data:
                     geometry.append((G.GetX(), G.GetY()))
                 elif self.is_line_data:
-                    ring = get_ring_data(G)
-                    geometry.append(ring)
+                    rings.append(get_ring_data(G))
+                    ring_counts.append(1)
                 elif self.is_polygon_data:
                     polygon = get_polygon_data(G)
-                    geometry.append(polygon)
+                    rings.append(polygon.outer_ring)
+                    rings.extend(polygon.inner_rings)
+                    ring_counts.append(1 + len(polygon.inner_rings))
                 elif self.is_multi_polygon_data:
                     try:
                         G = ogr.ForceToPolygon(G)
@@ -497,7 +596,9 @@ class Vector(Layer):
                         # Read polygon data as single part
                         self.geometry_type = ogr.wkbPolygon
                         polygon = get_polygon_data(G)
-                        geometry.append(polygon)
+                        rings.append(polygon.outer_ring)
+                        rings.extend(polygon.inner_rings)
+                        ring_counts.append(1 + len(polygon.inner_rings))
                 else:
                     msg = ('Only point, line and polygon geometries are '
                            'supported. '
@@ -506,34 +607,190 @@ class Vector(Layer):
                                         self.geometry_type))
                     raise ReadLayerError(msg)
 
-            # Record attributes by name
-            number_of_fields = feature.GetFieldCount()
-            fields = {}
-            for j in range(number_of_fields):
-                name = feature.GetFieldDefnRef(j).GetName()
-
+            # Record attributes by field
+            for j, field_values in zip(field_indices, values):
                 # FIXME (Ole): Ascertain the type of each field?
                 #              We need to cast each appropriately?
                 #              This is issue #66
                 #              (https://github.com/AIFDR/riab/issues/66)
                 #feature_type = feature.GetFieldDefnRef(j).GetType()
-                fields[name] = feature.GetField(j)
+                value = feature.GetField(j)
+
+                # We do this because there is NaN problem on windows
+                # NaN value must be converted to _pseudo_in to solve the
+                # problem. But, when InaSAFE read the file, it'll be
+                # converted back to NaN value, so that NaN in InaSAFE is a
+                # numpy.nan
+                # please check https://github.com/AIFDR/inasafe/issues/269
+                # for more information
+                if value == _pseudo_inf:
+                    value = float('nan')
+                field_values.append(value)
 
-                    # We do this because there is NaN problem on windows
-                    # NaN value must be converted to _pseudo_in to solve the
-                    # problem. But, when InaSAFE read the file, it'll be
-                    # converted back to NaN value, so that NaN in InaSAFE is a
-                    # numpy.nan
-                    # please check https://github.com/AIFDR/inasafe/issues/269
-                    # for more information
-                if fields[name] == _pseudo_inf:
-                    fields[name] = float('nan')
-                #print 'Field', name, feature_type, j, fields[name]
-
-            data.append(fields)
         # Store geometry coordinates as a compact numeric array
+        if self.is_polygon_data:
+            self.geometry = pack_rings(rings, ring_counts,
+                                       geometry_type='polygon')
+        elif self.is_line_data:
+            self.geometry = pack_rings(rings, ring_counts,
+                                       geometry_type='line')
+        else:
+            self.geometry = geometry
+        self.data = dict(zip(names, values))
+
+        # Extent of the features read
+        if bbox is not None:
+            self.extent = self._get_extent()
+
+        if cache:
+            self._write_cache(cache_filename, source_key)
+
+    def _read_cache(self, cache_filename, source_key):
+        """Read geometry and attributes from vector cache file
+
+        :param cache_filename: Name of .npz file written by _write_cache
+        :type cache_filename: str
+
+        :param source_key: Key of the vector file as returned by
+            get_vector_cache_key
+        :type source_key: str
+
+        :returns: True if the cache file was up to date and has been read,
+            otherwise False
+        :rtype: bool
+        """
+
+        if not os.path.isfile(cache_filename):
+            return False
+
+        try:
+            D = load_cache_arrays(cache_filename)
+            try:
+                if (int(D['version']) != VECTOR_CACHE_VERSION or
+                        str(D['source']) != source_key):
+                    return False
+
+                projection = Projection(str(D['projection']))
+                extent = D['extent'].tolist()
+                if 'geometry_type' in D.files:
+                    geometry_type = int(D['geometry_type'])
+                else:
+                    geometry_type = None
+
+                if 'coordinates' in D.files:
+                    geometry = PackedGeometry(D['coordinates'],
+                                              D['ring_offsets'],
+                                              D['feature_offsets'],
+                                              str(D['packed_type']))
+                else:
+                    geometry = D['points'].tolist()
+
+                data = {}
+                for j, name in enumerate(D['field_names'].tolist()):
+                    column = D['field_%i' % j]
+                    if 'none_%i' % j in D.files:
+                        # Restore None values of string or mixed columns
+                        values = column.tolist()
+                        for i in numpy.where(D['none_%i' % j])[0]:
+                            values[i] = None
+                        column = make_column(values)
+                    data[name] = column
+            finally:
+                D.close()
+        except Exception, e:
+            msg = ('Could not read vector cache file %s. It will be '
+                   'replaced. Error message: %s' % (cache_filename, e))
+            LOGGER.warn(msg)
+            return False
+
+        self.projection = projection
+        self.extent = extent
+        self.geometry_type = geometry_type
         self.geometry = geometry
         self.data = data
+        return True
+
+    def _write_cache(self, cache_filename, source_key):
+        """Write geometry and attributes to vector cache file
+
+        :param cache_filename: Name of .npz file to write
+        :type cache_filename: str
+
+        :param source_key: Key of the vector file as returned by
+            get_vector_cache_key
+        :type source_key: str
+
+        Note:
+            Failure to write the cache file is logged but not raised.
+            Attributes that can not be stored without pickling, e.g.
+            features with different fields or values other than numbers
+            and strings, are not cached.
+        """
+
+        arrays = {'version': VECTOR_CACHE_VERSION,
+                  'source': source_key,
+                  'projection': self.projection.get_projection(),
+                  'extent': numpy.array(self.extent, dtype='d')}
+
+        if self.geometry_type is not None:
+            arrays['geometry_type'] = self.geometry_type
+
+        if isinstance(self.geometry, PackedGeometry):
+            arrays['coordinates'] = self.geometry.coordinates
+            arrays['ring_offsets'] = self.geometry.ring_offsets
+            arrays['feature_offsets'] = self.geometry.feature_offsets
+            arrays['packed_type'] = self.geometry.geometry_type
+        else:
+            arrays['points'] = numpy.reshape(
+                numpy.array(self.geometry, dtype='d'), (-1, 2))
+
+        columns = self._get_columns()
+        if columns is None:
+            columns = {}
+            names = None
+        else:
+            names = pack_cache_values(columns.keys())
+        if names is None:
+            LOGGER.warn('Vector attributes can not be stored in cache '
+                        'file %s' % cache_filename)
+            return
+        arrays['field_names'] = names[0]
+
+        for j, name in enumerate(columns.keys()):
+            column = columns[name]
+            if column.dtype == object:
+                packed = pack_cache_values(column.tolist())
+                if packed is None:
+                    msg = ('Values of attribute %s can not be stored in '
+                           'cache file %s' % (name, cache_filename))
+                    LOGGER.warn(msg)
+                    return
+                column, is_none = packed
+                if numpy.any(is_none):
+                    arrays['none_%i' % j] = is_none
+            arrays['field_%i' % j] = column
+
+        # Write to temporary file first so that other processes never
+        # see a partially written cache file
+        tmp_filename = '%s.%i.tmp' % (cache_filename, os.getpid())
+        try:
+            cache_dir = os.path.dirname(cache_filename)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+
+            fid = open(tmp_filename, 'wb')
+            try:
+                numpy.savez(fid, **arrays)
+            finally:
+                fid.close()
+
+            if os.path.exists(cache_filename):
+                os.remove(cache_filename)
+            os.rename(tmp_filename, cache_filename)
+        except (IOError, OSError), e:
+            msg = ('Could not write vector cache file %s: %s'
+                   % (cache_filename, e))
+            LOGGER.warn(msg)
 
     def write_to_file(self, filename, sublayer=None):
         """Save vector data to file
@@ -579,12 +836,9 @@ class Vector(Layer):
         else:
             layer_name = sublayer
 
-        # Get vector data
-        if self.is_polygon_data:
-            geometry = self.get_geometry(as_geometry_objects=True)
-        else:
-            geometry = self.get_geometry()
-        data = self.get_data()
+        # Get vector data (packed for lines and polygons)
+        geometry = self.geometry
+        data = self._get_rows()
 
         N = len(geometry)
 
@@ -678,18 +932,13 @@ class Vector(Layer):
                 geom.SetPoint_2D(0, x, y)
             elif self.is_line_data:
                 geom = array_to_line(
-                    geometry[i], geometry_type=ogr.wkbLineString)
+                    geometry.get_rings(i)[0], geometry_type=ogr.wkbLineString)
             elif self.is_polygon_data:
                 # Create polygon geometry
                 geom = ogr.Geometry(ogr.wkbPolygon)
 
-                # Add outer ring
-                linear_ring = array_to_line(
-                    geometry[i].outer_ring, geometry_type=ogr.wkbLinearRing)
-                geom.AddGeometry(linear_ring)
-
-                # Add inner rings if any
-                for A in geometry[i].inner_rings:
+                # Add outer ring and inner rings if any
+                for A in geometry.get_rings(i):
                     geom.AddGeometry(array_to_line(
                         A, geometry_type=ogr.wkbLinearRing))
             else:
@@ -749,12 +998,19 @@ class Vector(Layer):
         This copy will be equal to self in the sense defined by __eq__
         """
 
-        if self.is_polygon_data:
-            geometry = self.get_geometry(copy=True, as_geometry_objects=True)
+        if isinstance(self.geometry, PackedGeometry):
+            geometry = self.get_geometry(copy=True, packed=True)
         else:
             geometry = self.get_geometry(copy=True)
 
-        return Vector(data=self.get_data(copy=True),
+        if self._columns is None:
+            data = self.get_data(copy=True)
+        else:
+            data = {}
+            for name, column in self._columns.items():
+                data[name] = copy_module.deepcopy(column)
+
+        return Vector(data=data,
                       geometry=geometry,
                       projection=self.get_projection(),
                       keywords=self.get_keywords())
@@ -765,7 +1021,77 @@ class Vector(Layer):
         These are the ones that can be used with get_data
         """
 
-        return self.data[0].keys()
+        if self._columns is not None:
+            return self._columns.keys()
+        else:
+            return self._rows[0].keys()
+
+    @property
+    def data(self):
+        """Attributes as a list of dictionaries, one for each feature
+
+        This is the same as get_data()
+        """
+        return self.get_data()
+
+    @data.setter
+    def data(self, data):
+        """Set attributes from a list of dictionaries or columns
+
+        :param data: List of dictionaries of field names and attribute
+            values, one for each feature, or dictionary of field names
+            and sequences of attribute values or None.
+        :type data: list, dict, None
+
+        Note:
+            Lists of dictionaries are stored column wise if all features
+            have the same field names. Otherwise the list itself is kept.
+        """
+
+        self._rows = None
+        self._columns = None
+
+        if isinstance(data, dict):
+            self._columns = {}
+            for name in data:
+                self._columns[name] = make_column(data[name])
+        elif data is not None:
+            self._columns = rows_to_columns(data)
+            if self._columns is None:
+                self._rows = data
+
+    def _get_rows(self):
+        """Get attributes as a list of dictionaries without handing it out
+
+        Unlike get_data() this leaves the columns in place, so the list
+        must not be modified.
+        """
+
+        if self._columns is None:
+            return self._rows
+
+        names = self._columns.keys()
+        if len(names) == 0:
+            return [{} for _ in range(len(self))]
+
+        values = [self._columns[name].tolist() for name in names]
+        return [dict(zip(names, x)) for x in zip(*values)]
+
+    def _get_columns(self):
+        """Get attributes as a dictionary of columns
+
+        If the attributes are held as a list of dictionaries, e.g. after
+        it was handed out by get_data(), new columns are built from it
+        and the list is left in place.
+
+        :returns: Dictionary of numpy arrays or None if the features do
+            not all have the same field names.
+        """
+
+        if self._rows is not None:
+            return rows_to_columns(self._rows)
+
+        return self._columns
 
     def get_data(self, attribute=None, index=None, copy=False):
         """Get vector attributes
@@ -801,38 +1127,147 @@ class Vector(Layer):
             If optional argument copy is True and all attributes are requested,
             a copy will be returned. Otherwise a pointer to the data is
             returned.
+
+            Attributes are stored column wise. When all attributes are
+            requested without copy, the list of dictionaries is built and
+            from then on holds the attributes of the layer, so changes
+            to it are seen by the layer as before. Setting the data again,
+            e.g. V.data = V.get_data(), stores the attributes column wise
+            and releases the list.
         """
 
-        if hasattr(self, 'data'):
+        if self._columns is None and self._rows is None:
             if attribute is None:
+                return None
+            msg = 'Vector data instance does not have any attributes'
+            raise GetDataError(msg)
+
+        if attribute is None:
+            if self._rows is not None:
                 if copy:
-                    return copy_module.deepcopy(self.data)
+                    return copy_module.deepcopy(self._rows)
                 else:
-                    return self.data
+                    return self._rows
+
+            rows = self._get_rows()
+            if copy:
+                # Only values held in object arrays can be shared
+                for column in self._columns.values():
+                    if column.dtype == object:
+                        return copy_module.deepcopy(rows)
             else:
-                msg = ('Specified attribute %s does not exist in '
-                       'vector layer %s. Valid names are %s'
-                       '' % (attribute, self, self.data[0].keys()))
-                verify(attribute in self.data[0], msg)
-
-                if index is None:
-                    # Return all values for specified attribute
-                    return [x[attribute] for x in self.data]
-                else:
-                    # Return value for specified attribute and index
-                    msg = ('Specified index must be either None or '
-                           'an integer. I got %s' % index)
-                    verify(isinstance(index, int), msg)
+                # Hand the list out, it now holds the attributes
+                self._rows = rows
+                self._columns = None
+            return rows
+
+        if self._columns is not None:
+            names = self._columns.keys()
+        else:
+            names = self._rows[0].keys()
 
-                    msg = ('Specified index must lie within the bounds '
-                           'of vector layer %s which is [%i, %i]'
-                           '' % (self, 0, len(self) - 1))
-                    verify(0 <= index < len(self), msg)
+        msg = ('Specified attribute %s does not exist in '
+               'vector layer %s. Valid names are %s'
+               '' % (attribute, self, names))
+        verify(attribute in names, msg)
 
-                    return self.data[index][attribute]
+        if index is None:
+            # Return all values for specified attribute
+            if self._columns is not None:
+                return self._columns[attribute].tolist()
+            else:
+                return [x[attribute] for x in self._rows]
         else:
-            msg = 'Vector data instance does not have any attributes'
-            raise GetDataError(msg)
+            # Return value for specified attribute and index
+            msg = ('Specified index must be either None or '
+                   'an integer. I got %s' % index)
+            verify(isinstance(index, int), msg)
+
+            msg = ('Specified index must lie within the bounds '
+                   'of vector layer %s which is [%i, %i]'
+                   '' % (self, 0, len(self) - 1))
+            verify(0 <= index < len(self), msg)
+
+            if self._columns is not None:
+                return self._columns[attribute][index:index + 1].tolist()[0]
+            else:
+                return self._rows[index][attribute]
+
+    def get_column(self, attribute, copy=False):
+        """Get values of one attribute as a numpy array
+
+        :param attribute: Name of attribute
+        :type attribute: str
+
+        :param copy: Indicate whether to return the array held by the
+            layer or a copy of it.
+        :type copy: bool
+
+        :raises: GetDataError
+
+        :returns: Array with one value for each feature. Values of type
+            bool, int or float are returned in a typed array, other
+            values in an array of objects.
+        :rtype: numpy.ndarray
+
+        Note:
+            Without copy the array held by the layer is returned, so
+            changes to it change the layer. If the attributes are held
+            as a list of dictionaries (see get_data), a new array is
+            always returned.
+        """
+
+        if self._columns is None:
+            # Attributes are held per feature
+            return make_column(self.get_data(attribute))
+
+        msg = ('Specified attribute %s does not exist in '
+               'vector layer %s. Valid names are %s'
+               '' % (attribute, self, self._columns.keys()))
+        verify(attribute in self._columns, msg)
+
+        if copy:
+            return copy_module.deepcopy(self._columns[attribute])
+        else:
+            return self._columns[attribute]
+
+    def add_column(self, attribute, values):
+        """Add or replace values of one attribute for all features
+
+        :param attribute: Name of attribute
+        :type attribute: str
+
+        :param values: One value for each feature. A one dimensional numpy
+            array of numbers is stored without copying.
+        :type values: numpy.ndarray, list
+
+        :raises: VerificationError
+
+        Note:
+            If the attributes are held as a list of dictionaries (see
+            get_data), the values are added to each dictionary.
+        """
+
+        msg = ('Specified attribute must be a string. '
+               'I got %s' % (type(attribute)))
+        verify(isinstance(attribute, basestring), msg)
+
+        column = make_column(values)
+
+        msg = ('Number of values for attribute %s must match the number '
+               'of features in vector layer %s. I got %i values and %i '
+               'features' % (attribute, self, len(column), len(self)))
+        verify(len(column) == len(self), msg)
+
+        if self._columns is None and self._rows is None:
+            self._columns = {}
+
+        if self._columns is None:
+            # Attributes are held per feature, update each of them
+            for i, value in enumerate(column.tolist()):
+                self._rows[i][attribute] = value
+        else:
+            self._columns[attribute] = column
 
     def get_geometry_type(self):
         """Return geometry type for vector layer
@@ -844,7 +1279,8 @@ class Vector(Layer):
         """
         return geometry_type_to_string(self.geometry_type)
 
-    def get_geometry(self, copy=False, as_geometry_objects=False):
+    def get_geometry(self, copy=False, as_geometry_objects=False,
+                     packed=False):
         """Return geometry for vector layer.
 
         Depending on the feature type, geometry is
@@ -868,27 +1304,48 @@ class Vector(Layer):
             than a list of arrays.
         :type as_geometry_objects: bool
 
+        :param packed: Set to return line or polygon geometry as the
+            PackedGeometry instance holding all vertices of the layer.
+        :type packed: bool
+
         :raises: InaSAFEError
 
-        :returns: A list of geometry objects or arrays.
-        :rtype: list
+        :returns: A list of geometry objects or arrays or a PackedGeometry.
+        :rtype: list, PackedGeometry
+
+        Note:
+            Lines and polygons are stored packed into flat arrays (see
+            PackedGeometry) and the arrays and geometry objects returned
+            are views into them.
         """
 
+        if as_geometry_objects and not self.is_polygon_data:
+            msg = ('Argument as_geometry_objects can currently '
+                   'be True only for polygon data')
+            raise InaSAFEError(msg)
+
+        if packed and not isinstance(self.geometry, PackedGeometry):
+            msg = ('Argument packed can be True only for line and '
+                   'polygon data')
+            raise InaSAFEError(msg)
+
+        if not isinstance(self.geometry, PackedGeometry):
+            if copy:
+                return copy_module.deepcopy(self.geometry)
+            else:
+                return self.geometry
+
         if copy:
-            geometry = copy_module.deepcopy(self.geometry)
+            geometry = self.geometry.copy()
         else:
             geometry = self.geometry
 
-        if self.is_polygon_data:
-            if not as_geometry_objects:
-                geometry = [p.outer_ring for p in geometry]
+        if packed:
+            return geometry
+        elif as_geometry_objects:
+            return list(geometry)
         else:
-            if as_geometry_objects:
-                msg = ('Argument as_geometry_objects can currently '
-                       'be True only for polygon data')
-                raise InaSAFEError(msg)
-
-        return geometry
+            return geometry.get_outer_rings()
 
     def get_bounding_box(self):
         """Get bounding box coordinates for vector layer.
@@ -947,7 +1404,7 @@ class Vector(Layer):
         values = self.get_data(attribute)
 
         # Sort and select using Schwarzian transform
-        A = zip(values, self.data, self.geometry)
+        A = zip(values, self._get_rows(), self.geometry)
         A.sort()
 
         # Pick top N and unpack
@@ -1009,6 +1466,148 @@ class Vector(Layer):
 #----------------------------------
 # Helper functions for class Vector
 #----------------------------------
+def get_vector_cache_key(filename, cache, sublayer=None, bbox=None,
+                         fields=None):
+    """Get cache file name and key for reading vector file
+
+    :param filename: Name of vector file
+    :type filename: str
+
+    :param cache: True to keep the cache file next to filename or name of
+        directory for cache files
+    :type cache: bool, str
+
+    :param sublayer: Sublayer to be read
+    :type sublayer: str
+
+    :param bbox: Bounding box to be read
+    :type bbox: list
+
+    :param fields: Attribute names to be read
+    :type fields: list
+
+    :returns: Name of .npz cache file for this filename, sublayer, bbox and
+        fields, and a key with path, size and modification time of the
+        file(s) it is read from. The cache file is valid if its key is
+        the same.
+    :rtype: str, str
+    """
+
+    path = os.path.abspath(filename)
+    if bbox is not None:
+        bbox = list(bbox)
+    if fields is not None:
+        fields = sorted(fields)
+
+    digest = hashlib.md5(repr((path, sublayer, bbox, fields))).hexdigest()
+    if cache is True:
+        cache_dir = os.path.dirname(path)
+    else:
+        cache_dir = cache
+    cache_filename = os.path.join(cache_dir, '%s.%s.npz'
+                                  % (os.path.basename(path), digest[:16]))
+
+    # Shapefiles keep attributes and projection in separate files
+    sources = [path]
+    base_name, extension = os.path.splitext(path)
+    if extension == '.shp':
+        for extension in ['.shx', '.dbf', '.prj']:
+            if os.path.isfile(base_name + extension):
+                sources.append(base_name + extension)
+
+    source_key = repr([(x, os.path.getsize(x), os.path.getmtime(x))
+                       for x in sources])
+
+    return cache_filename, source_key
+
+
+def pack_cache_values(values):
+    """Store values of mixed type in an array that needs no pickling
+
+    :param values: Values of one type, e.g. str, unicode or float, or None
+    :type values: list
+
+    :returns: Array of the values with None replaced by a value of the
+        same type and boolean array which is True where values were None,
+        or None if the values can not be stored this way. Values are
+        recovered with tolist().
+    :rtype: numpy.ndarray, numpy.ndarray
+    """
+
+    is_none = numpy.array([x is None for x in values], dtype=numpy.bool_)
+    types = set([type(x) for x in values if x is not None])
+    if len(types) == 0:
+        types = set([str])
+    if len(types) > 1:
+        return None
+
+    value_type = types.pop()
+    if value_type is str:
+        # Fixed width byte strings lose trailing null bytes
+        for x in values:
+            if x is not None and x.endswith('\x00'):
+                return None
+        dtype = numpy.str_
+    elif value_type is unicode:
+        for x in values:
+            if x is not None and x.endswith(u'\x00'):
+                return None
+        dtype = numpy.unicode_
+    elif value_type in (bool, int, float):
+        dtype = value_type
+    else:
+        return None
+
+    fill_value = value_type()
+    values = [fill_value if x is None else x for x in values]
+    try:
+        array = numpy.array(values, dtype=dtype)
+    except (OverflowError, ValueError):
+        return None
+
+    return array, is_none
+
+
+def load_cache_arrays(cache_filename):
+    """Load arrays from vector cache file without unpickling any data
+
+    :param cache_filename: Name of .npz file written by Vector._write_cache
+    :type cache_filename: str
+
+    :returns: Arrays in the file
+    :rtype: numpy.lib.npyio.NpzFile
+
+    :raises: VerificationError if the file holds pickled data
+    """
+
+    try:
+        return numpy.load(cache_filename, allow_pickle=False)
+    except TypeError:
+        pass
+
+    # Older numpy versions have no allow_pickle and unpickle object
+    # arrays and files that are not npz archives. Check before loading.
+    msg = 'Vector cache file %s is not an npz file' % cache_filename
+    verify(zipfile.is_zipfile(cache_filename), msg)
+    archive = zipfile.ZipFile(cache_filename)
+    try:
+        for name in archive.namelist():
+            fid = archive.open(name)
+            try:
+                numpy.lib.format.read_magic(fid)
+                header = numpy.lib.format.read_array_header_1_0(fid)
+            finally:
+                fid.close()
+
+            msg = ('Vector cache file %s holds pickled data in %s'
+                   % (cache_filename, name))
+            verify(not numpy.dtype(header[2]).hasobject, msg)
+    finally:
+        archive.close()
+
+    return numpy.load(cache_filename)
+
+
 def convert_line_to_points(V, delta):
     """Convert line vector data to point vector data
 
@@ -1063,14 +1662,8 @@ def convert_polygons_to_centroids(V):
     msg = 'Input data %s must be polygon vector data' % V
     verify(V.is_polygon_data, msg)
 
-    geometry = V.get_geometry()
-    N = len(V)
-
-    # Calculate points for each polygon
-    centroids = []
-    for i in range(N):
-        c = calculate_polygon_centroid(geometry[i])
-        centroids.append(c)
+    # Calculate points for all polygons at once
+    centroids = V.get_geometry(packed=True).get_centroids()
 
     # Create new point vector layer with same attributes and return
     V = Vector(data=V.get_data(),
@@ -58,6 +58,7 @@ from safe_qgis.safe_interface import (
     safe_read_layer,
     ReadLayerError,
     points_in_and_outside_polygon,
+    label_points_by_polygons,
     calculate_polygon_centroid,
     unique_filename,
     messaging as m)
@@ -462,8 +463,6 @@ class Aggregator(QtCore.QObject):
                     safe_impact_layer.is_polygon_data):
                 LOGGER.debug('Doing point in polygon aggregation')
 
-                myRemainingValues = myImpactValues
-
                 if safe_impact_layer.is_polygon_data:
                     # Using centroids to do polygon in polygon aggregation
                     # this is always ok because
@@ -483,33 +482,34 @@ class Aggregator(QtCore.QObject):
                             outer_ring = myPolygon
                         c = calculate_polygon_centroid(outer_ring)
                         myCentroids.append(c)
-                    myRemainingPoints = myCentroids
+                    myPoints = myCentroids
 
                 else:
                     #this are already points data
-                    myRemainingPoints = myImpactGeoms
+                    myPoints = myImpactGeoms
+
+                # Label each point with the aggregation unit it falls in.
+                # If units overlap the first one encountered is used.
+                try:
+                    myLabels = label_points_by_polygons(
+                        myPoints,
+                        myAggregtionUnits,
+                        closed=True,
+                        check_input=True)
+                except PointsInputError:  # too few points provided
+                    myLabels = numpy.zeros(len(myPoints), dtype=numpy.int32)
+                    myLabels -= 1
+
+                # Group point indices by aggregation unit
+                myOrder = numpy.argsort(myLabels, kind='mergesort')
+                myLimits = numpy.cumsum(numpy.bincount(
+                    myLabels + 1, minlength=len(myAggregtionUnits) + 1))
 
                 #iterate over the aggregation units
-                for myPolygonIndex, myPolygon in enumerate(myAggregtionUnits):
-                    if hasattr(myPolygon, 'outer_ring'):
-                        outer_ring = myPolygon.outer_ring
-                        inner_rings = myPolygon.inner_rings
-                    else:
-                        # Assume it is an array
-                        outer_ring = myPolygon
-                        inner_rings = None
+                for myPolygonIndex in range(len(myAggregtionUnits)):
+                    inside = myOrder[myLimits[myPolygonIndex]:
+                                     myLimits[myPolygonIndex + 1]]
 
-                    try:
-                        # noinspection PyArgumentEqualDefault
-                        inside, outside = points_in_and_outside_polygon(
-                            myRemainingPoints,
-                            outer_ring,
-                            holes=inner_rings,
-                            closed=True,
-                            check_input=True)
-                    except PointsInputError:  # too few points provided
-                        inside = []
-                        outside = []
                     #self.impactLayerAttributes is a list of list of dict
                     #[
                     #   [{...},{...},{...}],
@@ -522,7 +522,7 @@ class Aggregator(QtCore.QObject):
                             myResults[myClass] = 0
 
                         for i in inside:
-                            myKey = myRemainingValues[i][self.targetField]
+                            myKey = myImpactValues[i][self.targetField]
                             try:
                                 myResults[myKey] += 1
                             except KeyError:
@@ -537,7 +537,7 @@ class Aggregator(QtCore.QObject):
                                 raise KeyError(myError)
 
                             self.impactLayerAttributes[myPolygonIndex].append(
-                                myRemainingValues[i])
+                                myImpactValues[i])
                         myAttrs = {}
                         for k, v in myResults.iteritems():
                             myKey = '%s_%s' % (k, self.targetField)
@@ -552,14 +552,14 @@ class Aggregator(QtCore.QObject):
                         myTotal = 0
                         for i in inside:
                             try:
-                                myTotal += myRemainingValues[i][
+                                myTotal += myImpactValues[i][
                                     self.targetField]
                             except TypeError:
                                 pass
 
                             #add all attributes to the impactLayerAttributes
                             self.impactLayerAttributes[myPolygonIndex].append(
-                                myRemainingValues[i])
+                                myImpactValues[i])
                         myAttrs = {myAggrFieldIndex: myTotal}
 
                     # Add features inside this polygon
@@ -567,25 +567,6 @@ class Aggregator(QtCore.QObject):
                     myAggregationProvider.changeAttributeValues(
                         {myFID: myAttrs})
 
-                    # make outside points the input to the next iteration
-                    # this could maybe be done more quickly using directly
-                    # numpy arrays like this:
-                    # myRemainingPoints = myRemainingPoints[outside]
-                    # myRemainingValues =
-                    # [myRemainingValues[i] for i in outside]
-                    myTmpPoints = []
-                    myTmpValues = []
-                    for i in outside:
-                        myTmpPoints.append(myRemainingPoints[i])
-                        myTmpValues.append(myRemainingValues[i])
-                    myRemainingPoints = myTmpPoints
-                    myRemainingValues = myTmpValues
-
-                    # LOGGER.debug('Before: ' + str(len(myRemainingValues)))
-                    # LOGGER.debug('After: ' + str(len(myRemainingValues)))
-                    # LOGGER.debug('Inside: ' + str(len(inside)))
-                    # LOGGER.debug('Outside: ' + str(len(outside)))
-
             elif safe_impact_layer.is_line_data:
                 LOGGER.debug('Doing line in polygon aggregation')
 
@@ -55,6 +55,7 @@ from safe.api import (
     ReadLayerError,
     get_plugins, get_version,
     in_and_outside_polygon as points_in_and_outside_polygon,
+    label_points_by_polygons,
     calculate_polygon_centroid,
     get_postprocessors,
     get_postprocessor_human_name,